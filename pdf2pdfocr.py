@@ -10,39 +10,62 @@
 # and this post: https://github.com/jbarlow83/OCRmyPDF/issues/8
 ###############################################################################
 import argparse
+import collections
 import configparser
+import contextlib
 import datetime
 import errno
 import glob
+import hashlib
+import importlib.util
 import io
-import itertools
+import json
 import math
 import multiprocessing
 import os
+import queue
 import random
 import re
 import shlex
 import shutil
 import signal
 import string
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from collections import namedtuple
 from concurrent import futures
-from pathlib import Path
 from xml.etree import ElementTree
 
-import PyPDF2
-import psutil
-from PIL import Image, ImageChops
-from PyPDF2.errors import PdfReadError
-from PyPDF2.generic import ByteStringObject
-from bs4 import BeautifulSoup
-from packaging.version import parse as parse_version
-from reportlab.lib.units import inch
-from reportlab.pdfgen.canvas import Canvas
+
+
+def lazy_import(param_module_name):
+    """Module loaded on first attribute access. Runs that stop early and spawned workers do not pay for unused dependencies"""
+    if param_module_name in sys.modules:
+        return sys.modules[param_module_name]
+    module_spec = importlib.util.find_spec(param_module_name)
+    module_spec.loader = importlib.util.LazyLoader(module_spec.loader)
+    module = importlib.util.module_from_spec(module_spec)
+    sys.modules[param_module_name] = module
+    module_spec.loader.exec_module(module)
+    parent_name, _, child_name = param_module_name.rpartition(".")
+    if parent_name != "":
+        setattr(sys.modules[parent_name], child_name, module)
+    return module
+
+
+# Heavy dependencies are imported on first use, so startup (e.g. "--help" or a file rejected early) doesn't pay for them.
+# Names imported "from" a module (bs4, reportlab) are imported where they are used.
+# Import time budget is 100 ms, about 55 ms measured with bytecode compiled (checked by tests/test_import_time.py).
+PyPDF2 = lazy_import("PyPDF2")
+psutil = lazy_import("psutil")
+Image = lazy_import("PIL.Image")
+ImageChops = lazy_import("PIL.ImageChops")
+pdfmetrics = lazy_import("reportlab.pdfbase.pdfmetrics")
+packaging_version = lazy_import("packaging.version")
 
 __author__ = 'Leonardo F. Cardoso'
 
@@ -53,11 +76,33 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, flush=True, **kwargs)
 
 
+def register_worker(param_worker_pids):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Pool initializer: each worker sends its pid to its session, so tools run by tasks of one pool can be found (see 'get_workers').
+    """
+    param_worker_pids.put(os.getpid())
+
+
+def wait_process(param_process, param_timeout):
+    """Wait for an external process. After timeout in seconds ('None' is no limit), process is killed and False is returned"""
+    try:
+        param_process.wait(timeout=param_timeout)
+    except subprocess.TimeoutExpired:
+        param_process.kill()
+        param_process.wait()
+        return False
+    return True
+
+
 def do_pdftoimage(param_path_pdftoppm, param_page_range, param_input_file, param_image_resolution, param_tmp_dir,
-                  param_prefix, param_shell_mode):
+                  param_prefix, param_shell_mode, param_timeout=None):
     """
     Will be called from multiprocessing, so no global variables are allowed.
     Convert PDF to image file.
+    Images are renamed to "<prefix>-<page number with 9 digits>.<ext>" (same names used for image input files).
+    Return the pdftoppm return code and the list of created images. Return code is None if pdftoppm was killed after
+    timeout, and only complete images are returned.
     """
     command_line_list = [param_path_pdftoppm]
     first_page = 0
@@ -66,48 +111,282 @@ def do_pdftoimage(param_path_pdftoppm, param_page_range, param_input_file, param
         first_page = param_page_range[0]
         last_page = param_page_range[1]
         command_line_list += ['-f', str(first_page), '-l', str(last_page)]
+    # Each range uses its own dir, so created images can be found without scanning the whole temp dir
+    range_dir = param_tmp_dir + "pdftoppm_{0}-{1}-{2}".format(param_prefix, first_page, last_page) + os.path.sep
+    os.mkdir(range_dir)
     #
-    command_line_list += ['-r', str(param_image_resolution), '-jpeg', param_input_file, param_tmp_dir + param_prefix]
+    command_line_list += ['-r', str(param_image_resolution), '-jpeg', param_input_file, range_dir + param_prefix]
     pimage = subprocess.Popen(command_line_list, stdout=subprocess.DEVNULL,
                               stderr=open(param_tmp_dir + "pdftoppm_err_{0}-{1}-{2}.log".format(param_prefix, first_page, last_page), "wb"),
                               shell=param_shell_mode)
-    pimage.wait()
-    return pimage.returncode
+    return_code = pimage.returncode if wait_process(pimage, param_timeout) else None
+    #
+    image_names = sorted(os.listdir(range_dir))
+    if return_code is None and len(image_names) > 0:
+        # Pages are rasterized in order, so only the last image may be incomplete
+        os.remove(range_dir + image_names.pop())
+    image_files = []
+    for image_name in image_names:
+        image_name_no_ext, image_ext = os.path.splitext(image_name)
+        page_number = int(image_name_no_ext.rsplit("-", 1)[1])
+        image_file = param_tmp_dir + "{0}-{1:09d}{2}".format(param_prefix, page_number, image_ext)
+        os.rename(range_dir + image_name, image_file)
+        image_files.append(image_file)
+    os.rmdir(range_dir)
+    return return_code, image_files
+
+
+def do_pdftoimage_memory(param_path_pdftoppm, param_page_number, param_input_file, param_image_resolution, param_image_file,
+                         param_tmp_dir, param_shell_mode, param_timeout=None):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Convert one PDF page to an uncompressed greyscale image (PGM) in an anonymous memory file, so raster data never touches
+    disk and there is no JPEG encoding. 'param_image_file' is created as a link to the memory file and can be used as any
+    other image file while the returned file descriptor is open. Return None if pdftoppm was killed after timeout.
+    """
+    image_fd = os.memfd_create(os.path.basename(param_image_file))
+    pimage = subprocess.Popen([param_path_pdftoppm, '-f', str(param_page_number), '-l', str(param_page_number),
+                               '-r', str(param_image_resolution), '-gray', param_input_file],
+                              stdout=image_fd,
+                              stderr=open(param_tmp_dir + "pdftoppm_err_{0}.log".format(os.path.basename(param_image_file)), "wb"),
+                              shell=param_shell_mode)
+    if not wait_process(pimage, param_timeout):
+        os.close(image_fd)
+        return None
+    if pimage.returncode != 0:
+        os.close(image_fd)
+        raise Pdf2PdfOcrException("Fail to create image of page {0} from PDF".format(param_page_number))
+    # Link left by an interrupted run of the same job (see '--resume-dir')
+    if os.path.islink(param_image_file):
+        os.remove(param_image_file)
+    os.symlink("/proc/{0}/fd/{1}".format(os.getpid(), image_fd), param_image_file)
+    return image_fd
+
+
+def do_pdftoimage_again(param_image_file, param_image_resolution, param_settings):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Rasterize again the page of an image created by 'do_pdftoimage' or 'do_pdftoimage_memory', with other resolution.
+    Return False if pdftoppm was killed after page timeout (image is kept as it was).
+    """
+    page_number = int(os.path.splitext(param_image_file)[0][-9:])
+    if param_settings["raster_in_memory"]:
+        # Page is rasterized in a new memory file, then copied to the memory file linked by image file (truncated and written again)
+        error_log_file = param_settings["tmp_dir"] + "pdftoppm_err_{0}.log".format(os.path.basename(param_image_file))
+        again_fd = os.memfd_create(os.path.basename(param_image_file))
+        try:
+            pimage = subprocess.Popen([param_settings["path_pdftoppm"], '-f', str(page_number), '-l', str(page_number),
+                                       '-r', str(param_image_resolution), '-gray', param_settings["input_file_for_images"]],
+                                      stdout=again_fd, stderr=open(error_log_file, "wb"), shell=param_settings["shell_mode"])
+            if not wait_process(pimage, param_settings["page_timeout"]):
+                return False
+            return_code = pimage.returncode
+            if return_code == 0:
+                with open(again_fd, "rb", closefd=False) as again_file, open(param_image_file, "wb") as image_memory_file:
+                    again_file.seek(0)
+                    shutil.copyfileobj(again_file, image_memory_file)
+        finally:
+            os.close(again_fd)
+    else:
+        return_code, _ = do_pdftoimage(param_settings["path_pdftoppm"], (page_number, page_number), param_settings["input_file_for_images"],
+                                       param_image_resolution, param_settings["tmp_dir"], param_settings["prefix"], param_settings["shell_mode"],
+                                       param_settings["page_timeout"])
+        if return_code is None:
+            return False
+    if return_code != 0:
+        raise Pdf2PdfOcrException("Fail to create image of page {0} from PDF".format(page_number))
+    return True
 
 
-def do_autorotate_info(param_image_file, param_shell_mode, param_temp_dir, param_tess_lang, param_path_tesseract, param_tesseract_version):
+def do_autorotate_info(param_image_file, param_settings):
     """
     Will be called from multiprocessing, so no global variables are allowed.
-    Do autorotate of images based on tesseract (execution with 'psm 0') information.
+    Orientation of image with tesseract ('psm 0'), saved in "<image>.osd" file. Orientation is detected in a downscaled copy of
+    the image, and again in the full image only when orientation confidence is low.
     """
-    param_image_no_ext = os.path.splitext(os.path.basename(param_image_file))[0]
-    psm_parameter = "-psm" if (param_tesseract_version == 3) else "--psm"
-    tess_command_line = [param_path_tesseract, '-l', "osd+" + param_tess_lang, psm_parameter, '0', param_image_file,
-                         param_temp_dir + param_image_no_ext]
+    temp_dir = param_settings["tmp_dir"]
+    image_no_ext = os.path.splitext(os.path.basename(param_image_file))[0]
+    osd_scale = param_settings["osd_resolution"] / param_settings["image_resolution"]
+    if osd_scale < 1:
+        small_image_file = temp_dir + "osd_" + image_no_ext + ".png"
+        with Image.open(param_image_file) as im:
+            small_image_size = (max(1, round(im.width * osd_scale)), max(1, round(im.height * osd_scale)))
+            im.draft("L", small_image_size)  # JPEG images are decoded already reduced
+            im.convert("L").resize(small_image_size, Image.BILINEAR).save(small_image_file)
+        try:
+            do_tesseract_osd(small_image_file, temp_dir + image_no_ext, param_settings)
+        finally:
+            Pdf2PdfOcr.best_effort_remove(small_image_file)
+        if get_osd_confidence(temp_dir + image_no_ext + ".osd") >= param_settings["osd_min_confidence"]:
+            return
+    do_tesseract_osd(param_image_file, temp_dir + image_no_ext, param_settings)
+
+
+def do_tesseract_osd(param_image_file, param_output_base, param_settings):
+    """Run tesseract orientation and script detection ('psm 0'), creating "<output base>.osd" file"""
+    output_no_ext = os.path.basename(param_output_base)
+    psm_parameter = "-psm" if (param_settings["tesseract_version"] == 3) else "--psm"
+    tess_command_line = [param_settings["path_tesseract"], '-l', "osd+" + param_settings["tess_langs"], psm_parameter, '0', param_image_file,
+                         param_output_base]
     ptess1 = subprocess.Popen(tess_command_line,
-                              stdout=open(param_temp_dir + "autorot_tess_out_{0}.log".format(param_image_no_ext), "wb"),
-                              stderr=open(param_temp_dir + "autorot_tess_err_{0}.log".format(param_image_no_ext), "wb"),
-                              shell=param_shell_mode)
+                              stdout=open(param_settings["tmp_dir"] + "autorot_tess_out_{0}.log".format(output_no_ext), "wb"),
+                              stderr=open(param_settings["tmp_dir"] + "autorot_tess_err_{0}.log".format(output_no_ext), "wb"),
+                              shell=param_settings["shell_mode"])
     ptess1.wait()
 
 
-def do_deskew(param_image_file, param_threshold, param_shell_mode, param_path_mogrify):
+def get_osd_rotation(param_osd_file):
+    """Clockwise rotation angle ('Rotate') of an OSD file, or zero if it's missing"""
+    try:
+        with open(param_osd_file, 'r') as f:
+            match = re.search(r"^Rotate: (\d+)", f.read(), re.MULTILINE)
+    except OSError:
+        return 0
+    return int(match.group(1)) % 360 if match else 0
+
+
+def do_rotate_image(param_image_file, param_angle):
+    """Rotate image clockwise (angle is a multiple of 90 degrees), keeping its format and resolution"""
+    transpose_methods = {90: Image.Transpose.ROTATE_270, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_90}
+    with Image.open(param_image_file) as im:
+        image_format, image_info = im.format, im.info
+        rotated_image = im.transpose(transpose_methods[param_angle])
+    save_page_image(rotated_image, param_image_file, image_format, image_info)
+
+
+def do_scale_image(param_image_file, param_from_resolution, param_to_resolution):
+    """Scale image rasterized in a lower resolution to the size (and resolution) of page images, keeping its format"""
+    scale = param_to_resolution / param_from_resolution
+    with Image.open(param_image_file) as im:
+        image_format, image_info = im.format, dict(im.info, dpi=(param_to_resolution, param_to_resolution))
+        scaled_image = im.resize((round(im.width * scale), round(im.height * scale)), Image.BILINEAR)
+    save_page_image(scaled_image, param_image_file, image_format, image_info)
+
+
+def save_page_image(param_image, param_image_file, param_image_format, param_image_info):
+    """Save a transformed page image over its file, with the same format and resolution"""
+    save_params = {"dpi": param_image_info["dpi"]} if "dpi" in param_image_info else {}
+    if param_image_format == "JPEG":
+        save_params["quality"] = 95
+    param_image.save(param_image_file, param_image_format, **save_params)
+
+
+def get_osd_confidence(param_osd_file):
+    """Orientation confidence of an OSD file, or zero if it's missing"""
+    try:
+        with open(param_osd_file, 'r') as f:
+            match = re.search(r"^Orientation confidence: ([\d.]+)", f.read(), re.MULTILINE)
+    except OSError:
+        return 0.0
+    return float(match.group(1)) if match else 0.0
+
+
+def do_autorotate_info_from_hocr(param_image_file, param_settings):
     """
     Will be called from multiprocessing, so no global variables are allowed.
-    Do a deskew of image.
+    Orientation of image from text lines angles ('textangle') in HOCR of OCR, as tesseract already detects orientation in page
+    segmentation modes 1 and 12. OSD file is written in the format of tesseract 'psm 0', and confidence is the percent of
+    lines with page orientation. Without HOCR (e.g. OCR result from cache), orientation is detected with 'do_autorotate_info'.
     """
-    pd = subprocess.Popen([param_path_mogrify, '-deskew', param_threshold, param_image_file], shell=param_shell_mode)
-    pd.wait()
+    image_file_base = os.path.splitext(param_image_file)[0]
+    try:
+        with open(image_file_base + ".hocr", 'rb') as f:
+            hocr = f.read()
+    except OSError:
+        do_autorotate_info(param_image_file, param_settings)
+        return
+    line_angles = collections.Counter()
+    for line_tag in re.findall(rb"class=['\"]ocr_(?:line|header|caption|textfloat)['\"][^>]*>", hocr):
+        match = re.search(rb"textangle (\d+)", line_tag)
+        line_angles[int(match.group(1)) % 360 if match else 0] += 1
+    orientation, orientation_lines = line_angles.most_common(1)[0] if len(line_angles) > 0 else (0, 0)
+    confidence = 100 * orientation_lines / max(1, sum(line_angles.values()))
+    with open(image_file_base + ".osd", 'w') as f:
+        f.write("Page number: 0\nOrientation in degrees: {0}\nRotate: {1}\nOrientation confidence: {2:.2f}\n"
+                "Orientation source: hocr\n".format(orientation, (360 - orientation) % 360, confidence))
+
+
+def do_deskew(param_image_file, param_threshold, param_shell_mode, param_path_mogrify, param_timeout=None):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Do a deskew of image. Return False if mogrify was killed after timeout (image is kept unchanged).
+    """
+    if param_timeout is None:
+        pd = subprocess.Popen([param_path_mogrify, '-deskew', param_threshold, param_image_file], shell=param_shell_mode)
+        pd.wait()
+        return True
+    # Mogrify writes over its input, so a killed process could leave a broken image
+    image_dir, image_name = os.path.split(param_image_file)
+    deskew_file = os.path.join(image_dir, "deskew_" + image_name)
+    shutil.copyfile(param_image_file, deskew_file)
+    pd = subprocess.Popen([param_path_mogrify, '-deskew', param_threshold, deskew_file], shell=param_shell_mode)
+    if not wait_process(pd, param_timeout):
+        os.remove(deskew_file)
+        return False
+    if os.path.islink(param_image_file):
+        # Image in memory: memory file is written again
+        with open(deskew_file, "rb") as f_deskew, open(param_image_file, "wb") as f_image:
+            shutil.copyfileobj(f_deskew, f_image)
+        os.remove(deskew_file)
+    else:
+        os.replace(deskew_file, param_image_file)
     return True
 
 
-def do_ocr_tesseract(param_image_file, param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_temp_dir, param_shell_mode, param_path_tesseract,
-                     param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf):
+def get_skew_angle(param_image_file, param_max_angle):
     """
-    Will be called from multiprocessing, so no global variables are allowed.
-    Do OCR of image with tesseract
+    Angle (degrees, counterclockwise) that makes text lines of image horizontal, estimated with projection profiles: a downscaled
+    copy is rotated by each candidate angle and the angle with the sharpest profile of rows (lines of text and gaps between them)
+    wins. Rows are summed by PIL (resize to one column), so only the profile is handled in Python.
     """
-    param_image_no_ext = os.path.splitext(os.path.basename(param_image_file))[0]
+    profile_size = 600
+    with Image.open(param_image_file) as im:
+        im.draft("L", (im.width * profile_size // max(im.size), im.height * profile_size // max(im.size)))
+        small_image = im.convert("L")
+    if max(small_image.size) > profile_size:
+        small_image.thumbnail((profile_size, profile_size), Image.BILINEAR)
+    # Ink is white on black background, so background added by rotation doesn't count
+    small_image = small_image.point(lambda value: 255 if value < 128 else 0)
+
+    def profile_score(angle):
+        rows = list(small_image.rotate(angle, Image.NEAREST).resize((1, small_image.height), Image.BOX).getdata())
+        return sum((row - next_row) ** 2 for row, next_row in zip(rows, rows[1:]))
+
+    coarse_step, fine_step = 0.5, 0.1
+    coarse_angles = [step * coarse_step for step in range(-int(param_max_angle / coarse_step), int(param_max_angle / coarse_step) + 1)]
+    best_angle = max(coarse_angles, key=profile_score)
+    fine_angles = [best_angle + step * fine_step for step in range(-int(coarse_step / fine_step), int(coarse_step / fine_step) + 1)]
+    return round(max(fine_angles, key=profile_score), 2)
+
+
+def do_deskew_image(param_image_file, param_angle):
+    """Rotate image counterclockwise by a small angle (degrees) around its center, keeping size, format and resolution"""
+    with Image.open(param_image_file) as im:
+        image_format, image_info = im.format, im.info
+        deskewed_image = im.rotate(param_angle, Image.BICUBIC, fillcolor="white")
+    save_page_image(deskewed_image, param_image_file, image_format, image_info)
+
+
+def do_rotate_text_pdf(param_text_pdf_file, param_angle):
+    """Rotate content of OCR text PDF (one page) counterclockwise by an angle (degrees) around page center, keeping page size"""
+    with open(param_text_pdf_file, 'rb') as f:
+        text_page = PyPDF2.PdfReader(f, strict=False).pages[0]
+        center_x, center_y = float(text_page.mediabox.width) / 2, float(text_page.mediabox.height) / 2
+        # Rotation around origin, then center goes back to its place (translation before rotation is lost by some PyPDF2 versions)
+        cos_angle, sin_angle = math.cos(math.radians(param_angle)), math.sin(math.radians(param_angle))
+        text_page.add_transformation(PyPDF2.Transformation().rotate(param_angle)
+                                     .translate(center_x - center_x * cos_angle + center_y * sin_angle,
+                                                center_y - center_x * sin_angle - center_y * cos_angle))
+        output_pdf = PyPDF2.PdfWriter()
+        output_pdf.add_page(text_page)
+        with open(param_text_pdf_file + ".tmp", 'wb') as f_output:
+            output_pdf.write(f_output)
+    os.replace(param_text_pdf_file + ".tmp", param_text_pdf_file)
+
+
+def get_tesseract_command_line(param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_path_tesseract, param_text_generation_strategy,
+                               param_tess_can_textonly_pdf):
+    """Tesseract command line for OCR, without input and output files"""
     tess_command_line = [param_path_tesseract]
     if type(param_extra_ocr_flag) == str:
         tess_command_line.extend(param_extra_ocr_flag.split(" "))
@@ -122,13 +401,39 @@ def do_ocr_tesseract(param_image_file, param_extra_ocr_flag, param_tess_lang, pa
     #
     tess_command_line += [
         '-c', 'tessedit_create_txt=1',
-        '-c', 'tessedit_pageseg_mode=' + param_tess_psm,
-        param_image_file, param_temp_dir + param_image_no_ext]
+        '-c', 'tessedit_pageseg_mode=' + param_tess_psm]
+    return tess_command_line
+
+
+def do_ocr_tesseract(param_image_file, param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_temp_dir, param_shell_mode, param_path_tesseract,
+                     param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf, param_text_per_line,
+                     param_hocr_resolution=300, param_timeout=None):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Do OCR of image with tesseract. Return False if tesseract was killed after timeout.
+    """
+    param_image_no_ext = os.path.splitext(os.path.basename(param_image_file))[0]
+    tess_command_line = get_tesseract_command_line(param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_path_tesseract,
+                                                   param_text_generation_strategy, param_tess_can_textonly_pdf)
+    tess_command_line += [param_image_file, param_temp_dir + param_image_no_ext]
     pocr = subprocess.Popen(tess_command_line,
                             stdout=subprocess.DEVNULL,
                             stderr=open(param_temp_dir + "tess_err_{0}.log".format(param_image_no_ext), "wb"),
                             shell=param_shell_mode)
-    pocr.wait()
+    if not wait_process(pocr, param_timeout):
+        return False
+    do_tesseract_output(param_image_no_ext, param_temp_dir, param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf,
+                        param_text_per_line, param_hocr_resolution)
+    return True
+
+
+def do_tesseract_output(param_image_no_ext, param_temp_dir, param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf,
+                        param_text_per_line, param_hocr_resolution=300):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Create the text PDF of one image from tesseract output.
+    HOCR coordinates are converted to pt with 'param_hocr_resolution' (pixels per inch).
+    """
     if param_text_generation_strategy == "tesseract" and (not param_tess_can_textonly_pdf):
         pdf_file = param_temp_dir + param_image_no_ext + ".pdf"
         pdf_file_tmp = param_temp_dir + param_image_no_ext + ".tesspdf"
@@ -153,14 +458,126 @@ def do_ocr_tesseract(param_image_file, param_extra_ocr_flag, param_tess_lang, pa
             os.remove(pdf_file_tmp)
     #
     if param_text_generation_strategy == "native":
-        hocr = HocrTransform(param_temp_dir + param_image_no_ext + ".hocr", 300)
+        hocr = HocrTransform(param_temp_dir + param_image_no_ext + ".hocr", param_hocr_resolution)
         hocr.to_pdf(param_temp_dir + param_image_no_ext + ".pdf", image_file_name=None, show_bounding_boxes=False,
-                    invisible_text=True)
-    # Track progress in all situations
-    Path(param_temp_dir + param_image_no_ext + ".tmp").touch()  # .tmp files are used to track overall progress
+                    invisible_text=True, text_per_line=param_text_per_line)
 
 
-def do_ocr_cuneiform(param_image_file, param_extra_ocr_flag, param_cunei_lang, param_temp_dir, param_shell_mode, param_path_cunei):
+def do_ocr_tesseract_batch(param_image_files, param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_temp_dir, param_shell_mode,
+                           param_path_tesseract, param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf,
+                           param_text_per_line, param_hocr_resolution=300, param_timeout=None):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Do OCR of many images with only one tesseract process, so language data is loaded once.
+    Tesseract output (one document for all images) is split in the same files created by 'do_ocr_tesseract' for each image.
+    Timeout is for each image. Return images not OCR'ed because tesseract was killed after timeout.
+    """
+    if len(param_image_files) == 1:
+        if do_ocr_tesseract(param_image_files[0], param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_temp_dir, param_shell_mode,
+                            param_path_tesseract, param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf,
+                            param_text_per_line, param_hocr_resolution, param_timeout):
+            return []
+        return param_image_files
+    #
+    images_no_ext = [os.path.splitext(os.path.basename(image_file))[0] for image_file in param_image_files]
+    batch_no_ext = "batch_" + images_no_ext[0]
+    # Tesseract reads a list of images from a text file, one per line
+    list_file = param_temp_dir + batch_no_ext + ".lst"
+    with open(list_file, "w") as f:
+        f.write("\n".join(param_image_files) + "\n")
+    tess_command_line = get_tesseract_command_line(param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_path_tesseract,
+                                                   param_text_generation_strategy, param_tess_can_textonly_pdf)
+    tess_command_line += [list_file, param_temp_dir + batch_no_ext]
+    pocr = subprocess.Popen(tess_command_line,
+                            stdout=subprocess.DEVNULL,
+                            stderr=open(param_temp_dir + "tess_err_{0}.log".format(batch_no_ext), "wb"),
+                            shell=param_shell_mode)
+    batch_timeout = None if param_timeout is None else param_timeout * len(param_image_files)
+    try:
+        if not wait_process(pocr, batch_timeout):
+            raise ValueError("timeout")
+        split_tesseract_batch_output(param_temp_dir + batch_no_ext, [param_temp_dir + x for x in images_no_ext], param_text_generation_strategy)
+        if param_text_generation_strategy == "native":
+            # Batch HOCR is parsed only once, to create text PDF of each image
+            hocr = HocrTransform(param_temp_dir + batch_no_ext + ".hocr", param_hocr_resolution)
+            for idx, image_no_ext in enumerate(images_no_ext):
+                hocr.to_pdf(param_temp_dir + image_no_ext + ".pdf", image_file_name=None, show_bounding_boxes=False, invisible_text=True,
+                            pages=[idx], text_per_line=param_text_per_line)
+    except (OSError, ValueError, PyPDF2.errors.PdfReadError, ElementTree.ParseError, HocrTransformError) as e:
+        eprint("Warning: fail to OCR images from '{0}' in one process ({1}). Trying again one image at a time.".format(batch_no_ext, e))
+        return [image_file for image_file in param_image_files if not do_ocr_tesseract(
+            image_file, param_extra_ocr_flag, param_tess_lang, param_tess_psm, param_temp_dir, param_shell_mode, param_path_tesseract,
+            param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf, param_text_per_line, param_hocr_resolution,
+            param_timeout)]
+    #
+    if param_text_generation_strategy != "native":
+        for image_no_ext in images_no_ext:
+            do_tesseract_output(image_no_ext, param_temp_dir, param_text_generation_strategy, param_delete_temps, param_tess_can_textonly_pdf,
+                                param_text_per_line, param_hocr_resolution)
+    if param_delete_temps:
+        for batch_file in [list_file, param_temp_dir + batch_no_ext + ".pdf", param_temp_dir + batch_no_ext + ".txt",
+                           param_temp_dir + batch_no_ext + ".hocr", param_temp_dir + "tess_err_{0}.log".format(batch_no_ext)]:
+            Pdf2PdfOcr.best_effort_remove(batch_file)
+    return []
+
+
+def split_tesseract_batch_output(param_batch_file_base, param_images_file_base, param_text_generation_strategy):
+    """Split tesseract output of many images in one file per image (.pdf, .txt and .hocr)"""
+    number_of_images = len(param_images_file_base)
+    if param_text_generation_strategy == "tesseract":
+        with open(param_batch_file_base + ".pdf", 'rb') as f:
+            batch_pdf = PyPDF2.PdfReader(f, strict=False)
+            if len(batch_pdf.pages) != number_of_images:
+                raise ValueError("{0} pages in PDF output".format(len(batch_pdf.pages)))
+            for idx, image_file_base in enumerate(param_images_file_base):
+                image_pdf = PyPDF2.PdfWriter()
+                image_pdf.add_page(batch_pdf.pages[idx])
+                with open(image_file_base + ".pdf", 'wb') as f_image:
+                    image_pdf.write(f_image)
+    #
+    # Text of each image is followed (or separated) by a form feed
+    with open(param_batch_file_base + ".txt", 'rb') as f:
+        batch_text = f.read()
+    image_texts = batch_text.split(b"\f")
+    page_separator = b""
+    if len(image_texts) == number_of_images + 1 and image_texts[-1].strip() == b"":
+        image_texts.pop()
+        page_separator = b"\f"
+    if len(image_texts) != number_of_images:
+        raise ValueError("{0} pages in text output".format(len(image_texts)))
+    for idx, image_file_base in enumerate(param_images_file_base):
+        with open(image_file_base + ".txt", 'wb') as f_image:
+            f_image.write(image_texts[idx] + page_separator)
+    #
+    # HOCR is created by native text generation and by the first pass of adaptive OCR
+    if os.path.isfile(param_batch_file_base + ".hocr"):
+        with open(param_batch_file_base + ".hocr", 'rb') as f:
+            batch_hocr = f.read()
+        page_starts = [match.start() for match in re.finditer(rb"<div class=['\"]ocr_page['\"]", batch_hocr)]
+        body_end = batch_hocr.rfind(b"</body>")
+        if len(page_starts) != number_of_images or body_end < 0:
+            raise ValueError("{0} pages in HOCR output".format(len(page_starts)))
+        # Each image HOCR keeps the document header and footer around its own page
+        page_starts.append(body_end)
+        for idx, image_file_base in enumerate(param_images_file_base):
+            with open(image_file_base + ".hocr", 'wb') as f_image:
+                f_image.write(batch_hocr[:page_starts[0]] + batch_hocr[page_starts[idx]:page_starts[idx + 1]] + batch_hocr[body_end:])
+
+
+def get_hocr_confidence(param_hocr_file):
+    """Mean word confidence (tesseract 'x_wconf', from 0 to 100) of a HOCR file, or None if there are no words"""
+    try:
+        with open(param_hocr_file, 'rb') as f:
+            confidences = [int(confidence) for confidence in re.findall(rb"x_wconf (\d+)", f.read())]
+    except OSError:
+        return None
+    if len(confidences) == 0:
+        return None
+    return sum(confidences) / len(confidences)
+
+
+def do_ocr_cuneiform(param_image_file, param_extra_ocr_flag, param_cunei_lang, param_temp_dir, param_shell_mode, param_path_cunei,
+                     param_text_per_line):
     """
     Will be called from multiprocessing, so no global variables are allowed.
     Do OCR of image with cuneiform
@@ -189,6 +606,7 @@ def do_ocr_cuneiform(param_image_file, param_extra_ocr_flag, param_cunei_lang, p
                                 shell=param_shell_mode)
         pocr.wait()
     #
+    from bs4 import BeautifulSoup
     bs_parser = "lxml"
     if os.path.isfile(param_temp_dir + param_image_no_ext + ".hocr"):
         # Try to fix unclosed meta tags, as cuneiform HOCR may be not well-formed
@@ -202,15 +620,18 @@ def do_ocr_cuneiform(param_image_file, param_extra_ocr_flag, param_cunei_lang, p
         fpw.write(corrected_hocr)
     #
     hocr = HocrTransform(param_temp_dir + param_image_no_ext + ".fixed.hocr", 300)
-    hocr.to_pdf(param_temp_dir + param_image_no_ext + ".pdf", image_file_name=None, show_bounding_boxes=False, invisible_text=True)
+    hocr.to_pdf(param_temp_dir + param_image_no_ext + ".pdf", image_file_name=None, show_bounding_boxes=False, invisible_text=True,
+                text_per_line=param_text_per_line)
     # Track progress
-    Path(param_temp_dir + param_image_no_ext + ".tmp").touch()  # .tmp files are used to track overall progress
 
 
-def do_rebuild(param_image_file, param_path_convert, param_convert_params, param_tmp_dir, param_shell_mode):
+def do_rebuild(param_image_file, param_path_convert, param_convert_params, param_tmp_dir, param_shell_mode, param_timeout=None,
+               param_degraded_convert_params=None):
     """
     Will be called from multiprocessing, so no global variables are allowed.
     Create one PDF file from image file.
+    If convert is killed after timeout, PDF file is created again with degraded convert params (e.g. 'fast' preset).
+    Return a note about degraded rebuild, or None.
     """
     param_image_no_ext = os.path.splitext(os.path.basename(param_image_file))[0]
     # http://stackoverflow.com/questions/79968/split-a-string-by-spaces-preserving-quoted-substrings-in-python
@@ -221,35 +642,77 @@ def do_rebuild(param_image_file, param_path_convert, param_convert_params, param
         stdout=open(param_tmp_dir + "convert_log_{0}.log".format(param_image_no_ext), "wb"),
         stderr=open(param_tmp_dir + "convert_err_{0}.log".format(param_image_no_ext), "wb"),
         shell=param_shell_mode)
-    prebuild.wait()
+    if wait_process(prebuild, param_timeout):
+        return None
+    if param_degraded_convert_params is None:
+        raise Pdf2PdfOcrException("Fail to rebuild PDF page from image '{0}' in {1} seconds".format(param_image_no_ext, param_timeout))
+    # Without degraded params, this call fails instead of returning after timeout
+    do_rebuild(param_image_file, param_path_convert, param_degraded_convert_params, param_tmp_dir, param_shell_mode, param_timeout)
+    return "rebuilt with 'fast' preset"
 
 
 def do_check_img_greyscale(param_image_file):
     """
-    Inspired in code provided by karl-k:
-    https://stackoverflow.com/questions/23660929/how-to-check-whether-a-jpeg-image-is-color-or-gray-scale-using-only-python-stdli
-    Check if image is monochrome (1 channel or 3 identical channels)
+    Check if image is monochrome (1 channel or no pixels with color).
+    Image is checked in reduced size (JPEG draft mode is much faster than full decoding), strip by strip, and the check stops
+    at the first strip with enough color pixels. Small differences between channels (JPEG noise, scanner fringes) don't count.
     """
-    im = Image.open(param_image_file).convert('RGB')
-    rgb = im.split()
-    if ImageChops.difference(rgb[0], rgb[1]).getextrema()[1] != 0:
-        return False
-    if ImageChops.difference(rgb[0], rgb[2]).getextrema()[1] != 0:
-        return False
+    color_tolerance = 24
+    color_pixels_percent = 0.05
+    strip_height = 32
+    with Image.open(param_image_file) as im:
+        if im.mode in ["1", "L", "LA", "I", "I;16", "F"]:
+            return True
+        width, height = im.size
+        im.draft('RGB', (width // 4, height // 4))
+        im = im.convert('RGB')
+    if max(im.size) > 512:
+        im.thumbnail((512, 512))
+    max_color_pixels = im.size[0] * im.size[1] * color_pixels_percent / 100
+    color_pixels = 0
+    for strip_top in range(0, im.size[1], strip_height):
+        red, green, blue = im.crop((0, strip_top, im.size[0], min(strip_top + strip_height, im.size[1]))).split()
+        # Biggest difference between channels of each pixel
+        chroma = ImageChops.lighter(ImageChops.lighter(ImageChops.difference(red, green), ImageChops.difference(red, blue)),
+                                    ImageChops.difference(green, blue))
+        color_pixels += sum(chroma.histogram()[color_tolerance + 1:])
+        if color_pixels > max_color_pixels:
+            return False
     #
     return True
 
 
-def do_check_img_colors_size(param_image_file):
+def do_check_img_blank_size(param_image_file, param_blank_threshold):
     """
-    Inspired in code provided by Raffael:
-    https://stackoverflow.com/questions/14041562/python-pil-detect-if-an-image-is-completely-black-or-white
-    Check if image is single color
+    Check if image is blank: no more than 'param_blank_threshold' percent of pixels (ink) far from background color.
+    Image is checked in reduced size (JPEG draft mode is much faster than full decoding). With a threshold, page borders are
+    ignored, so JPEG noise, dust and scanner edges don't count as ink. With threshold 0, only images of one color are blank.
+    Image size comes from header only.
     """
-    im = Image.open(param_image_file)
-    colors = im.getcolors()
-    width, height = im.size
-    return colors, (width, height)
+    with Image.open(param_image_file) as image_file:
+        width, height = image_file.size
+        image_file.draft('L', (width // 4, height // 4))
+        im = image_file.convert('L')
+    if max(im.size) > 1024:
+        im.thumbnail((1024, 1024))
+    ink_tolerance = 0
+    if param_blank_threshold > 0:
+        ink_tolerance = 48
+        margin_width, margin_height = im.size[0] // 50, im.size[1] // 50
+        im = im.crop((margin_width, margin_height, im.size[0] - margin_width, im.size[1] - margin_height))
+    histogram = im.histogram()
+    total_pixels = sum(histogram)
+    if total_pixels == 0:
+        return True, (width, height)
+    # Background is the median level
+    pixels_counted = 0
+    background = 0
+    for background, pixels_at_level in enumerate(histogram):
+        pixels_counted += pixels_at_level
+        if pixels_counted * 2 >= total_pixels:
+            break
+    ink_pixels = sum(pixels_at_level for level, pixels_at_level in enumerate(histogram) if abs(level - background) > ink_tolerance)
+    return (ink_pixels * 100.0 / total_pixels) <= param_blank_threshold, (width, height)
 
 
 def do_create_blank_pdf(param_filename_pdf, param_dimensions, param_image_resolution):
@@ -264,6 +727,591 @@ def do_create_blank_pdf(param_filename_pdf, param_dimensions, param_image_resolu
         f.close()
 
 
+def get_page_size_pt(param_page):
+    """Size (pt) of a PDF page as it is shown (and rasterized): width and height are swapped for pages rotated by 90 or 270 degrees"""
+    width_pt, height_pt = float(param_page.mediabox.width), float(param_page.mediabox.height)
+    if (param_page.get("/Rotate") or 0) % 180 != 0:
+        width_pt, height_pt = height_pt, width_pt
+    return width_pt, height_pt
+
+
+def do_create_empty_page_pdf(param_filename_pdf, param_width_pt, param_height_pt):
+    """Create the empty OCR text layer of a page not rasterized (page already has native text or is not selected for OCR)"""
+    text_page_output_pdf = PyPDF2.PdfWriter()
+    text_page_output_pdf.addBlankPage(param_width_pt, param_height_pt)
+    with open(param_filename_pdf, 'wb') as f:
+        text_page_output_pdf.write(f)
+
+
+def do_assemble_pdf(param_image_pages, param_text_pdf_files, param_rotation_angles, param_metadata, param_result_pdf_file,
+                    param_image_rotation_angles=None):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Build PDF in a single write. Image pages (tuples of PDF file and page index, from input file or rebuilt pages) are merged
+    with OCR text PDF files (one page each, 'None' keeps image pages as they are), rotated by autorotate angles (per page,
+    'None' to skip) and metadata is set (if not 'None').
+    Image rotation angles (per page, 'None' to skip) rotate image pages before merge, for pages OCR'ed after rotation.
+    """
+    output_pdf = PyPDF2.PdfWriter()
+    with contextlib.ExitStack() as image_files:
+        image_pdfs = dict()
+        for page_index, (image_pdf_file, image_page_index) in enumerate(param_image_pages):
+            if image_pdf_file not in image_pdfs:
+                image_pdfs[image_pdf_file] = PyPDF2.PdfReader(image_files.enter_context(open(image_pdf_file, 'rb')), strict=False)
+            image_page = image_pdfs[image_pdf_file].pages[image_page_index]
+            if param_image_rotation_angles is not None and param_image_rotation_angles[page_index] != 0:
+                image_page.rotate_clockwise(param_image_rotation_angles[page_index])
+            if param_text_pdf_files is not None:
+                # Text PDF files are small (one page from OCR), so they are read into memory
+                text_page = PyPDF2.PdfReader(param_text_pdf_files[page_index], strict=False).pages[0]
+                result_page = merge_ocr_page(output_pdf, image_page, text_page)
+            else:
+                output_pdf.add_page(image_page)
+                result_page = image_page
+            if param_rotation_angles is not None and param_rotation_angles[page_index] != 0:
+                result_page.rotate_clockwise(param_rotation_angles[page_index])
+        if param_metadata is not None:
+            output_pdf.add_metadata(param_metadata)
+        #
+        with open(param_result_pdf_file, 'wb') as f:
+            output_pdf.write(f)
+
+
+def do_join_pdf_files(param_pdf_files, param_metadata, param_result_pdf_file):
+    """
+    Join PDF files, writing each object to result file as soon as it is read. Only one input file is kept in memory at a time,
+    so memory does not grow with the number of pages (only the position of each object is kept, for the cross-reference table).
+    """
+    pages_ref, catalog_ref, info_ref = [PyPDF2.generic.IndirectObject(idnum, 0, None) for idnum in [1, 2, 3]]
+    object_offsets = [None, None, None, None]  # Object 0 is not used
+    page_refs = []
+    with open(param_result_pdf_file, 'wb') as f:
+        f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+        def write_object(object_ref, pdf_object):
+            object_offsets[object_ref.idnum] = f.tell()
+            f.write("{0} 0 obj\n".format(object_ref.idnum).encode("latin-1"))
+            pdf_object.write_to_stream(f, None)
+            f.write(b"\nendobj\n")
+
+        for pdf_file in param_pdf_files:
+            pdf_reader = PyPDF2.PdfReader(pdf_file, strict=False)
+            # Objects of this file (id and generation) -> objects in result file. Pending objects are written after each page
+            object_refs = dict()
+            pending_objects = collections.deque()
+            for page in pdf_reader.pages:
+                page_refs.append(copy_pdf_object(page.indirectRef, object_refs, pending_objects, object_offsets, pages_ref))
+                if len(pending_objects) > 0:
+                    pending_objects[0] = (page_refs[-1], page)  # Page has inherited attributes (e.g. '/MediaBox') of page tree
+                while len(pending_objects) > 0:
+                    object_ref, source_object = pending_objects.popleft()
+                    write_object(object_ref, copy_pdf_object(source_object.get_object(), object_refs, pending_objects,
+                                                             object_offsets, pages_ref))
+        #
+        write_object(pages_ref, PyPDF2.generic.DictionaryObject({
+            PyPDF2.generic.NameObject("/Type"): PyPDF2.generic.NameObject("/Pages"),
+            PyPDF2.generic.NameObject("/Kids"): PyPDF2.generic.ArrayObject(page_refs),
+            PyPDF2.generic.NameObject("/Count"): PyPDF2.generic.NumberObject(len(page_refs))}))
+        write_object(catalog_ref, PyPDF2.generic.DictionaryObject({
+            PyPDF2.generic.NameObject("/Type"): PyPDF2.generic.NameObject("/Catalog"),
+            PyPDF2.generic.NameObject("/Pages"): pages_ref}))
+        info = PyPDF2.generic.DictionaryObject()
+        if param_metadata is not None:
+            for key, value in param_metadata.items():
+                info[PyPDF2.generic.NameObject(key)] = PyPDF2.generic.createStringObject(value)
+        write_object(info_ref, info)
+        #
+        xref_offset = f.tell()
+        f.write("xref\n0 {0}\n0000000000 65535 f \n".format(len(object_offsets)).encode("latin-1"))
+        for object_offset in object_offsets[1:]:
+            f.write("{0:010d} 00000 n \n".format(object_offset).encode("latin-1"))
+        f.write("trailer\n<< /Size {0} /Root {1} 0 R /Info {2} 0 R >>\nstartxref\n{3}\n%%EOF\n".format(
+            len(object_offsets), catalog_ref.idnum, info_ref.idnum, xref_offset).encode("latin-1"))
+
+
+def copy_pdf_object(param_object, param_object_refs, param_pending_objects, param_object_offsets, param_pages_ref):
+    """
+    Copy of PDF object to be written in another file (by 'do_join_pdf_files'). References to objects not seen before get a
+    new object number and are added to pending objects. Pages are moved to the page tree of the new file.
+    """
+    if isinstance(param_object, PyPDF2.generic.IndirectObject):
+        object_key = (param_object.idnum, param_object.generation)
+        object_ref = param_object_refs.get(object_key)
+        if object_ref is None:
+            object_ref = PyPDF2.generic.IndirectObject(len(param_object_offsets), 0, None)
+            param_object_offsets.append(None)
+            param_object_refs[object_key] = object_ref
+            param_pending_objects.append((object_ref, param_object))
+        return object_ref
+    if isinstance(param_object, PyPDF2.generic.DictionaryObject):
+        if isinstance(param_object, PyPDF2.generic.StreamObject):
+            # Stream data is copied as it is (still encoded)
+            object_copy = PyPDF2.generic.EncodedStreamObject() if "/Filter" in param_object else PyPDF2.generic.DecodedStreamObject()
+            object_copy._data = param_object._data
+        else:
+            object_copy = PyPDF2.generic.DictionaryObject()
+        is_page = param_object.get("/Type") == "/Page"
+        for key, value in dict.items(param_object):
+            if is_page and key == "/Parent":
+                object_copy[key] = param_pages_ref
+            elif isinstance(param_object, PyPDF2.generic.StreamObject) and key == "/Length":
+                continue  # Set when stream is written
+            else:
+                object_copy[key] = copy_pdf_object(value, param_object_refs, param_pending_objects, param_object_offsets, param_pages_ref)
+        return object_copy
+    if isinstance(param_object, PyPDF2.generic.ArrayObject):
+        return PyPDF2.generic.ArrayObject(copy_pdf_object(value, param_object_refs, param_pending_objects, param_object_offsets,
+                                                          param_pages_ref) for value in param_object)
+    return param_object
+
+
+def merge_ocr_page(param_output_pdf, param_image_page, param_text_page):
+    """
+    Merge image page with OCR text page (emulate pdftk multibackground operator) and add result to output PDF.
+    Image page is embedded as a form XObject, so its content streams are copied without being parsed, decoded or compressed
+    again. Result page has text page size and image page is scaled and rotated to fit it.
+    """
+    scale_tolerance = 0.001
+    text_page_x = float(param_text_page.mediabox.upper_right[0])
+    text_page_y = float(param_text_page.mediabox.upper_right[1])
+    rotate_angle = param_image_page.get('/Rotate')
+    if rotate_angle is None:
+        rotate_angle = 0
+    rotate_angle = rotate_angle % 360
+    image_page_x = float(param_image_page.mediabox.upper_right[0])
+    image_page_y = float(param_image_page.mediabox.upper_right[1])
+    # With rotated pages (90 or 270 degress), we have to switch x and y, to avoid wrong scale operation
+    if rotate_angle == 90 or rotate_angle == 270:
+        image_page_x, image_page_y = image_page_y, image_page_x
+    image_transformation = PyPDF2.Transformation()
+    factor_x = text_page_x / image_page_x
+    factor_y = text_page_y / image_page_y
+    # Try to avoid unnecessary scale operation
+    if abs(factor_x - 1) > scale_tolerance or abs(factor_y - 1) > scale_tolerance:
+        image_transformation = image_transformation.scale(factor_x, factor_y)
+    # Tested values for translation with each rotation
+    if rotate_angle == 90:
+        image_transformation = image_transformation.translate(-image_page_y / 2, -image_page_y / 2).rotate(-90) \
+            .translate(image_page_y / 2, image_page_y / 2)
+    elif rotate_angle == 180:
+        image_transformation = image_transformation.translate(-image_page_x / 2, -image_page_y / 2).rotate(-180) \
+            .translate(image_page_x / 2, image_page_y / 2)
+    elif rotate_angle == 270:
+        image_transformation = image_transformation.translate(-image_page_x / 2, -image_page_x / 2).rotate(-270) \
+            .translate(image_page_x / 2, image_page_x / 2)
+    #
+    # Text page content (small, from OCR) is used directly. Image page is a form XObject, drawn on top
+    result_page = param_output_pdf.add_blank_page(text_page_x, text_page_y)
+    result_resources = PyPDF2.generic.DictionaryObject()
+    text_page_resources = param_text_page.get("/Resources")
+    if text_page_resources is not None:
+        result_resources.update(text_page_resources.get_object())
+    result_xobjects = PyPDF2.generic.DictionaryObject()
+    text_page_xobjects = result_resources.get("/XObject")
+    if isinstance(text_page_xobjects, PyPDF2.generic.DictionaryObject):
+        result_xobjects.update(text_page_xobjects)
+    result_xobjects[PyPDF2.generic.NameObject("/OCRImage")] = param_output_pdf._add_object(get_page_form_xobject(param_image_page))
+    result_resources[PyPDF2.generic.NameObject("/XObject")] = result_xobjects
+    result_page[PyPDF2.generic.NameObject("/Resources")] = result_resources
+    result_contents = PyPDF2.generic.ArrayObject([param_output_pdf._add_object(get_content_stream(b"q\n"))])
+    text_page_contents = param_text_page.get("/Contents")
+    if text_page_contents is not None:
+        if isinstance(text_page_contents.get_object(), PyPDF2.generic.ArrayObject):
+            result_contents.extend(text_page_contents.get_object())
+        else:
+            result_contents.append(text_page_contents)
+    result_contents.append(param_output_pdf._add_object(get_content_stream("\nQ q {0} cm /OCRImage Do Q".format(
+        " ".join("{0:.6f}".format(value) for value in image_transformation.ctm)).encode("latin-1"))))
+    result_page[PyPDF2.generic.NameObject("/Contents")] = result_contents
+    result_annots = PyPDF2.generic.ArrayObject()
+    for page in [param_text_page, param_image_page]:
+        page_annots = page.get("/Annots")
+        if page_annots is not None:
+            result_annots.extend(page_annots.get_object())
+    if len(result_annots) > 0:
+        result_page[PyPDF2.generic.NameObject("/Annots")] = result_annots
+    return result_page
+
+
+def get_content_stream(param_data):
+    content_stream = PyPDF2.generic.DecodedStreamObject()
+    content_stream.set_data(param_data)
+    return content_stream
+
+
+def get_page_form_xobject(param_page):
+    """Form XObject with page content and resources. A single content stream is reused as it is (still encoded)"""
+    page_contents = param_page.get("/Contents")
+    page_contents = page_contents.get_object() if page_contents is not None else None
+    if isinstance(page_contents, PyPDF2.generic.StreamObject):
+        page_form = PyPDF2.generic.EncodedStreamObject() if "/Filter" in page_contents else PyPDF2.generic.DecodedStreamObject()
+        page_form._data = page_contents._data
+        for stream_key in ["/Filter", "/DecodeParms"]:
+            if stream_key in page_contents:
+                page_form[PyPDF2.generic.NameObject(stream_key)] = page_contents[stream_key]
+    else:
+        # Content streams in an array are joined (a token may be split between two streams)
+        page_form = PyPDF2.generic.DecodedStreamObject()
+        if page_contents is not None:
+            page_form.set_data(b"\n".join(content.get_object().get_data() for content in page_contents))
+            page_form = page_form.flate_encode()
+    page_form[PyPDF2.generic.NameObject("/Type")] = PyPDF2.generic.NameObject("/XObject")
+    page_form[PyPDF2.generic.NameObject("/Subtype")] = PyPDF2.generic.NameObject("/Form")
+    page_form[PyPDF2.generic.NameObject("/BBox")] = param_page.mediabox
+    page_resources = param_page.get("/Resources")
+    page_form[PyPDF2.generic.NameObject("/Resources")] = page_resources if page_resources is not None else PyPDF2.generic.DictionaryObject()
+    return page_form
+
+
+def hash_pdf_object(param_object, param_hash, param_object_digests):
+    """
+    Update hash with a PDF object and all objects referenced by it, except parents in page tree.
+    Digests of indirect objects are kept in 'param_object_digests', as resources (fonts, images) are usually shared by pages.
+    """
+    if isinstance(param_object, PyPDF2.generic.IndirectObject):
+        object_key = (param_object.idnum, param_object.generation)
+        object_digest = param_object_digests.get(object_key)
+        if object_digest is None:
+            param_object_digests[object_key] = b"cycle"  # Objects can refer to themselves (e.g. annotations)
+            object_hash = hashlib.sha256()
+            hash_pdf_object(param_object.get_object(), object_hash, param_object_digests)
+            object_digest = object_hash.digest()
+            param_object_digests[object_key] = object_digest
+        param_hash.update(b"R" + object_digest)
+    elif isinstance(param_object, PyPDF2.generic.DictionaryObject):
+        param_hash.update(b"<<")
+        for key in sorted(param_object.keys()):
+            if key != "/Parent":
+                param_hash.update(key.encode("utf-8"))
+                hash_pdf_object(param_object.raw_get(key), param_hash, param_object_digests)
+        param_hash.update(b">>")
+        if isinstance(param_object, PyPDF2.generic.StreamObject):
+            param_hash.update(param_object._data)
+    elif isinstance(param_object, PyPDF2.generic.ArrayObject):
+        param_hash.update(b"[")
+        for item in param_object:
+            hash_pdf_object(item, param_hash, param_object_digests)
+        param_hash.update(b"]")
+    else:
+        param_hash.update("{0}:{1};".format(type(param_object).__name__, param_object).encode("utf-8", errors="replace"))
+
+
+def do_process_pages(param_image_files, param_settings, param_raster_cache_keys=None, param_raster_cached=None, param_raster_again=False):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Run all page stages (blank check, autorotate info, deskew, OCR and rebuild) for a chunk of images, so each page can go
+    through the whole pipeline as soon as it is rasterized. Tesseract OCR of all pages in chunk is done by only one process.
+    With cache, image is copied from cache ('param_raster_cached') or stored in cache before any change (e.g. deskew).
+    With page timeout, pages not rasterized in time are rasterized again in lower resolution (here, for images in memory, or
+    when 'param_raster_again' is set for pages of a pdftoppm range killed after timeout, after one more try in full resolution).
+    Return one result per image.
+    """
+    if param_raster_cache_keys is None:
+        param_raster_cache_keys = [None] * len(param_image_files)
+    if param_raster_cached is None:
+        param_raster_cached = [False] * len(param_image_files)
+    page_timeout = param_settings["page_timeout"]
+    degraded_resolution = param_settings["degraded_resolution"]
+    # Image file -> page stages degraded by page timeout
+    degraded_notes = {image_file: [] for image_file in param_image_files}
+    raster_fds = []
+    try:
+        if param_settings["raster_in_memory"]:
+            for image_file in param_image_files:
+                page_number = int(os.path.splitext(image_file)[0][-9:])
+                raster_fd = do_pdftoimage_memory(param_settings["path_pdftoppm"], page_number, param_settings["input_file_for_images"],
+                                                 param_settings["image_resolution"], image_file, param_settings["tmp_dir"],
+                                                 param_settings["shell_mode"], page_timeout)
+                if raster_fd is None:
+                    raster_fd = do_pdftoimage_memory(param_settings["path_pdftoppm"], page_number, param_settings["input_file_for_images"],
+                                                     degraded_resolution, image_file, param_settings["tmp_dir"],
+                                                     param_settings["shell_mode"], page_timeout)
+                    if raster_fd is not None:
+                        do_scale_image(image_file, degraded_resolution, param_settings["image_resolution"])
+                        degraded_notes[image_file].append("rasterized in {0} DPI".format(degraded_resolution))
+                raster_fds.append(raster_fd)
+        elif param_raster_again:
+            for image_file in param_image_files:
+                page_number = int(os.path.splitext(image_file)[0][-9:])
+                # Page is rasterized alone in full resolution, as the range may be slow only because of other pages. Lower
+                # resolution is used only when the page itself is too slow
+                return_code, _ = do_pdftoimage(param_settings["path_pdftoppm"], (page_number, page_number),
+                                               param_settings["input_file_for_images"], param_settings["image_resolution"],
+                                               param_settings["tmp_dir"], param_settings["prefix"], param_settings["shell_mode"], page_timeout)
+                if return_code is not None:
+                    continue
+                return_code, _ = do_pdftoimage(param_settings["path_pdftoppm"], (page_number, page_number),
+                                               param_settings["input_file_for_images"], degraded_resolution, param_settings["tmp_dir"],
+                                               param_settings["prefix"], param_settings["shell_mode"], page_timeout)
+                if return_code == 0:
+                    do_scale_image(image_file, degraded_resolution, param_settings["image_resolution"])
+                    degraded_notes[image_file].append("rasterized in {0} DPI".format(degraded_resolution))
+        return do_process_images(param_image_files, param_settings, param_raster_cache_keys, param_raster_cached, degraded_notes)
+    finally:
+        # Memory used by images is released as soon as pages are processed
+        for image_file, raster_fd in zip(param_image_files, raster_fds):
+            if raster_fd is not None:
+                os.remove(image_file)
+                os.close(raster_fd)
+
+
+def do_process_images(param_image_files, param_settings, param_raster_cache_keys, param_raster_cached, param_degraded_notes):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Page stages for images already rasterized (see 'do_process_pages').
+    """
+    results = []
+    for image_file, raster_cache_key, raster_cached in zip(param_image_files, param_raster_cache_keys, param_raster_cached):
+        if os.path.exists(image_file):
+            results.append(do_prepare_page(image_file, param_settings, raster_cache_key, raster_cached))
+        else:
+            results.append(do_prepare_page_without_image(image_file, param_settings))
+        results[-1]["degraded"] = param_degraded_notes[image_file] + results[-1]["degraded"]
+    #
+    ocr_images = [result["image_file"] for result in results if result["ocr_needed"]]
+    ocr_timeout_images = []
+    if len(ocr_images) > 0:
+        if param_settings["ocr_engine"] == "cuneiform":
+            for image_file in ocr_images:
+                do_ocr_cuneiform(image_file, param_settings["extra_ocr_flag"], param_settings["tess_langs"], param_settings["tmp_dir"],
+                                 param_settings["shell_mode"], param_settings["path_cuneiform"], param_settings["text_per_line"])
+        elif param_settings["ocr_engine"] == "tesseract" and param_settings["adaptive_confidence"] is not None:
+            ocr_timeout_images = do_adaptive_ocr_tesseract(ocr_images, results, param_settings)
+        elif param_settings["ocr_engine"] == "tesseract":
+            ocr_timeout_images = do_ocr_tesseract_batch(ocr_images, param_settings["extra_ocr_flag"], param_settings["tess_langs"],
+                                                        param_settings["tess_psm"], param_settings["tmp_dir"], param_settings["shell_mode"],
+                                                        param_settings["path_tesseract"], param_settings["text_generation_strategy"],
+                                                        param_settings["delete_temps"], param_settings["tesseract_can_textonly_pdf"],
+                                                        param_settings["text_per_line"], 300, param_settings["page_timeout"])
+    # Pages not OCR'ed in time are OCR'ed again with a simpler page segmentation mode, or get an empty text layer
+    results_by_image = {result["image_file"]: result for result in results}
+    for image_file in ocr_timeout_images:
+        if do_ocr_tesseract(image_file, param_settings["extra_ocr_flag"], param_settings["tess_langs"], param_settings["degraded_tess_psm"],
+                            param_settings["tmp_dir"], param_settings["shell_mode"], param_settings["path_tesseract"],
+                            param_settings["text_generation_strategy"], param_settings["delete_temps"],
+                            param_settings["tesseract_can_textonly_pdf"], param_settings["text_per_line"], 300, param_settings["page_timeout"]):
+            results_by_image[image_file]["degraded"].append("OCR with psm {0}".format(param_settings["degraded_tess_psm"]))
+        else:
+            results_by_image[image_file]["empty_text"] = True
+            results_by_image[image_file]["degraded"].append("not OCR'ed, without text")
+    #
+    for result in results:
+        do_finish_page(result, param_settings)
+    return results
+
+
+def do_adaptive_ocr_tesseract(param_image_files, param_results, param_settings):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Adaptive OCR: all images are OCR'ed with a cheap first pass (images in lower resolution and/or other tesseract flags). Images
+    with mean word confidence below the threshold are rasterized again in full resolution and OCR'ed again with normal settings.
+    Confidence and OCR time of each page are saved in its result. Return images not OCR'ed in time (see 'do_ocr_tesseract_batch').
+    """
+    results_by_image = {result["image_file"]: result for result in param_results}
+    # Text of first pass has the same size it would have in full resolution
+    first_pass_hocr_resolution = 300 * param_settings["image_resolution"] / param_settings["full_image_resolution"]
+    start_time = time.perf_counter()
+    first_pass_timeout_images = do_ocr_tesseract_batch(param_image_files, param_settings["adaptive_ocr_flag"], param_settings["tess_langs"],
+                                                       param_settings["tess_psm"], param_settings["tmp_dir"], param_settings["shell_mode"],
+                                                       param_settings["path_tesseract"], param_settings["text_generation_strategy"],
+                                                       param_settings["delete_temps"], param_settings["tesseract_can_textonly_pdf"],
+                                                       param_settings["text_per_line"], first_pass_hocr_resolution,
+                                                       param_settings["page_timeout"])
+    first_pass_seconds = (time.perf_counter() - start_time) / len(param_image_files)
+    escalated_images = []
+    for image_file in param_image_files:
+        confidence = get_hocr_confidence(os.path.splitext(image_file)[0] + ".hocr")
+        results_by_image[image_file]["adaptive"] = {"confidence": confidence, "escalated": False, "first_pass_seconds": first_pass_seconds,
+                                                    "full_pass_seconds": 0.0}
+        # Pages without words are not escalated (pages without text are found by blank check)
+        if image_file in first_pass_timeout_images or (confidence is not None and confidence < param_settings["adaptive_confidence"]):
+            escalated_images.append(image_file)
+    if len(escalated_images) == 0:
+        return []
+    #
+    start_time = time.perf_counter()
+    if param_settings["image_resolution"] != param_settings["full_image_resolution"]:
+        for image_file in list(escalated_images):
+            if not do_pdftoimage_again(image_file, param_settings["full_image_resolution"], param_settings):
+                # Page keeps the text of first pass (if any), as it can't be OCR'ed in full resolution
+                escalated_images.remove(image_file)
+                results_by_image[image_file]["degraded"].append("not rasterized again in {0} DPI".format(param_settings["full_image_resolution"]))
+                if image_file in first_pass_timeout_images:
+                    results_by_image[image_file]["empty_text"] = True
+                    results_by_image[image_file]["degraded"].append("not OCR'ed, without text")
+                continue
+            if results_by_image[image_file]["rotated_before_ocr"] != 0:
+                do_rotate_image(image_file, results_by_image[image_file]["rotated_before_ocr"])
+            if param_settings["use_deskew_mode"]:
+                if not do_deskew(image_file, param_settings["deskew_threshold"], param_settings["shell_mode"], param_settings["path_mogrify"],
+                                 param_settings["page_timeout"]):
+                    results_by_image[image_file]["degraded"].append("not deskewed")
+            elif results_by_image[image_file]["deskew_angle"] != 0:
+                do_deskew_image(image_file, results_by_image[image_file]["deskew_angle"])
+    if len(escalated_images) == 0:
+        return []
+    full_pass_timeout_images = do_ocr_tesseract_batch(escalated_images, param_settings["extra_ocr_flag"], param_settings["tess_langs"],
+                                                      param_settings["tess_psm"], param_settings["tmp_dir"], param_settings["shell_mode"],
+                                                      param_settings["path_tesseract"], param_settings["text_generation_strategy"],
+                                                      param_settings["delete_temps"], param_settings["tesseract_can_textonly_pdf"],
+                                                      param_settings["text_per_line"], 300, param_settings["page_timeout"])
+    full_pass_seconds = (time.perf_counter() - start_time) / len(escalated_images)
+    for image_file in escalated_images:
+        results_by_image[image_file]["adaptive"].update(escalated=True, full_pass_seconds=full_pass_seconds)
+    return full_pass_timeout_images
+
+
+def new_page_result(param_image_file):
+    """Result of page stages, sent back to main process (see 'do_process_pages')"""
+    return {"image_file": param_image_file, "blank": False, "dimensions": None, "greyscale": None, "cache": {"raster": None, "ocr": None},
+            "ocr_needed": False, "ocr_cache_key": None, "selected": True, "adaptive": None, "rotated_before_ocr": 0, "deskew_angle": 0,
+            "empty_text": False, "degraded": []}
+
+
+def do_prepare_page_without_image(param_image_file, param_settings):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Page not rasterized in time (see 'do_process_pages') gets an empty text layer with the size of PDF page.
+    """
+    page_number = int(os.path.splitext(param_image_file)[0][-9:])
+    if param_settings["rebuild_pdf_from_images"]:
+        raise Pdf2PdfOcrException("Fail to create image of page {0} from PDF in {1} seconds".format(page_number, param_settings["page_timeout"]))
+    result = new_page_result(param_image_file)
+    with open(param_settings["input_file_for_images"], 'rb') as f:
+        width_pt, height_pt = get_page_size_pt(PyPDF2.PdfReader(f, strict=False).pages[page_number - 1])
+    result["dimensions"] = (round(width_pt * param_settings["image_resolution"] / 72.0), round(height_pt * param_settings["image_resolution"] / 72.0))
+    result["empty_text"] = True
+    result["degraded"].append("not rasterized, without text")
+    return result
+
+
+def do_prepare_page(param_image_file, param_settings, param_raster_cache_key, param_raster_cached):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Page stages before OCR (raster cache, blank check, autorotate info, deskew and OCR cache)
+    """
+    result = new_page_result(param_image_file)
+    ocr_engine = param_settings["ocr_engine"]
+    tmp_dir = param_settings["tmp_dir"]
+    shell_mode = param_settings["shell_mode"]
+    cache = param_settings["cache"]
+    image_file_base = os.path.splitext(param_image_file)[0]
+    image_ext = os.path.splitext(param_image_file)[1]
+    if param_raster_cache_key is not None:
+        if param_raster_cached and cache.get(param_raster_cache_key, image_file_base):
+            result["cache"]["raster"] = "hit"
+        else:
+            if param_raster_cached:
+                # Entry removed after cache was checked. Page is rasterized here
+                page_number = int(image_file_base[-9:])
+                do_pdftoimage(param_settings["path_pdftoppm"], (page_number, page_number), param_settings["input_file_for_images"],
+                              param_settings["image_resolution"], tmp_dir, param_settings["prefix"], shell_mode)
+            cache.put(param_raster_cache_key, image_file_base, [image_ext])
+            result["cache"]["raster"] = "miss"
+    #
+    pages_selection = param_settings["pages_selection"]
+    page_number = int(image_file_base[-9:])
+    if pages_selection is not None and \
+            not any(first <= page_number and (last is None or page_number <= last) for first, last in pages_selection):
+        # Page is rasterized only to rebuild the PDF. It's kept unchanged, without OCR
+        result["selected"] = False
+        with Image.open(param_image_file) as im:
+            result["dimensions"] = im.size
+        return result
+    result["blank"], result["dimensions"] = do_check_img_blank_size(param_image_file, param_settings["blank_threshold"])
+    if not result["blank"]:
+        if param_settings["use_autorotate"] and not param_settings["autorotate_from_hocr"]:
+            do_autorotate_info(param_image_file, param_settings)
+            if param_settings["rotate_before_ocr"]:
+                # OCR sees upright text. Image page is rotated when merged with text (see 'Pdf2PdfOcr.get_rotation_angles')
+                result["rotated_before_ocr"] = get_osd_rotation(tmp_dir + os.path.basename(image_file_base) + ".osd")
+                if result["rotated_before_ocr"] != 0:
+                    do_rotate_image(param_image_file, result["rotated_before_ocr"])
+        if param_settings["use_deskew_mode"]:
+            if not do_deskew(param_image_file, param_settings["deskew_threshold"], shell_mode, param_settings["path_mogrify"],
+                             param_settings["page_timeout"]):
+                result["degraded"].append("not deskewed")
+        elif param_settings["deskew_min_angle"] is not None:
+            skew_angle = get_skew_angle(param_image_file, param_settings["deskew_max_angle"])
+            if skew_angle != 0 and abs(skew_angle) >= param_settings["deskew_min_angle"]:
+                do_deskew_image(param_image_file, skew_angle)
+                result["deskew_angle"] = skew_angle
+        if cache is not None and ocr_engine in ["cuneiform", "tesseract"]:
+            result["ocr_cache_key"] = Pdf2PdfOcrCache.make_key("ocr", Pdf2PdfOcrCache.hash_file(param_image_file),
+                                                               *param_settings["ocr_cache_key"])
+        if result["ocr_cache_key"] is not None and cache.get(result["ocr_cache_key"], image_file_base):
+            result["cache"]["ocr"] = "hit"
+        else:
+            result["ocr_needed"] = ocr_engine in ["cuneiform", "tesseract"]
+    return result
+
+
+def do_finish_page(param_result, param_settings):
+    """
+    Will be called from multiprocessing, so no global variables are allowed.
+    Page stages after OCR (OCR cache, blank page PDF, greyscale check and rebuild)
+    """
+    image_file = param_result["image_file"]
+    image_file_base = os.path.splitext(image_file)[0]
+    if param_result["ocr_needed"] and param_result["ocr_cache_key"] is not None:
+        # OCR degraded by page timeout is not cached
+        if os.path.isfile(image_file_base + ".pdf") and len(param_result["degraded"]) == 0:
+            param_settings["cache"].put(param_result["ocr_cache_key"], image_file_base, [".pdf", ".txt", ".hocr"])
+        param_result["cache"]["ocr"] = "miss"
+    # OCR text of deskewed image is rotated back to the original page (cached OCR is kept as read from deskewed image)
+    if param_result["deskew_angle"] != 0 and param_settings["deskew_text_back"] and os.path.isfile(image_file_base + ".pdf"):
+        do_rotate_text_pdf(image_file_base + ".pdf", -param_result["deskew_angle"])
+    if param_settings["use_autorotate"] and param_settings["autorotate_from_hocr"] and param_result["selected"] and not param_result["blank"] \
+            and not param_result["empty_text"]:
+        do_autorotate_info_from_hocr(image_file, param_settings)
+    if (param_result["blank"] or not param_result["selected"] or param_result["empty_text"]) and \
+            param_settings["ocr_engine"] in ["cuneiform", "tesseract"]:
+        do_create_blank_pdf(image_file_base + ".pdf", param_result["dimensions"], param_settings["image_resolution"])
+    if param_result["empty_text"]:
+        Pdf2PdfOcr.best_effort_remove(image_file_base + ".txt")
+    #
+    if param_settings["check_greyscale"]:
+        param_result["greyscale"] = do_check_img_greyscale(image_file)
+    # Convert params are only known here when rebuilding without "smart" preset (smart needs all pages checked first)
+    convert_params = param_settings["convert_params"]
+    if param_settings["page_convert_params"] is not None:
+        convert_params = param_settings["page_convert_params"][param_result["greyscale"]]
+    if convert_params is not None:
+        rebuild_note = do_rebuild(image_file, param_settings["path_convert"], convert_params, param_settings["tmp_dir"],
+                                  param_settings["shell_mode"], param_settings["page_timeout"], param_settings["degraded_convert_params"])
+        if rebuild_note is not None:
+            param_result["degraded"].append(rebuild_note)
+    #
+    if param_settings["delete_temps"]:
+        # Free temp space as soon as possible. Only files used to build final output (PDF, text and OSD) are kept
+        image_no_ext = os.path.basename(image_file_base)
+        page_temp_files = [image_file_base + ".hocr"] + [param_settings["tmp_dir"] + log_name.format(image_no_ext) for log_name in
+                                                         ["tess_err_{0}.log", "autorot_tess_out_{0}.log", "autorot_tess_err_{0}.log",
+                                                          "convert_log_{0}.log", "convert_err_{0}.log", "cuneif_out_{0}.log",
+                                                          "cuneif_err_{0}.log", "cuneif_out_eng_{0}.log", "cuneif_err_eng_{0}.log"]]
+        # Smart preset rebuilds PDF from images after all pages are checked. Images in memory are released by 'do_process_pages'
+        if (convert_params is not None or not param_settings["check_greyscale"]) and not param_settings["raster_in_memory"]:
+            page_temp_files.append(image_file)
+        for page_temp_file in page_temp_files:
+            Pdf2PdfOcr.best_effort_remove(page_temp_file)
+
+
+def page_selection(x):
+    """Page ranges (e.g. "1-10,250-300", "5" or "20-" until the last page) as a list of (first, last) tuples, last may be None"""
+    result = []
+    try:
+        for page_range in x.split(","):
+            first, separator, last = page_range.strip().partition("-")
+            first = int(first)
+            last = (int(last) if last.strip() != "" else None) if separator != "" else first
+            if first < 1 or (last is not None and last < first):
+                raise ValueError
+            result.append((first, last))
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a valid page selection (e.g. 1-10,250-300)" % (x,))
+    return result
+
+
 def percentual_float(x):
     x = float(x)
     if x <= 0.0 or x > 1.0:
@@ -271,6 +1319,93 @@ def percentual_float(x):
     return x
 
 
+class Pdf2PdfOcrCache:
+    """
+    Persistent content addressed cache for rasterized pages and OCR results.
+    Each entry is a directory with one file per suffix (e.g. ".jpg" for images, ".pdf", ".txt" and ".hocr" for OCR).
+    When cache is bigger than its maximum size, least recently used entries are removed.
+    Will be sent to multiprocessing, so only simple attributes are allowed.
+    """
+
+    def __init__(self, cache_dir, max_size_mb):
+        self.cache_dir = os.path.abspath(cache_dir) + os.path.sep
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*key_parts):
+        return hashlib.sha256("\0".join(str(key_part) for key_part in key_parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def hash_file(file_name):
+        file_hash = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    def get_entry_dir(self, key):
+        return self.cache_dir + key[:2] + os.path.sep + key + os.path.sep
+
+    def contains(self, key):
+        return os.path.isdir(self.get_entry_dir(key))
+
+    def get(self, key, dest_file_base):
+        """Copy entry files to 'dest_file_base + suffix'. Return False if key is not in cache"""
+        entry_dir = self.get_entry_dir(key)
+        try:
+            for entry_file in os.listdir(entry_dir):
+                shutil.copyfile(entry_dir + entry_file, dest_file_base + entry_file[len("entry"):])
+            os.utime(entry_dir)  # Entry modification time is used as "last use" time
+            return True
+        except OSError:
+            return False
+
+    def put(self, key, src_file_base, suffixes):
+        """Store files 'src_file_base + suffix' (only existing ones) as a new entry"""
+        entry_dir = self.get_entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+        tmp_entry_dir = None
+        try:
+            os.makedirs(self.cache_dir + "tmp", exist_ok=True)
+            tmp_entry_dir = tempfile.mkdtemp(dir=self.cache_dir + "tmp") + os.path.sep
+            for suffix in suffixes:
+                if os.path.isfile(src_file_base + suffix):
+                    shutil.copyfile(src_file_base + suffix, tmp_entry_dir + "entry" + suffix)
+            os.makedirs(self.cache_dir + key[:2], exist_ok=True)
+            # Entry is complete before it's visible to other processes
+            os.rename(tmp_entry_dir, entry_dir)
+        except OSError:
+            # Same entry created by other process or cache not writable. Cache is best effort only
+            if tmp_entry_dir is not None:
+                shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+
+    def evict(self):
+        """Remove least recently used entries until cache size is lower than its maximum. Return number of removed entries"""
+        entries = []
+        cache_size = 0
+        for key_prefix_dir in os.scandir(self.cache_dir):
+            if not key_prefix_dir.is_dir() or len(key_prefix_dir.name) != 2:
+                continue
+            for entry_dir in os.scandir(key_prefix_dir.path):
+                try:
+                    entry_size = sum(entry_file.stat().st_size for entry_file in os.scandir(entry_dir.path))
+                    entries.append((entry_dir.stat().st_mtime, entry_size, entry_dir.path))
+                    cache_size += entry_size
+                except OSError:
+                    pass  # Removed by other process
+        entries.sort()
+        removed_entries = 0
+        for entry_mtime, entry_size, entry_dir in entries:
+            if cache_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            cache_size -= entry_size
+            removed_entries += 1
+        return removed_entries
+
+
 class HocrTransformError(Exception):
     pass
 
@@ -282,76 +1417,82 @@ class HocrTransform:
     http://docs.google.com/View?docid=dfxcv4vc_67g844kf
 
     Adapted from https://github.com/jbarlow83/OCRmyPDF/blob/master/ocrmypdf/hocrtransform.py
+    hOCR file is read in one streaming pass, keeping only text and coordinates (in pt) of each page.
     """
 
+    rect = namedtuple('Rect', ['x1', 'y1', 'x2', 'y2'])
+    page = namedtuple('Page', ['width', 'height', 'paragraphs', 'lines'])
+    line = namedtuple('Line', ['coords', 'text', 'words'])
+    word = namedtuple('Word', ['coords', 'text'])
+    box_pattern = re.compile(r'bbox((\s+\d+){4})')
+    line_classes = {"ocr_line", "ocr_header", "ocr_caption", "ocr_textfloat"}
+    # Width of each glyph (for font size 1000) by font name, as measuring text is the slowest part of PDF creation
+    glyph_widths = {}
+
     def __init__(self, hocr_file_name, dpi):
-        self.rect = namedtuple('Rect', ['x1', 'y1', 'x2', 'y2'])
+        from reportlab.lib.units import inch
         self.dpi = dpi
-        self.boxPattern = re.compile(r'bbox((\s+\d+){4})')
-        self.hocr = ElementTree.parse(hocr_file_name)
-        # if the hOCR file has a namespace, ElementTree requires its use to
-        # find elements
-        matches = re.match(r'({.*})html', self.hocr.getroot().tag)
-        self.xmlns = ''
-        if matches:
-            self.xmlns = matches.group(1)
-        # get dimension in pt (not pixel!!!!) of the OCRed image
-        self.width, self.height = None, None
-        for div in self.hocr.findall(
-                ".//%sdiv[@class='ocr_page']" % self.xmlns):
-            coords = self.element_coordinates(div)
-            pt_coords = self.pt_from_pixel(coords)
-            self.width = pt_coords.x2 - pt_coords.x1
-            self.height = pt_coords.y2 - pt_coords.y1
-            # there shouldn't be more than one, and if there is, we don't want it
-            break
-        if self.width is None or self.height is None:
+        self.pt_per_pixel = inch / dpi
+        self.pages = []
+        self._parse(hocr_file_name)
+        # get dimension in pt (not pixel!!!!) of the first OCRed image
+        if len(self.pages) == 0:
             raise HocrTransformError("hocr file is missing page dimensions")
+        self.width, self.height = self.pages[0].width, self.pages[0].height
 
     def __str__(self):
         """
-        Return the textual content of the HTML body
-        """
-        if self.hocr is None:
-            return ''
-        body = self.hocr.find(".//%sbody" % self.xmlns)
-        if body:
-            return self._get_element_text(body)
-        else:
-            return ''
-
-    def _get_element_text(self, element):
+        Return the textual content of the hOCR file, one line of text per line
         """
-        Return the textual content of the element and its children
-        """
-        text = ''
-        if element.text is not None:
-            text += element.text
-        for child in element:
-            text += self._get_element_text(child)
-        if element.tail is not None:
-            text += element.tail
-        return text
+        return "\n".join(line.text for page in self.pages for line in page.lines)
+
+    def _parse(self, hocr_file_name):
+        paragraphs, lines, words = [], [], []
+        for event, element in ElementTree.iterparse(hocr_file_name):
+            element_class = element.get('class')
+            if element_class == "ocrx_word":
+                word_text = self.replace_unsupported_chars("".join(element.itertext()).rstrip())
+                if len(word_text) > 0:
+                    words.append(self.word(self.element_coordinates(element), word_text))
+            elif element_class in self.line_classes:
+                if len(words) > 0:
+                    line_text = " ".join(word.text for word in words)
+                else:
+                    line_text = self.replace_unsupported_chars("".join(element.itertext()).strip())
+                if len(line_text) > 0:
+                    lines.append(self.line(self.element_coordinates(element), line_text, words))
+                words = []
+                element.clear()
+            elif element_class == "ocr_par":
+                paragraphs.append(self.element_coordinates(element))
+            elif element_class == "ocr_page":
+                # Words outside lines are lines by themselves
+                lines.extend(self.line(word.coords, word.text, [word]) for word in words)
+                page_coords = self.element_coordinates(element)
+                self.pages.append(self.page(page_coords.x2 - page_coords.x1, page_coords.y2 - page_coords.y1, paragraphs, lines))
+                paragraphs, lines, words = [], [], []
+                element.clear()
 
     def element_coordinates(self, element):
         """
-        Returns a tuple containing the coordinates of the bounding box around
+        Returns a tuple containing the coordinates (in pt) of the bounding box around
         an element
         """
-        out = (0, 0, 0, 0)
-        if 'title' in element.attrib:
-            matches = self.boxPattern.search(element.attrib['title'])
+        title = element.get('title')
+        if title is not None:
+            matches = self.box_pattern.search(title)
             if matches:
-                coords = matches.group(1).split()
-                out = self.rect._make(int(coords[n]) for n in range(4))
-        return out
+                x1, y1, x2, y2 = matches.group(1).split()
+                pt_per_pixel = self.pt_per_pixel
+                return self.rect(int(x1) * pt_per_pixel, int(y1) * pt_per_pixel, int(x2) * pt_per_pixel, int(y2) * pt_per_pixel)
+        return self.rect(0, 0, 0, 0)
 
     def pt_from_pixel(self, pxl):
         """
         Returns the quantity in PDF units (pt) given quantity in pixels
         """
         return self.rect._make(
-            (c / self.dpi * inch) for c in pxl)
+            (c * self.pt_per_pixel) for c in pxl)
 
     def replace_unsupported_chars(self, s):
         """
@@ -365,75 +1506,81 @@ class HocrTransform:
         s = s.replace(u"ﬁ", "fi")
         return s
 
+    @classmethod
+    def string_width(cls, text, fontname, fontsize):
+        """
+        Returns the width of text (same value as 'stringWidth' from reportlab), using cached glyph widths
+        """
+        font_glyph_widths = cls.glyph_widths.setdefault(fontname, {})
+        width = 0
+        for char in text:
+            char_width = font_glyph_widths.get(char)
+            if char_width is None:
+                char_width = font_glyph_widths[char] = pdfmetrics.stringWidth(char, fontname, 1000)
+            width += char_width
+        return width * fontsize / 1000
+
     def to_pdf(self, out_file_name, image_file_name=None, show_bounding_boxes=False, fontname="Helvetica",
-               invisible_text=True):
+               invisible_text=True, pages=None, text_per_line=False):
         """
         Creates a PDF file with an image superimposed on top of the text.
-        Text is positioned according to the bounding box of the lines in
-        the hOCR file.
+        Text is positioned according to the bounding box of the words (or
+        lines, with 'text_per_line') in the hOCR file.
         The image need not be identical to the image used to create the hOCR
         file.
         It can have a lower resolution, different color mode, etc.
+        Each page of hOCR file is a page of PDF file, unless a list of page indexes is given in 'pages'.
         """
+        from reportlab.pdfgen.canvas import Canvas
+        if pages is None:
+            pages = range(len(self.pages))
         # create the PDF file
         # page size in points (1/72 in.)
         pdf = Canvas(
-            out_file_name, pagesize=(self.width, self.height), pageCompression=1)
-        # draw bounding box for each paragraph
-        # light blue for bounding box of paragraph
-        pdf.setStrokeColorRGB(0, 1, 1)
-        # light blue for bounding box of paragraph
-        pdf.setFillColorRGB(0, 1, 1)
-        pdf.setLineWidth(0)  # no line for bounding box
-        for elem in self.hocr.findall(
-                ".//%sp[@class='%s']" % (self.xmlns, "ocr_par")):
-            elemtxt = self._get_element_text(elem).rstrip()
-            if len(elemtxt) == 0:
-                continue
-            pxl_coords = self.element_coordinates(elem)
-            pt = self.pt_from_pixel(pxl_coords)
-            # draw the bbox border
-            if show_bounding_boxes:
-                pdf.rect(pt.x1, self.height - pt.y2, pt.x2 - pt.x1, pt.y2 - pt.y1, fill=1)
-        # check if element with class 'ocrx_word' are available
-        # otherwise use 'ocr_line' as fallback
-        elemclass = "ocr_line"
-        if self.hocr.find(".//%sspan[@class='ocrx_word']" % self.xmlns) is not None:
-            elemclass = "ocrx_word"
-        # itterate all text elements
-        # light green for bounding box of word/line
-        pdf.setStrokeColorRGB(1, 0, 0)
-        pdf.setLineWidth(0.5)  # bounding box line width
-        pdf.setDash(6, 3)  # bounding box is dashed
-        pdf.setFillColorRGB(0, 0, 0)  # text in black
-        for elem in self.hocr.findall(".//%sspan[@class='%s']" % (self.xmlns, elemclass)):
-            elemtxt = self._get_element_text(elem).rstrip()
-            elemtxt = self.replace_unsupported_chars(elemtxt)
-            if len(elemtxt) == 0:
-                continue
-            pxl_coords = self.element_coordinates(elem)
-            pt = self.pt_from_pixel(pxl_coords)
-            # draw the bbox border
+            out_file_name, pagesize=(self.pages[pages[0]].width, self.pages[pages[0]].height), pageCompression=1)
+        # 'textOut' moves text cursor by the width of each word (from canvas). Widths come from glyph width cache, so they are not
+        # calculated again by reportlab for each word
+        pdf.stringWidth = self.string_width
+        for page_index in pages:
+            page = self.pages[page_index]
+            pdf.setPageSize((page.width, page.height))
             if show_bounding_boxes:
-                pdf.rect(pt.x1, self.height - pt.y2, pt.x2 - pt.x1, pt.y2 - pt.y1, fill=0)
+                # light blue for bounding box of paragraph
+                pdf.setFillColorRGB(0, 1, 1)
+                pdf.setLineWidth(0)  # no line for bounding box
+                for pt in page.paragraphs:
+                    pdf.rect(pt.x1, page.height - pt.y2, pt.x2 - pt.x1, pt.y2 - pt.y1, fill=1)
+                # red dashed bounding box of word/line
+                pdf.setStrokeColorRGB(1, 0, 0)
+                pdf.setLineWidth(0.5)  # bounding box line width
+                pdf.setDash(6, 3)  # bounding box is dashed
+            pdf.setFillColorRGB(0, 0, 0)  # text in black
+            # All text of the page is written in only one text object, with font size 1 scaled by text matrix
             text = pdf.beginText()
-            fontsize = pt.y2 - pt.y1
-            text.setFont(fontname, fontsize)
+            text.setFont(fontname, 1)
             if invisible_text:
                 text.setTextRenderMode(3)  # Invisible (indicates OCR text)
-            # set cursor to bottom left corner of bbox (adjust for dpi)
-            text.setTextOrigin(pt.x1, self.height - pt.y2)
-            # scale the width of the text to fill the width of the bbox
-            text.setHorizScale(100 * (pt.x2 - pt.x1) / pdf.stringWidth(elemtxt, fontname, fontsize))
-            # write the text to the page
-            text.textLine(elemtxt)
+            for line in page.lines:
+                for pt, elemtxt in ([(line.coords, line.text)] if text_per_line or len(line.words) == 0 else line.words):
+                    fontsize = pt.y2 - pt.y1
+                    elemtxt_width = self.string_width(elemtxt, fontname, 1)
+                    if elemtxt_width <= 0 or fontsize <= 0:
+                        continue
+                    # draw the bbox border
+                    if show_bounding_boxes:
+                        pdf.rect(pt.x1, page.height - pt.y2, pt.x2 - pt.x1, pt.y2 - pt.y1, fill=0)
+                    # set cursor to bottom left corner of bbox (adjust for dpi)
+                    # and scale the width of the text to fill the width of the bbox
+                    text.setTextTransform((pt.x2 - pt.x1) / elemtxt_width, 0, 0, fontsize, pt.x1, page.height - pt.y2)
+                    # write the text to the page (cursor moved by textOut is not used, as each text has its own origin)
+                    text.textOut(elemtxt)
             pdf.drawText(text)
-        #
-        # put the image on the page, scaled to fill the page
-        if image_file_name is not None:
-            pdf.drawImage(image_file_name, 0, 0, width=self.width, height=self.height)
-        # finish up the page and save it
-        pdf.showPage()
+            #
+            # put the image on the page, scaled to fill the page
+            if image_file_name is not None:
+                pdf.drawImage(image_file_name, 0, 0, width=page.width, height=page.height)
+            # finish up the page
+            pdf.showPage()
         pdf.save()
         #
 
@@ -442,7 +1589,34 @@ class Pdf2PdfOcrException(Exception):
     pass
 
 
-class Pdf2PdfOcr:
+class Pdf2PdfOcrLogger:
+    """Log and debug messages, with the same format for all classes"""
+
+    log_time_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    verbose_mode = False
+
+    def debug(self, param):
+        try:
+            if self.verbose_mode:
+                tstamp = datetime.datetime.now().strftime(self.log_time_format)
+                print("[{0}] [DEBUG] {1}".format(tstamp, param), flush=True)
+        except:
+            pass
+
+    def log(self, param):
+        try:
+            tstamp = datetime.datetime.now().strftime(self.log_time_format)
+            print("[{0}] [LOG] {1}".format(tstamp, param), flush=True)
+        except:
+            pass
+
+
+class Pdf2PdfOcrSession(Pdf2PdfOcrLogger):
+    """
+    Resources shared by all files processed in one execution: the worker pool and the external tools discovery.
+    Tools capabilities are cached on disk, keyed by each tool path and modification time.
+    """
     # External tools command. If you can't edit your path, adjust here to match your system
     cmd_cuneiform = "cuneiform"
     path_cuneiform = ""
@@ -451,6 +1625,7 @@ class Pdf2PdfOcr:
     cmd_convert = "convert"
     cmd_magick = "magick"  # used on Windows with ImageMagick 7+ (to avoid conversion path problems)
     path_convert = ""
+    path_magick = ""
     cmd_mogrify = "mogrify"
     path_mogrify = ""
     cmd_file = "file"
@@ -465,8 +1640,6 @@ class Pdf2PdfOcr:
     path_pdf2ps = ""
     cmd_gs = "gs"
     path_gs = ""
-    cmd_qpdf = "qpdf"
-    path_qpdf = ""
 
     tesseract_can_textonly_pdf = False
     """Since Tesseract 3.05.01, new use case of tesseract - https://github.com/tesseract-ocr/tesseract/issues/660"""
@@ -474,17 +1647,14 @@ class Pdf2PdfOcr:
     tesseract_version = 3
     """Tesseract version installed on system"""
 
-    extension_images = "jpg"
-    """Temp images will use this extension. Using jpg to avoid big temp files in pdf with a lot of pages"""
-
-    output_file = ""
-    """The PDF output file"""
+    tools_cache_version = 1
+    """Change when content of tools cache file changes"""
 
-    output_file_text = ""
-    """The TXT output file"""
+    cgroup_dir = "/sys/fs/cgroup/"
+    """Where cgroup limits of this process (e.g. in a container) are read from, on Linux"""
 
-    path_this_python = sys.executable
-    """Path for python in this system"""
+    io_wait_extra_workers = 0.5
+    """Pool has this percent of workers more than CPUs to use, to run more page tasks when tasks are waiting on I/O"""
 
     shell_mode = (sys.platform == "win32")
     """How to run external process? In Windows use Shell=True
@@ -493,97 +1663,154 @@ class Pdf2PdfOcr:
     and will only look in relative to the current working directory."
     """
 
-    def __init__(self, args, override_input_file=None):
+    def __init__(self, args):
         super().__init__()
-        self.log_time_format = '%Y-%m-%d %H:%M:%S.%f'
-        #
-        # A random prefix to support multiple execution in parallel
-        self.prefix = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(5))
-        # The temp dir
-        self.tmp_dir = tempfile.gettempdir() + os.path.sep + "pdf2pdfocr_{0}".format(self.prefix) + os.path.sep
-        os.mkdir(self.tmp_dir)
-        #
         self.verbose_mode = args.verbose_mode
+        self.tools_cache_file = Pdf2PdfOcrSession.get_tools_cache_file()
         self.check_external_tools()
-        # Handle arguments from command line
-        self.safe_mode = args.safe_mode
-        self.check_text_mode = args.check_text_mode
-        self.ignore_existing_text = args.ignore_existing_text
-        self.blank_pages = []
-        self.blank_pages_dimensions = []
-        self.check_protection_mode = args.check_protection_mode
-        self.avoid_high_pages_mode = args.max_pages is not None
-        self.avoid_high_pages_pages = args.max_pages
-        self.avoid_small_file_mode = args.min_kbytes is not None
-        self.avoid_small_file_limit_kb = args.min_kbytes
-        self.force_rebuild_mode = args.force_rebuild_mode
-        self.rebuild_pdf_from_images = False
-        self.user_convert_params = args.convert_params
-        if self.user_convert_params is None:
-            self.user_convert_params = ""  # Default
-        self.deskew_threshold = args.deskew_percent
-        self.use_deskew_mode = args.deskew_percent is not None
-        self.use_autorotate = args.autorotate
+        #
         self.parallel_threshold = args.parallel_percent
         if self.parallel_threshold is None:
             self.parallel_threshold = 1  # Default
-        self.create_text_mode = args.create_text_mode
-        self.force_out_file_mode = args.output_file is not None
-        if self.force_out_file_mode:
-            self.force_out_file = args.output_file
-        else:
-            self.force_out_file = ""
-        self.force_out_dir_mode = args.output_dir is not None
-        if self.force_out_dir_mode:
-            self.force_out_dir = args.output_dir
-        else:
-            self.force_out_dir = ""
-        if self.force_out_file != "" and self.force_out_dir != "":
-            raise Pdf2PdfOcrException("It's not possible to force output name and dir at the same time. Please use '-o' OR '-O'")
-        if self.force_out_dir_mode and (not os.path.isdir(self.force_out_dir)):
-            raise Pdf2PdfOcrException("Invalid output directory: {0}".format(self.force_out_dir))
-        self.tess_langs = args.tess_langs
-        if self.tess_langs is None:
-            self.tess_langs = "por+eng"  # Default
-        self.tess_psm = args.tess_psm
-        if self.tess_psm is None:
-            self.tess_psm = "1"  # Default
-        self.image_resolution = args.image_resolution
-        self.text_generation_strategy = args.text_generation_strategy
-        if self.text_generation_strategy not in ["tesseract", "native"]:
-            raise Pdf2PdfOcrException("{0} is not a valid text generation strategy. Exiting.".format(self.text_generation_strategy))
-        self.ocr_ignored = False
-        self.ocr_engine = args.ocr_engine
-        if self.ocr_engine not in ["tesseract", "cuneiform", "no_ocr"]:
-            raise Pdf2PdfOcrException("{0} is not a valid ocr engine. Exiting.".format(self.ocr_engine))
-        self.extra_ocr_flag = args.extra_ocr_flag
-        if self.extra_ocr_flag is not None:
-            self.extra_ocr_flag = str(self.extra_ocr_flag.strip())
-        self.delete_temps = not args.keep_temps
-        self.input_file = args.input_file if override_input_file is None else override_input_file
-        if not os.path.isfile(self.input_file):
-            raise Pdf2PdfOcrException("{0} not found. Exiting.".format(self.input_file))
-        self.input_file = os.path.abspath(self.input_file)
-        self.input_file_type = ""
-        #
-        self.input_file_has_text = False
-        self.input_file_is_encrypted = False
-        self.input_file_metadata = dict()
-        self.input_file_number_of_pages = None
-        #
-        self.debug("Temp dir is {0}".format(self.tmp_dir))
-        self.debug("Prefix is {0}".format(self.prefix))
-        # Where am I?
-        self.script_dir = os.path.dirname(os.path.abspath(__file__)) + os.path.sep
-        self.debug("Script dir is {0}".format(self.script_dir))
-        #
-        self.cpu_to_use = int(multiprocessing.cpu_count() * self.parallel_threshold)
+        self.cpu_to_use = int(Pdf2PdfOcrSession.get_available_cpus() * self.parallel_threshold)
         if self.cpu_to_use == 0:
             self.cpu_to_use = 1
-        self.debug("Parallel operations will use {0} CPUs".format(self.cpu_to_use))
+        # Extra workers are used only when measures show that page tasks are waiting on I/O (see 'Pdf2PdfOcr.adjust_concurrency')
+        self.max_workers = self.cpu_to_use + math.ceil(self.cpu_to_use * self.io_wait_extra_workers)
+        self.debug("Parallel operations will use {0} CPUs ({1} workers at most)".format(self.cpu_to_use, self.max_workers))
         #
-        self.main_pool = multiprocessing.Pool(self.cpu_to_use)
+        # Workers can be restarted after some tasks, to limit memory growth in long runs
+        self.worker_max_tasks = args.worker_max_tasks
+        # Pool is created on first task, so files rejected early don't start workers
+        self.main_pool = None
+        # Workers of this pool (not of pools of other sessions, in service mode) register themselves when started
+        self.worker_pids_queue = multiprocessing.SimpleQueue()
+        self.worker_pids = set()
         #
+        self.cache = None
+        if args.cache_dir is not None:
+            self.cache = Pdf2PdfOcrCache(args.cache_dir, args.cache_size)
+            self.debug("Cache dir is {0}".format(self.cache.cache_dir))
+        self.cache_stats = Pdf2PdfOcrSession.new_cache_stats()
+
+    @staticmethod
+    def new_cache_stats():
+        return {"raster_hit": 0, "raster_miss": 0, "ocr_hit": 0, "ocr_miss": 0}
+
+    def log_cache_stats(self, cache_stats, scope):
+        self.log("Cache ({0}): rasterized pages {1} hits / {2} misses, OCR {3} hits / {4} misses".format(
+            scope, cache_stats["raster_hit"], cache_stats["raster_miss"], cache_stats["ocr_hit"], cache_stats["ocr_miss"]))
+
+    def get_pool(self):
+        if self.main_pool is None:
+            self.main_pool = multiprocessing.Pool(self.max_workers, initializer=register_worker, initargs=(self.worker_pids_queue,),
+                                                  maxtasksperchild=self.worker_max_tasks)
+        return self.main_pool
+
+    def get_workers(self):
+        """Live worker processes of this session pool"""
+        while not self.worker_pids_queue.empty():
+            self.worker_pids.add(self.worker_pids_queue.get())
+        workers = []
+        for worker_pid in list(self.worker_pids):
+            try:
+                worker = psutil.Process(worker_pid)
+                # Pid of a finished worker may be reused by other process
+                if worker.ppid() != os.getpid():
+                    raise psutil.NoSuchProcess(worker_pid)
+            except psutil.Error:
+                self.worker_pids.discard(worker_pid)
+                continue
+            workers.append(worker)
+        return workers
+
+    @staticmethod
+    def read_cgroup_file(cgroup_file):
+        """
+        Fields of a cgroup file of this process, or None if it's missing (no cgroup, other cgroup version or other OS).
+        Cgroup v1 files are prefixed by their controller dir (e.g. 'memory/memory.limit_in_bytes'). Cgroup of this process is
+        read from '/proc/self/cgroup'. In a container, cgroup files of the container may be in cgroup root dir instead.
+        """
+        controller_dir, cgroup_file_name = os.path.split(cgroup_file)
+        cgroup_dirs = [Pdf2PdfOcrSession.cgroup_dir + controller_dir]
+        try:
+            with open("/proc/self/cgroup", 'r') as f:
+                for cgroup_line in f.read().splitlines():
+                    # "<id>:<controllers>:<path>", controllers are empty in cgroup v2
+                    _, controllers, cgroup_path = cgroup_line.split(":", 2)
+                    if controller_dir in controllers.split(",") and cgroup_path.strip("/") != "":
+                        cgroup_dirs.insert(0, os.path.join(cgroup_dirs[-1], cgroup_path.strip("/")))
+        except (OSError, ValueError):
+            pass
+        for cgroup_dir in cgroup_dirs:
+            try:
+                with open(os.path.join(cgroup_dir, cgroup_file_name), 'r') as f:
+                    return f.read().split()
+            except OSError:
+                continue
+        return None
+
+    @staticmethod
+    def get_available_cpus():
+        """CPUs this process can use: CPUs of its affinity, limited by cgroup CPU quota (e.g. 'docker run --cpus')"""
+        try:
+            available_cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            available_cpus = multiprocessing.cpu_count()  # No affinity info (Windows, MacOS)
+        cpu_quota = None
+        cpu_max = Pdf2PdfOcrSession.read_cgroup_file("cpu.max")  # cgroup v2: "<quota> <period>" or "max <period>"
+        if cpu_max is not None and cpu_max[0] != "max":
+            cpu_quota = int(cpu_max[0]) / int(cpu_max[1])
+        elif cpu_max is None:
+            cfs_quota = Pdf2PdfOcrSession.read_cgroup_file("cpu/cpu.cfs_quota_us")  # cgroup v1: -1 is no quota
+            cfs_period = Pdf2PdfOcrSession.read_cgroup_file("cpu/cpu.cfs_period_us")
+            if cfs_quota is not None and cfs_period is not None and int(cfs_quota[0]) > 0:
+                cpu_quota = int(cfs_quota[0]) / int(cfs_period[0])
+        if cpu_quota is not None:
+            available_cpus = min(available_cpus, max(1, math.ceil(cpu_quota)))
+        return available_cpus
+
+    @staticmethod
+    def get_available_memory():
+        """
+        Memory (bytes) still available to this process: free system memory, limited by cgroup memory limit minus cgroup usage.
+        Inactive file cache is not counted as usage, as it is released before the cgroup runs out of memory.
+        """
+        available_memory = psutil.virtual_memory().available
+        for limit_file, usage_file, stat_file, inactive_key in [("memory.max", "memory.current", "memory.stat", "inactive_file"),
+                                                                ("memory/memory.limit_in_bytes", "memory/memory.usage_in_bytes",
+                                                                 "memory/memory.stat", "total_inactive_file")]:
+            memory_limit = Pdf2PdfOcrSession.read_cgroup_file(limit_file)
+            memory_usage = Pdf2PdfOcrSession.read_cgroup_file(usage_file)
+            if memory_limit is None or memory_usage is None:
+                continue
+            if memory_limit[0] != "max":
+                memory_stat = Pdf2PdfOcrSession.read_cgroup_file(stat_file) or []
+                memory_stat = dict(zip(memory_stat[::2], memory_stat[1::2]))
+                cgroup_usage = int(memory_usage[0]) - int(memory_stat.get(inactive_key, 0))
+                available_memory = min(available_memory, int(memory_limit[0]) - cgroup_usage)
+            break
+        return max(0, available_memory)
+
+    def restart_pool(self):
+        """Stop running tasks (of a failed or timed out file). A new pool is created for the next files"""
+        self.debug("Restarting worker pool")
+        self.stop_pool()
+
+    def stop_pool(self):
+        if self.main_pool:
+            self.main_pool.close()
+            self.main_pool.terminate()
+            self.main_pool.join()
+            self.main_pool = None
+
+    def close(self):
+        self.stop_pool()
+        if self.cache is not None:
+            self.log_cache_stats(self.cache_stats, "all files")
+            removed_entries = self.cache.evict()
+            self.debug("{0} entries removed from cache".format(removed_entries))
+            self.cache = None
 
     def check_external_tools(self):
         """Check if external tools are available, aborting or warning in case of any error."""
@@ -592,22 +1819,12 @@ class Pdf2PdfOcr:
             eprint("tesseract not found. Aborting...")
             sys.exit(1)
         #
-        self.tesseract_can_textonly_pdf = self.test_tesseract_textonly_pdf()
-        self.tesseract_version = self.get_tesseract_version()
-        #
         self.path_cuneiform = shutil.which(self.cmd_cuneiform)
         if self.path_cuneiform is None:
             self.debug("cuneiform not available")
         #
-        # Try to avoid errors on Windows with native OS "convert" command
-        # http://savage.net.au/ImageMagick/html/install-convert.html
-        # https://www.imagemagick.org/script/magick.php
         self.path_convert = shutil.which(self.cmd_convert)
-        if not self.test_convert():
-            self.path_convert = shutil.which(self.cmd_magick)
-        if self.path_convert is None:
-            eprint("convert/magick from ImageMagick not found. Aborting...")
-            sys.exit(1)
+        self.path_magick = shutil.which(self.cmd_magick)
         #
         self.path_mogrify = shutil.which(self.cmd_mogrify)
         if self.path_mogrify is None:
@@ -623,8 +1840,6 @@ class Pdf2PdfOcr:
         if self.path_pdftoppm is None:
             eprint("pdftoppm (poppler) not found. Aborting...")
             sys.exit(1)
-        if self.get_pdftoppm_version() <= parse_version("0.70.0"):
-            self.log("External tool 'pdftoppm' is outdated. Please upgrade poppler")
         #
         self.path_pdffonts = shutil.which(self.cmd_pdffonts)
         if self.path_pdffonts is None:
@@ -640,53 +1855,420 @@ class Pdf2PdfOcr:
         if self.path_gs is None:
             eprint("ghostscript not found. Param 'ignore-existing-text' will not work...")
         #
-        self.path_qpdf = shutil.which(self.cmd_qpdf)
-        if self.path_qpdf is None:
-            self.log("External tool 'qpdf' not available. Merge can be slow")
+        # Capabilities are discovered running the tools, so they are cached until some tool changes
+        tools_key = self.get_tools_key()
+        capabilities = self.read_tools_cache(tools_key)
+        if capabilities is None:
+            capabilities = self.probe_tools()
+            self.write_tools_cache(tools_key, capabilities)
         else:
-            qpdf_version = self.get_qpdf_version()
-            minimum_version = "8.4.1"
-            if qpdf_version < parse_version(minimum_version):
-                self.log("External tool 'qpdf' is not on minimum version ({0}). Merge can be slow".format(minimum_version))
-                self.path_qpdf = None
+            self.debug("Tools capabilities read from cache {0}".format(self.tools_cache_file))
+        #
+        self.tesseract_can_textonly_pdf = capabilities["tesseract_can_textonly_pdf"]
+        self.debug("Tesseract can 'textonly_pdf': {0}".format(self.tesseract_can_textonly_pdf))
+        self.tesseract_version = capabilities["tesseract_version"]
+        self.debug("Tesseract version: {0}".format(self.tesseract_version))
+        #
+        # Try to avoid errors on Windows with native OS "convert" command
+        # http://savage.net.au/ImageMagick/html/install-convert.html
+        # https://www.imagemagick.org/script/magick.php
+        if not capabilities["convert_is_imagemagick"]:
+            self.path_convert = self.path_magick
+        if self.path_convert is None:
+            eprint("convert/magick from ImageMagick not found. Aborting...")
+            sys.exit(1)
+        #
+        self.debug("Pdftoppm version: {0}".format(capabilities["pdftoppm_version"]))
+        if packaging_version.parse(capabilities["pdftoppm_version"]) <= packaging_version.parse("0.70.0"):
+            self.log("External tool 'pdftoppm' is outdated. Please upgrade poppler")
         #
 
-    def debug(self, param):
+    def probe_tools(self):
+        """Run external tools to discover versions and features"""
+        return {
+            "tesseract_can_textonly_pdf": self.test_tesseract_textonly_pdf(),
+            "tesseract_version": self.get_tesseract_version(),
+            "convert_is_imagemagick": self.test_convert(),
+            "pdftoppm_version": str(self.get_pdftoppm_version()),
+        }
+
+    def get_tools_key(self):
+        """Path and modification time of every tool found. Any difference invalidates the tools cache"""
+        tools_key = {}
+        for tool_path in [self.path_tesseract, self.path_cuneiform, self.path_convert, self.path_magick, self.path_mogrify, self.path_file,
+                          self.path_pdftoppm, self.path_pdffonts, self.path_ps2pdf, self.path_pdf2ps, self.path_gs]:
+            if tool_path is not None:
+                try:
+                    tools_key[tool_path] = os.stat(tool_path).st_mtime_ns
+                except OSError:
+                    tools_key[tool_path] = None
+        return tools_key
+
+    @staticmethod
+    def get_tools_cache_file():
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or (os.path.expanduser("~") + os.path.sep + ".cache")
+        return cache_dir + os.path.sep + "pdf2pdfocr" + os.path.sep + "tools.json"
+
+    def read_tools_cache(self, tools_key):
         try:
-            if self.verbose_mode:
-                tstamp = datetime.datetime.now().strftime(self.log_time_format)
-                print("[{0}] [DEBUG] {1}".format(tstamp, param), flush=True)
-        except:
-            pass
+            with open(self.tools_cache_file, "r") as f:
+                tools_cache = json.load(f)
+            if tools_cache["version"] == self.tools_cache_version and tools_cache["tools"] == tools_key:
+                return tools_cache["capabilities"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # Missing or invalid cache. Tools will be checked again
+        return None
+
+    def write_tools_cache(self, tools_key, capabilities):
+        tools_cache = {"version": self.tools_cache_version, "tools": tools_key, "capabilities": capabilities}
+        try:
+            os.makedirs(os.path.dirname(self.tools_cache_file), exist_ok=True)
+            # Write to another file and rename, so parallel executions never read a partial cache
+            tools_cache_file_tmp = self.tools_cache_file + ".{0}.tmp".format(os.getpid())
+            with open(tools_cache_file_tmp, "w") as f:
+                json.dump(tools_cache, f)
+            os.replace(tools_cache_file_tmp, self.tools_cache_file)
+        except OSError as e:
+            self.debug("Could not write tools cache {0}: {1}".format(self.tools_cache_file, e))
 
-    def log(self, param):
+    def test_convert(self):
+        """
+        test convert command to check if it's ImageMagick
+        :return: True if it's ImageMagicks convert, false with any other case or error
+        """
         try:
-            tstamp = datetime.datetime.now().strftime(self.log_time_format)
-            print("[{0}] [LOG] {1}".format(tstamp, param), flush=True)
-        except:
-            pass
+            result = False
+            test_image_fd, test_image = tempfile.mkstemp(prefix="pdf2pdfocr_converttest-", suffix=".jpg")
+            os.close(test_image_fd)
+            Pdf2PdfOcr.best_effort_remove(test_image)
+            ptest = subprocess.Popen([self.path_convert, 'rose:', test_image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                     shell=self.shell_mode)
+            ptest.wait()
+            return_code = ptest.returncode
+            if (return_code == 0) and (os.path.isfile(test_image)):
+                Pdf2PdfOcr.best_effort_remove(test_image)
+                result = True
+            return result
+        except Exception:
+            self.log("Error testing convert utility. Assuming there is no 'convert' available...")
+            return False
+
+    def test_tesseract_textonly_pdf(self):
+        result = False
+        try:
+            result = ('textonly_pdf' in subprocess.check_output([self.path_tesseract, '--print-parameters'], universal_newlines=True))
+        except Exception:
+            self.log("Error checking tesseract capabilities. Trying to continue without 'textonly_pdf' in Tesseract")
+        return result
+
+    def get_tesseract_version(self):
+        # Inspired by the great lib 'pytesseract' - https://github.com/madmaze/pytesseract/blob/master/src/pytesseract.py
+        try:
+            version_info = subprocess.check_output([self.path_tesseract, '--version'], stderr=subprocess.STDOUT).decode('utf-8').split()
+            # self.debug("Tesseract full version info: {0}".format(version_info))
+            version_info = version_info[1].lstrip(string.printable[10:])
+            l_version_info = packaging_version.parse(version_info)
+            result = int(l_version_info.base_version.split(".")[0])
+            return result
+        except Exception as e:
+            self.log("Error checking tesseract version. Trying to continue assuming legacy version 3. Exception was {0}".format(e))
+            return 3
+
+    def get_pdftoppm_version(self):
+        try:
+            version_info = subprocess.check_output([self.path_pdftoppm, '-v'], stderr=subprocess.STDOUT).decode('utf-8').split()
+            version_info = version_info[2]
+            l_version_info = packaging_version.parse(version_info)
+            return l_version_info
+        except Exception as e:
+            legacy_version = "0.70.0"
+            self.log("Error checking pdftoppm version. Trying to continue assuming legacy version {0}. Exception was {1}".format(legacy_version, e))
+            return packaging_version.parse(legacy_version)
+
+
+class Pdf2PdfOcr(Pdf2PdfOcrLogger):
+    extension_images = "jpg"
+    """Temp images will use this extension. Using jpg to avoid big temp files in pdf with a lot of pages"""
+
+    output_file = ""
+    """The PDF output file"""
+
+    output_file_text = ""
+    """The TXT output file"""
+
+    """Path for python in this system"""
+
+    shell_mode = Pdf2PdfOcrSession.shell_mode
+    """How to run external process? (see Pdf2PdfOcrSession)"""
+
+    osd_resolution = 150
+    """Images are downscaled to this resolution (DPI) to detect orientation for autorotate"""
+
+    osd_min_confidence = 5.0
+    """Orientation detected in downscaled image with lower confidence is detected again in full image"""
+
+    deskew_max_angle = 5.0
+    """In-process deskew looks for skew angles (degrees) up to this value"""
+
+    degraded_resolution = 150
+    """With page timeout, pages not rasterized in time are rasterized again in this resolution (DPI)"""
+
+    degraded_tess_psm = "6"
+    """With page timeout, pages not OCR'ed in time are OCR'ed again with this tesseract page segmentation mode"""
+
+    concurrency_check_seconds = 2.0
+    """Minimum time between measures of workers, to adjust the number of page tasks running at once"""
+
+    task_memory_per_pixel = 12
+    """Bytes of memory used by a page task for each pixel of page image (copies of image and OCR data), until it's measured"""
+
+    worker_base_memory = 64 * 1024 * 1024
+    """Bytes of memory used by a worker process without any page task"""
+
+    memory_reserve = 0.2
+    """Percent of available memory not used by page tasks"""
+
+    io_wait_cpu_per_task = 0.75
+    """Page tasks using less CPU than this (in CPUs per task) are waiting on I/O, so more tasks can run at once"""
+
+    resume_ignored_options = ["input_file", "output_file", "output_dir", "safe_mode", "parallel_percent", "timeout", "ocr_batch",
+                              "cache_dir", "cache_size", "tmp_dir_base", "tmp_size", "resume_dir", "watch_mode", "done_dir", "error_dir",
+                              "service_port", "service_jobs", "worker_max_tasks", "keep_temps", "verbose_mode", "pause_end_mode",
+                              "ignore_gooey", "no_effect_01"]
+    """Options that don't change output, so a job interrupted with other values of these options can be resumed"""
+
+    def __init__(self, args, override_input_file=None, session=None):
+        super().__init__()
+        # External tools started by this file (not by workers)
+        self.processes = []
+        self.tmp_dir_cleaned = False
+        #
+        # The temp dir (created when input file is known)
+        tmp_dir_base = tempfile.gettempdir() if args.tmp_dir_base is None else os.path.abspath(args.tmp_dir_base)
+        if not os.path.isdir(tmp_dir_base):
+            raise Pdf2PdfOcrException("Invalid temp directory: {0}".format(tmp_dir_base))
+        if args.resume_dir is not None and not os.path.isdir(args.resume_dir):
+            raise Pdf2PdfOcrException("Invalid resume directory: {0}".format(args.resume_dir))
+        #
+        self.verbose_mode = args.verbose_mode
+        # Without a session (one file only), this object creates and owns it
+        self.own_session = session is None
+        if self.own_session:
+            session = Pdf2PdfOcrSession(args)
+        self.session = session
+        self.path_tesseract = session.path_tesseract
+        self.path_cuneiform = session.path_cuneiform
+        self.path_convert = session.path_convert
+        self.path_mogrify = session.path_mogrify
+        self.path_file = session.path_file
+        self.path_pdftoppm = session.path_pdftoppm
+        self.path_pdffonts = session.path_pdffonts
+        self.path_ps2pdf = session.path_ps2pdf
+        self.path_pdf2ps = session.path_pdf2ps
+        self.path_gs = session.path_gs
+        self.tesseract_can_textonly_pdf = session.tesseract_can_textonly_pdf
+        self.tesseract_version = session.tesseract_version
+        # Handle arguments from command line
+        self.safe_mode = args.safe_mode
+        self.check_text_mode = args.check_text_mode
+        self.ignore_existing_text = args.ignore_existing_text
+        self.skip_text_pages = args.skip_text_pages
+        self.pages_selection = args.pages_selection
+        self.raster_in_memory = args.raster_in_memory
+        # Page number -> native text (None for pages not selected), for pages not rasterized nor OCR'ed
+        self.pages_without_ocr = dict()
+        self.min_text_page_chars = 32
+        # Bigger documents are assembled in chunks of pages, in parallel
+        self.assemble_chunk_pages = 200
+        self.blank_pages = []
+        self.pages_rotated_before_ocr = dict()
+        # Page number -> page stages degraded by page timeout
+        self.pages_degraded = dict()
+        # Pages with an empty text layer after page timeout (not rasterized or not OCR'ed)
+        self.pages_empty_text = set()
+        self.blank_pages_dimensions = []
+        self.pages_greyscale = []
+        self.check_protection_mode = args.check_protection_mode
+        self.avoid_high_pages_mode = args.max_pages is not None
+        self.avoid_high_pages_pages = args.max_pages
+        self.avoid_small_file_mode = args.min_kbytes is not None
+        self.avoid_small_file_limit_kb = args.min_kbytes
+        self.force_rebuild_mode = args.force_rebuild_mode
+        self.rebuild_pdf_from_images = False
+        self.user_convert_params = args.convert_params
+        if self.user_convert_params is None:
+            self.user_convert_params = ""  # Default
+        self.deskew_threshold = args.deskew_percent
+        self.use_deskew_mode = args.deskew_percent is not None
+        self.deskew_min_angle = args.deskew_min_angle
+        if self.use_deskew_mode and self.deskew_min_angle is not None:
+            eprint("Warning: imagemagick deskew (-d) is used. Option '--deskew-ocr' is ignored.")
+            self.deskew_min_angle = None
+        self.use_autorotate = args.autorotate
+        self.rotate_before_ocr = args.rotate_before_ocr
+        if self.rotate_before_ocr and not self.use_autorotate:
+            eprint("Warning: rotation before OCR works only with autorotate (-u). Pages will be OCR'ed as rasterized.")
+            self.rotate_before_ocr = False
+        self.create_text_mode = args.create_text_mode
+        self.force_out_file_mode = args.output_file is not None
+        if self.force_out_file_mode:
+            self.force_out_file = args.output_file
+        else:
+            self.force_out_file = ""
+        self.force_out_dir_mode = args.output_dir is not None
+        if self.force_out_dir_mode:
+            self.force_out_dir = args.output_dir
+        else:
+            self.force_out_dir = ""
+        if self.force_out_file != "" and self.force_out_dir != "":
+            raise Pdf2PdfOcrException("It's not possible to force output name and dir at the same time. Please use '-o' OR '-O'")
+        if self.force_out_dir_mode and (not os.path.isdir(self.force_out_dir)):
+            raise Pdf2PdfOcrException("Invalid output directory: {0}".format(self.force_out_dir))
+        self.tess_langs = args.tess_langs
+        if self.tess_langs is None:
+            self.tess_langs = "por+eng"  # Default
+        self.tess_psm = args.tess_psm
+        if self.tess_psm is None:
+            self.tess_psm = "1"  # Default
+        self.ocr_batch = args.ocr_batch
+        self.blank_threshold = args.blank_threshold
+        if not 0.0 <= self.blank_threshold <= 100.0:
+            raise Pdf2PdfOcrException("Invalid blank page threshold: {0}".format(self.blank_threshold))
+        if self.ocr_batch < 1:
+            raise Pdf2PdfOcrException("Invalid number of pages for each OCR process: {0}".format(self.ocr_batch))
+        self.image_resolution = args.image_resolution
+        self.text_generation_strategy = args.text_generation_strategy
+        if self.text_generation_strategy not in ["tesseract", "native"]:
+            raise Pdf2PdfOcrException("{0} is not a valid text generation strategy. Exiting.".format(self.text_generation_strategy))
+        self.text_per_line = args.text_per_line
+        self.ocr_ignored = False
+        self.ocr_engine = args.ocr_engine
+        if self.ocr_engine not in ["tesseract", "cuneiform", "no_ocr"]:
+            raise Pdf2PdfOcrException("{0} is not a valid ocr engine. Exiting.".format(self.ocr_engine))
+        self.extra_ocr_flag = args.extra_ocr_flag
+        if self.extra_ocr_flag is not None:
+            self.extra_ocr_flag = str(self.extra_ocr_flag.strip())
+        self.adaptive_confidence = args.adaptive_confidence
+        if self.adaptive_confidence is not None:
+            if not 0 <= self.adaptive_confidence <= 100:
+                raise Pdf2PdfOcrException("Invalid adaptive OCR confidence: {0}".format(self.adaptive_confidence))
+            if self.ocr_engine != "tesseract":
+                eprint("Warning: adaptive OCR works only with tesseract. Pages will be OCR'ed only once.")
+                self.adaptive_confidence = None
+        self.adaptive_resolution = args.adaptive_resolution
+        if self.adaptive_resolution < 1:
+            raise Pdf2PdfOcrException("Invalid adaptive OCR resolution: {0}".format(self.adaptive_resolution))
+        self.adaptive_ocr_flag = args.adaptive_ocr_flag
+        if self.adaptive_ocr_flag is None:
+            self.adaptive_ocr_flag = self.extra_ocr_flag
+        else:
+            self.adaptive_ocr_flag = str(self.adaptive_ocr_flag.strip())
+        self.delete_temps = not args.keep_temps
+        if args.tmp_size is not None and args.tmp_size < 1:
+            raise Pdf2PdfOcrException("Invalid temp size: {0}".format(args.tmp_size))
+        self.page_timeout = args.page_timeout
+        if self.page_timeout is not None and self.page_timeout <= 0:
+            raise Pdf2PdfOcrException("Invalid page timeout: {0}".format(self.page_timeout))
+        self.input_file = args.input_file if override_input_file is None else override_input_file
+        if not os.path.isfile(self.input_file):
+            raise Pdf2PdfOcrException("{0} not found. Exiting.".format(self.input_file))
+        self.input_file = os.path.abspath(self.input_file)
+        if args.resume_dir is None:
+            # A random prefix to support multiple execution in parallel
+            self.prefix = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(5))
+            self.tmp_dir = tmp_dir_base + os.path.sep + "pdf2pdfocr_{0}".format(self.prefix) + os.path.sep
+            os.mkdir(self.tmp_dir)
+            self.journal_file = None
+        else:
+            # A stable work dir for each job (input file and options), kept until job is completed, so it can be resumed
+            job_key = self.get_job_key(args)
+            self.prefix = job_key[:5].upper()
+            self.tmp_dir = os.path.abspath(args.resume_dir) + os.path.sep + "pdf2pdfocr_job_{0}".format(job_key) + os.path.sep
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            self.journal_file = self.tmp_dir + "journal.jsonl"
+        self.job_completed = False
+        # Page number -> page result of pages already processed by an interrupted run of this job
+        self.resumed_page_results = dict()
+        self.resumed_rebuilt_images = set()
+        self.number_of_images = None
+        self.input_file_type = ""
+        #
+        self.input_file_has_text = False
+        self.input_file_is_encrypted = False
+        self.input_file_metadata = dict()
+        self.input_file_number_of_pages = None
+        #
+        self.debug("Temp dir is {0}".format(self.tmp_dir))
+        self.debug("Prefix is {0}".format(self.prefix))
+        # Where am I?
+        self.script_dir = os.path.dirname(os.path.abspath(__file__)) + os.path.sep
+        self.debug("Script dir is {0}".format(self.script_dir))
+        #
+        self.cpu_to_use = session.cpu_to_use
+        # Page tasks running at once (adjusted at run time with measures of workers, see 'adjust_concurrency')
+        self.concurrency = self.cpu_to_use
+        self.task_memory = None
+        self.workers_cpu_seconds = dict()
+        self.last_concurrency_check = None
+        # Bound pages rasterized but not yet processed, so the pipeline does not fill temp dir ahead of OCR
+        self.max_pages_in_flight = self.cpu_to_use * max(3, 2 * self.ocr_batch)
+        # Bound size of images rasterized but not yet processed (None is no limit)
+        self.max_bytes_in_flight = None if args.tmp_size is None else args.tmp_size * 1024 * 1024
+        self.max_pages_per_range = max(10, self.ocr_batch)
+        #
+        self.pool_open = True
+        self.pool_busy = False
+        # Finished tasks (from pool callbacks), so each result is handled as soon as it is ready
+        self.events = queue.Queue()
+        self.cache_stats = Pdf2PdfOcrSession.new_cache_stats()
+        #
+
+    def start_process(self, *popen_args, **popen_kwargs):
+        """Start an external tool for this file, so it can be killed by cleanup (in timeout situation)"""
+        process = subprocess.Popen(*popen_args, **popen_kwargs)
+        self.processes.append(process)
+        return process
 
     def cleanup(self):
         #
-        # Try to kill all child process still alive (in timeout situation)
-        process = psutil.Process(os.getpid())
-        for proc in process.children(recursive=True):
-            if "python" not in proc.name().lower():  # Python process are from multiprocessing and will be handled below
-                self.debug("Killing child process {0} with pid {1}".format(proc.name(), proc.pid))
+        # Try to kill child process of this file still alive (in timeout situation): tools started by this file and tools started by
+        # workers of its session. Jobs running at the same time in service mode have other sessions, so their tools are not killed.
+        for process in self.processes:
+            if process.poll() is None:
+                self.debug("Killing child process {0} with pid {1}".format(process.args[0], process.pid))
                 try:
+                    process.kill()
+                except OSError:
+                    pass  # By design
+        for worker in self.session.get_workers():
+            try:
+                worker_tools = worker.children(recursive=True)
+            except psutil.Error:
+                continue
+            for proc in worker_tools:
+                try:
+                    self.debug("Killing child process {0} with pid {1}".format(proc.name(), proc.pid))
                     proc.kill()
-                except:
+                except psutil.Error:
                     pass  # By design
         #
         # Cleanup the pool
-        if self.main_pool:
-            self.main_pool.close()
-            self.main_pool.terminate()
-            self.main_pool.join()
-            self.main_pool = None  # Signal for pool to stop waiting in while loops
+        if self.pool_open:
+            if self.own_session:
+                self.session.close()
+            elif self.pool_busy:
+                # Pool is shared with next files, so it's restarted only to stop tasks still running for this file
+                self.session.restart_pool()
+            self.pool_open = False
+            self.events.put(None)  # Signal to stop waiting for tasks
         #
         # Cleanup temp files
-        if self.delete_temps:
+        if self.tmp_dir_cleaned:
+            return
+        self.tmp_dir_cleaned = True
+        if self.delete_temps and self.journal_file is not None and not self.job_completed and os.path.isfile(self.journal_file):
+            eprint("Work dir kept to resume this job: {0}".format(self.tmp_dir))
+        elif self.delete_temps:
             shutil.rmtree(self.tmp_dir, ignore_errors=True)
         else:
             eprint("Temporary files kept in {0}".format(self.tmp_dir))
@@ -702,25 +2284,12 @@ class Pdf2PdfOcr:
         self.debug("User conversion params: {0}".format(self.user_convert_params))
         self.define_output_files()
         self.initial_cleanup()
-        self.convert_input_to_images()
-        # TODO - create param to user pass input page range for OCR
-        image_file_list = sorted(glob.glob(self.tmp_dir + "{0}*.{1}".format(self.prefix, self.extension_images)))
-        if self.input_file_number_of_pages is None:
-            self.input_file_number_of_pages = len(image_file_list)
-        self.check_avoid_high_pages()
         # TODO - create param to user pass image filters before OCR
-        self.check_blank_pages(image_file_list)
-        self.autorotate_info(image_file_list)
-        self.deskew(image_file_list)
-        self.external_ocr(image_file_list)
+        self.process_pages()
         if not self.ocr_ignored:
-            self.join_ocred_pdf()
             self.create_text_output()
         self.build_final_output()
-        self.autorotate_final_output()
-        #
-        # TODO - create directory watch mode (maybe using watchdog library)
-        # Like a daemon
+        self.log_degraded_pages()
         #
         # TODO - create option for PDF/A files
         # gs -dPDFA=3 -dBATCH -dNOPAUSE -sProcessColorModel=DeviceCMYK -sDEVICE=pdfwrite
@@ -728,15 +2297,17 @@ class Pdf2PdfOcr:
         # As in
         # http://git.ghostscript.com/?p=ghostpdl.git;a=blob_plain;f=doc/VectorDevices.htm;hb=HEAD#PDFA
         #
-        # Edit producer and build final PDF
-        # Without edit producer is easy as "shutil.copyfile(tmp_dir + prefix + "-OUTPUT.pdf", output_file)"
-        self.edit_producer()
-        #
         self.debug("Output file created")
         #
         # Adjust the new file timestamp
         # TODO touch -r "$INPUT_FILE" "$OUTPUT_FILE"
         #
+        if self.session.cache is not None:
+            for cache_stat in self.cache_stats:
+                self.session.cache_stats[cache_stat] += self.cache_stats[cache_stat]
+            self.session.log_cache_stats(self.cache_stats, "this file")
+        #
+        self.job_completed = True
         self.cleanup()
         time_elapsed = time.time() - time_at_start
         #
@@ -766,69 +2337,98 @@ This software is free, but if you like it, please donate to support new features
             self.cleanup()
             raise Pdf2PdfOcrException("Rebuild from images and ignore existing text won't work together")
 
-    def _merge_ocr(self, image_pdf_file_path, text_pdf_file_path, result_pdf_file_path, tag):
-        # Merge OCR background PDF into the main PDF document making a PDF sandwich
-        self.debug("Merging with OCR")
-        if self.path_qpdf is not None:
-            try:
-                with open(image_pdf_file_path, "rb") as img_f:
-                    img_data = PyPDF2.PdfReader(img_f, strict=False)
-                    first_page_img_rect = img_data.pages[0].mediaBox
-                    first_page_img_area = first_page_img_rect.getWidth() * first_page_img_rect.getHeight()
-            except PdfReadError:
-                eprint("Warning: could not read input file page geometry. Merge may fail, please check input file.")
-                first_page_img_area = 0
-            with open(text_pdf_file_path, "rb") as txt_f:
-                txt_data = PyPDF2.PdfReader(txt_f, strict=False)
-                first_page_txt_rect = txt_data.pages[0].mediaBox
-                first_page_txt_area = first_page_txt_rect.getWidth() * first_page_txt_rect.getHeight()
-            #
-            # Define overlay / underlay based on biggest page
-            if first_page_txt_area < first_page_img_area:
-                qpdf_command = [self.path_qpdf, "--underlay", image_pdf_file_path, "--", text_pdf_file_path, result_pdf_file_path]
-            else:
-                qpdf_command = [self.path_qpdf, "--overlay", text_pdf_file_path, "--", image_pdf_file_path, result_pdf_file_path]
+    def _assemble_output(self, image_pdf_files, text_pdf_files, rotation_angles, output_metadata, tag, image_rotation_angles=None):
+        # Merge with OCR text, autorotate and edit metadata, writing final output file once
+        self.debug("Assembling final output")
+        assembled_pdf_files = []
+        try:
+            image_pages = Pdf2PdfOcr.get_image_pages(image_pdf_files)
+            if text_pdf_files is not None and len(text_pdf_files) != len(image_pages):
+                raise ValueError("{0} OCR text pages for {1} image pages".format(len(text_pdf_files), len(image_pages)))
+            if len(image_pages) <= self.assemble_chunk_pages:
+                do_assemble_pdf(image_pages, text_pdf_files, rotation_angles, output_metadata, self.output_file, image_rotation_angles)
+                return
             #
-            pqpdf = subprocess.Popen(
-                qpdf_command,
-                stdout=subprocess.DEVNULL,
-                stderr=open(self.tmp_dir + "err_merge-qpdf-{0}-{1}.log".format(self.prefix, tag), "wb"),
-                shell=self.shell_mode)
-            pqpdf.wait()
-        else:
-            pmulti = subprocess.Popen(
-                [self.path_this_python, self.script_dir + 'pdf2pdfocr_multibackground.py',
-                 image_pdf_file_path, text_pdf_file_path, result_pdf_file_path],
-                stdout=subprocess.DEVNULL,
-                stderr=open(self.tmp_dir + "err_merge-multiback-{0}-{1}.log".format(self.prefix, tag), "wb"),
-                shell=self.shell_mode)
-            pmulti.wait()
+            # Chunks of pages are assembled in parallel (memory of each task depends only on chunk size).
+            # Then, chunks are joined in final output file, one at a time.
+            self.pool_busy = True
+            for first_page in range(0, len(image_pages), self.assemble_chunk_pages):
+                chunk_pages = slice(first_page, first_page + self.assemble_chunk_pages)
+                assembled_pdf_file = self.tmp_dir + "ASSEMBLE_{0}-{1:09d}.pdf".format(self.prefix, first_page + 1)
+                assembled_pdf_files.append(assembled_pdf_file)
+                self._submit_task("assemble", do_assemble_pdf, (image_pages[chunk_pages],
+                                                                text_pdf_files[chunk_pages] if text_pdf_files is not None else None,
+                                                                rotation_angles[chunk_pages] if rotation_angles is not None else None,
+                                                                None, assembled_pdf_file,
+                                                                image_rotation_angles[chunk_pages] if image_rotation_angles is not None else None))
+            # Wait for all tasks (even after an error), so no task of this merge is still running if it is tried again
+            assemble_errors = []
+            for _ in assembled_pdf_files:
+                task_kind, task_args, task_value, task_error = self._wait_task()
+                if task_error is not None:
+                    assemble_errors.append(task_error)
+            if len(assemble_errors) > 0:
+                raise assemble_errors[0]
+            self.debug("Assembled {0} chunks of pages".format(len(assembled_pdf_files)))
+            do_join_pdf_files(assembled_pdf_files, output_metadata, self.output_file)
+        except Pdf2PdfOcrException:
+            raise
+        except Exception as e:
+            self.debug("Assembling ({0}) failed: {1}".format(tag, e))
+            Pdf2PdfOcr.best_effort_remove(self.output_file)
+        finally:
+            self.pool_busy = False
+            self.remove_merged_temps(assembled_pdf_files)
+
+    @staticmethod
+    def get_image_pages(image_pdf_files):
+        """Pages of image PDF files, as tuples of file and page index. When there are many files, each one is a rebuilt page"""
+        if len(image_pdf_files) > 1:
+            return [(image_pdf_file, 0) for image_pdf_file in image_pdf_files]
+        with open(image_pdf_files[0], 'rb') as f:
+            number_of_pages = len(PyPDF2.PdfReader(f, strict=False).pages)
+        return [(image_pdf_files[0], page_index) for page_index in range(number_of_pages)]
 
     def build_final_output(self):
         # Start building final PDF.
         # First, should we rebuild source file?
         if not self.rebuild_pdf_from_images:
-            if not self.ocr_ignored:
-                self._merge_ocr(self.input_file, (self.tmp_dir + self.prefix + "-ocr.pdf"), (self.tmp_dir + self.prefix + "-OUTPUT.pdf"),
-                                "final-output")
-                #
-                # Try to handle fail.
-                # The code below try to rewrite source PDF and try again.
-                if not os.path.isfile(self.tmp_dir + self.prefix + "-OUTPUT.pdf"):
-                    self.try_repair_input_and_merge()
-            else:
-                # OCR ignored
-                shutil.copyfile(self.input_file, (self.tmp_dir + self.prefix + "-OUTPUT.pdf"))
+            image_pdf_files = [self.input_file]
         else:
-            self.rebuild_and_merge()
+            image_pdf_files = self.rebuild_pages()
         #
-        if not os.path.isfile(self.tmp_dir + self.prefix + "-OUTPUT.pdf"):
+        text_pdf_files = None
+        if not self.ocr_ignored:
+            # One OCR text file per page (other PDF files in a resumed work dir are not pages)
+            text_pdf_files = [page_file for page_file in self.get_page_files_by_suffix(".pdf") if os.path.isfile(page_file)]
+            self.debug("We have {0} ocr'ed files".format(len(text_pdf_files)))
+            if len(text_pdf_files) == 0:
+                self.cleanup()
+                raise Pdf2PdfOcrException("No PDF files generated after OCR. This is not expected. Aborting.")
+        #
+        rotation_angles, image_rotation_angles = self.get_rotation_angles()
+        output_metadata = self.get_output_metadata()
+        # Merge, autorotate and metadata are done in process, so final output is written once
+        self._assemble_output(image_pdf_files, text_pdf_files, rotation_angles, output_metadata, "final-output", image_rotation_angles)
+        #
+        # Try to handle fail.
+        # The code below try to rewrite source PDF and try again.
+        if not os.path.isfile(self.output_file) and not self.rebuild_pdf_from_images and text_pdf_files is not None:
+            self._assemble_output([self.repair_input()], text_pdf_files, rotation_angles, output_metadata, "repair_input",
+                                  image_rotation_angles)
+        #
+        if not os.path.isfile(self.output_file):
             self.cleanup()
             raise Pdf2PdfOcrException("Output file could not be created :( Exiting with error code.")
-
-    def rebuild_and_merge(self):
-        eprint("Warning: metadata wiped from final PDF file (original file is not an unprotected PDF / "
-               "forcing rebuild from extracted images / using deskew)")
+        if text_pdf_files is not None:
+            self.remove_merged_temps(text_pdf_files)
+        if self.rebuild_pdf_from_images:
+            self.remove_merged_temps(image_pdf_files)
+
+    def get_convert_params(self, preset=None):
+        """Return 'convert' parameters to rebuild pages, based on user presets (or this preset)"""
+        if preset is None:
+            preset = self.user_convert_params
         # Convert presets
         # Please read http://www.imagemagick.org/Usage/quantize/#colors_two
         preset_fast = "-threshold 60% -compress Group4"
@@ -837,98 +2437,105 @@ This software is free, but if you like it, please donate to support new features
         preset_jpeg = "-strip -interlace Plane -gaussian-blur 0.05 -quality 50% -compress JPEG"
         preset_jpeg2000 = "-quality 32% -compress JPEG2000"
         #
-        rebuild_list = sorted(glob.glob(self.tmp_dir + self.prefix + "*." + self.extension_images))
-        #
-        if self.user_convert_params == "smart":
-            checkimg_pool_map = self.main_pool.starmap_async(do_check_img_greyscale, zip(rebuild_list))
-            checkimg_wait_rounds = 0
-            while not checkimg_pool_map.ready() and (self.main_pool is not None):
-                checkimg_wait_rounds += 1
-                if checkimg_wait_rounds % 10 == 0:
-                    self.log("Checking page colors...")
-                time.sleep(0.5)
-            result_check_img = checkimg_pool_map.get()
-            if all(result_check_img):
-                self.log("No color pages detected. Smart mode will use 'best' preset.")
-                self.user_convert_params = "best"
-            else:
-                self.log("Color pages detected. Smart mode will use 'jpeg' preset.")
-                self.user_convert_params = "jpeg"
-        #
-        if self.user_convert_params == "fast":
+        if preset == "fast":
             convert_params = preset_fast
-        elif self.user_convert_params == "best":
+        elif preset == "best":
             convert_params = preset_best
-        elif self.user_convert_params == "grayscale":
+        elif preset == "grayscale":
             convert_params = preset_grayscale
-        elif self.user_convert_params == "jpeg":
+        elif preset == "jpeg":
             convert_params = preset_jpeg
-        elif self.user_convert_params == "jpeg2000":
+        elif preset == "jpeg2000":
             convert_params = preset_jpeg2000
         else:
-            convert_params = self.user_convert_params
+            convert_params = preset
         # Handle default case
         if convert_params == "":
             convert_params = preset_best
+        return convert_params
+
+    def rebuild_pages(self):
+        """
+        Rebuild PDF pages from images.
+        :return: list of rebuilt PDF files, one per page
+        """
+        eprint("Warning: metadata wiped from final PDF file (original file is not an unprotected PDF / "
+               "forcing rebuild from extracted images / using deskew)")
         #
-        self.log("Rebuilding PDF from images")
-        rebuild_pool_map = self.main_pool.starmap_async(do_rebuild,
-                                                        zip(rebuild_list,
-                                                            itertools.repeat(self.path_convert),
-                                                            itertools.repeat(convert_params),
-                                                            itertools.repeat(self.tmp_dir),
-                                                            itertools.repeat(self.shell_mode)))
-        rebuild_wait_rounds = 0
-        while not rebuild_pool_map.ready() and (self.main_pool is not None):
-            rebuild_wait_rounds += 1
-            pages_processed = len(glob.glob(self.tmp_dir + "REBUILD_" + self.prefix + "*.pdf"))
-            if rebuild_wait_rounds % 10 == 0:
-                self.log("Waiting for PDF rebuild to complete. {0}/{1} pages completed...".format(pages_processed, self.input_file_number_of_pages))
-            time.sleep(0.5)
+        # Without "smart" preset, pages were already rebuilt by the page pipeline
+        if self.user_convert_params == "smart":
+            rebuild_list = sorted(glob.glob(self.tmp_dir + self.prefix + "*." + self.extension_images))
+            if all(self.pages_greyscale):
+                self.log("No color pages detected. Smart mode will use 'best' preset.")
+                self.user_convert_params = "best"
+            else:
+                self.log("Color pages detected. Smart mode will use 'jpeg' preset.")
+                self.user_convert_params = "jpeg"
+            convert_params = self.get_convert_params()
+            # Pages rebuilt by an interrupted run of this job
+            rebuild_list = [image_file for image_file in rebuild_list if os.path.basename(image_file) not in self.resumed_rebuilt_images]
+            #
+            self.log("Rebuilding PDF from images")
+            self.pool_busy = True
+            pending_rebuild = collections.deque(rebuild_list)
+            tasks_running = 0
+            pages_processed = 0
+            last_progress_time = time.time()
+            while pages_processed < len(rebuild_list):
+                while len(pending_rebuild) > 0 and (tasks_running == 0 or tasks_running < self.concurrency):
+                    self._submit_task("rebuild", do_rebuild, (pending_rebuild.popleft(), self.path_convert, convert_params, self.tmp_dir,
+                                                              self.shell_mode, self.page_timeout, self.get_convert_params("fast")))
+                    tasks_running += 1
+                self.adjust_concurrency(tasks_running)
+                task_kind, task_args, task_value, task_error = self._wait_task()
+                tasks_running -= 1
+                if task_error is not None:
+                    self.cleanup()
+                    raise Pdf2PdfOcrException("Error rebuilding PDF from images: {0}".format(task_error))
+                if task_value is not None:
+                    self.pages_degraded.setdefault(self.get_page_number(task_args[0]), []).append(task_value)
+                self.write_journal({"stage": "rebuild", "image_file": os.path.basename(task_args[0])})
+                pages_processed += 1
+                if time.time() - last_progress_time >= 5:
+                    last_progress_time = time.time()
+                    self.log("Waiting for PDF rebuild to complete. {0}/{1} pages completed...".format(pages_processed,
+                                                                                                      self.input_file_number_of_pages))
+            self.pool_busy = False
+        elif self.user_convert_params == "mixed":
+            self.log("{0} color pages rebuilt with 'jpeg' preset, other pages with 'best' preset".format(self.pages_greyscale.count(False)))
         #
-        rebuilt_pdf_file_list = sorted(glob.glob(self.tmp_dir + "REBUILD_{0}*.pdf".format(self.prefix)))
+        rebuilt_pdf_file_list = [page_file for page_file in self.get_page_files_by_suffix(".pdf", "REBUILD_") if os.path.isfile(page_file)]
         self.debug("We have {0} rebuilt PDF files".format(len(rebuilt_pdf_file_list)))
-        if len(rebuilt_pdf_file_list) > 0:
-            pdf_merger = PyPDF2.PdfMerger()
-            for rebuilt_pdf_file in rebuilt_pdf_file_list:
-                pdf_merger.append(PyPDF2.PdfReader(rebuilt_pdf_file, strict=False))
-            pdf_merger.write(self.tmp_dir + self.prefix + "-input_unprotected.pdf")
-            pdf_merger.close()
-        else:
+        if len(rebuilt_pdf_file_list) == 0:
             self.cleanup()
             raise Pdf2PdfOcrException("No PDF files generated after image rebuilding. This is not expected. Aborting.")
         self.debug("PDF rebuilding completed")
-        #
-        if not self.ocr_ignored:
-            self._merge_ocr((self.tmp_dir + self.prefix + "-input_unprotected.pdf"),
-                            (self.tmp_dir + self.prefix + "-ocr.pdf"),
-                            (self.tmp_dir + self.prefix + "-OUTPUT.pdf"), "rebuild-merge")
-        else:
-            shutil.copyfile((self.tmp_dir + self.prefix + "-input_unprotected.pdf"), (self.tmp_dir + self.prefix + "-OUTPUT.pdf"))
+        return rebuilt_pdf_file_list
 
-    def try_repair_input_and_merge(self):
+    def repair_input(self):
+        """
+        Rewrite input PDF with ghostscript, used when merge with OCR text fails.
+        :return: repaired PDF file
+        """
         self.debug("Fail to merge source PDF with extracted OCR text. Trying to fix source PDF to build final file...")
-        prepair1 = subprocess.Popen(
+        prepair1 = self.start_process(
             [self.path_pdf2ps, self.input_file, self.tmp_dir + self.prefix + "-fixPDF.ps"],
             stdout=subprocess.DEVNULL,
             stderr=open(self.tmp_dir + "err_pdf2ps-{0}.log".format(self.prefix), "wb"),
             shell=self.shell_mode)
         prepair1.wait()
-        prepair2 = subprocess.Popen([self.path_ps2pdf, self.tmp_dir + self.prefix + "-fixPDF.ps",
-                                     self.tmp_dir + self.prefix + "-fixPDF.pdf"],
-                                    stdout=subprocess.DEVNULL,
-                                    stderr=open(self.tmp_dir + "err_ps2pdf-{0}.log".format(self.prefix),
-                                                "wb"), shell=self.shell_mode)
+        prepair2 = self.start_process([self.path_ps2pdf, self.tmp_dir + self.prefix + "-fixPDF.ps",
+                                       self.tmp_dir + self.prefix + "-fixPDF.pdf"],
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=open(self.tmp_dir + "err_ps2pdf-{0}.log".format(self.prefix),
+                                                  "wb"), shell=self.shell_mode)
         prepair2.wait()
-        #
-        self._merge_ocr((self.tmp_dir + self.prefix + "-fixPDF.pdf"),
-                        (self.tmp_dir + self.prefix + "-ocr.pdf"),
-                        (self.tmp_dir + self.prefix + "-OUTPUT.pdf"), "repair_input")
+        return self.tmp_dir + self.prefix + "-fixPDF.pdf"
 
     def create_text_output(self):
         # Create final text output
         if self.create_text_mode:
-            text_files = sorted(glob.glob(self.tmp_dir + self.prefix + "*.txt"))
+            text_files = [page_file for page_file in self.get_page_files_by_suffix(".txt") if os.path.isfile(page_file)]
             text_io_wrapper = open(self.output_file_text, 'wb')
             with text_io_wrapper as outfile:
                 for fname in text_files:
@@ -936,206 +2543,626 @@ This software is free, but if you like it, please donate to support new features
                         outfile.write(infile.read())
             #
             text_io_wrapper.close()
+            self.remove_merged_temps(text_files)
             #
             self.log("Created final text file")
 
-    def join_ocred_pdf(self):
-        # Join PDF files into one file that contains all OCR "backgrounds"
-        text_pdf_file_list = sorted(glob.glob(self.tmp_dir + "{0}*.{1}".format(self.prefix, "pdf")))
-        self.debug("We have {0} ocr'ed files".format(len(text_pdf_file_list)))
-        if len(text_pdf_file_list) > 0:
-            pdf_merger = PyPDF2.PdfMerger()
-            for text_pdf_file in text_pdf_file_list:
-                pdf_merger.append(PyPDF2.PdfReader(text_pdf_file, strict=False))
-            pdf_merger.write(self.tmp_dir + self.prefix + "-ocr.pdf")
-            pdf_merger.close()
-        else:
-            self.cleanup()
-            raise Pdf2PdfOcrException("No PDF files generated after OCR. This is not expected. Aborting.")
-        #
-        self.debug("Joined ocr'ed PDF files")
-
-    def external_ocr(self, image_file_list):
+    def remove_merged_temps(self, page_files):
+        # Per page files are not needed after merge. With a resume dir, they are kept until the job is completed, as the journal
+        # refers to them (the work dir is removed then)
+        if self.delete_temps and self.journal_file is None:
+            for page_file in page_files:
+                Pdf2PdfOcr.best_effort_remove(page_file)
+
+    def get_page_settings(self, input_file_for_images):
+        """Settings used by 'do_process_pages' (a dict, as it will be sent to other processes)"""
+        convert_params = None
+        page_convert_params = None
+        if self.rebuild_pdf_from_images:
+            if self.user_convert_params == "mixed":
+                # Greyscale check result -> convert params, so each page is rebuilt as soon as its colors are checked
+                page_convert_params = {True: self.get_convert_params("best"), False: self.get_convert_params("jpeg")}
+            elif self.user_convert_params != "smart":
+                convert_params = self.get_convert_params()
+        # Tesseract detects orientation while doing OCR in these page segmentation modes, so it's read from HOCR (unless
+        # it's needed before OCR)
+        autorotate_from_hocr = self.ocr_engine == "tesseract" and self.tess_psm in ["1", "12"] and not self.rotate_before_ocr
+        extra_ocr_flag = self.extra_ocr_flag
+        if self.use_autorotate and autorotate_from_hocr and self.text_generation_strategy != "native":
+            extra_ocr_flag = " ".join(flag for flag in [self.extra_ocr_flag, "-c tessedit_create_hocr=1"] if flag)
+        return {
+            "ocr_engine": self.ocr_engine,
+            "tmp_dir": self.tmp_dir,
+            "shell_mode": self.shell_mode,
+            "image_resolution": self.get_raster_resolution(input_file_for_images),
+            "full_image_resolution": self.image_resolution,
+            "blank_threshold": self.blank_threshold,
+            "pages_selection": self.pages_selection,
+            "raster_in_memory": self.use_raster_in_memory(input_file_for_images),
+            "use_autorotate": self.use_autorotate,
+            "autorotate_from_hocr": autorotate_from_hocr,
+            "rotate_before_ocr": self.rotate_before_ocr,
+            "osd_resolution": self.osd_resolution,
+            "osd_min_confidence": self.osd_min_confidence,
+            "use_deskew_mode": self.use_deskew_mode,
+            "deskew_threshold": self.deskew_threshold,
+            "deskew_min_angle": self.deskew_min_angle,
+            "deskew_max_angle": self.deskew_max_angle,
+            # Without rebuild, original page images are kept, so OCR text goes back to their geometry
+            "deskew_text_back": not self.rebuild_pdf_from_images,
+            "rebuild_pdf_from_images": self.rebuild_pdf_from_images,
+            "page_timeout": self.page_timeout,
+            "degraded_resolution": min(self.degraded_resolution, self.get_raster_resolution(input_file_for_images)),
+            "degraded_tess_psm": self.degraded_tess_psm,
+            "degraded_convert_params": self.get_convert_params("fast"),
+            "tess_langs": self.tess_langs,
+            "tess_psm": self.tess_psm,
+            "extra_ocr_flag": extra_ocr_flag,
+            "adaptive_confidence": self.adaptive_confidence,
+            # First pass needs HOCR for word confidences, whatever the text generation strategy
+            "adaptive_ocr_flag": " ".join(flag for flag in [self.adaptive_ocr_flag, "-c tessedit_create_hocr=1"] if flag),
+            "text_generation_strategy": self.text_generation_strategy,
+            "text_per_line": self.text_per_line,
+            "delete_temps": self.delete_temps,
+            "tesseract_version": self.tesseract_version,
+            "tesseract_can_textonly_pdf": self.tesseract_can_textonly_pdf,
+            "path_tesseract": self.path_tesseract,
+            "path_cuneiform": self.path_cuneiform,
+            "path_mogrify": self.path_mogrify,
+            "path_convert": self.path_convert,
+            "check_greyscale": self.rebuild_pdf_from_images and self.user_convert_params in ["smart", "mixed"],
+            "convert_params": convert_params,
+            "page_convert_params": page_convert_params,
+            "path_pdftoppm": self.path_pdftoppm,
+            "input_file_for_images": input_file_for_images,
+            "prefix": self.prefix,
+            "cache": self.session.cache,
+            # Everything (besides image content) that changes OCR output
+            "ocr_cache_key": (self.ocr_engine, self.tess_langs, self.tess_psm, self.extra_ocr_flag, self.text_generation_strategy,
+                              self.text_per_line, self.tesseract_can_textonly_pdf, self.tesseract_version, self.adaptive_confidence,
+                              self.adaptive_resolution, self.adaptive_ocr_flag),
+        }
+
+    def process_pages(self):
+        """
+        Page pipeline: each page goes through blank check, autorotate info, deskew, OCR and rebuild as soon as it is
+        rasterized, while the next pages are still being rasterized. Rasterization stops when too many pages are waiting.
+        Pages are processed in chunks of 'ocr_batch' pages, so one tesseract process can OCR many pages.
+        """
         if self.ocr_engine in ["cuneiform", "tesseract"]:
             self.log("Starting OCR with {0}...".format(self.ocr_engine))
-            image_list_for_external_ocr = [x for x in image_file_list if x not in self.blank_pages]
-            if self.ocr_engine == "cuneiform":
-                ocr_pool_map = self.main_pool.starmap_async(do_ocr_cuneiform,
-                                                            zip(image_list_for_external_ocr,
-                                                                itertools.repeat(self.extra_ocr_flag),
-                                                                itertools.repeat(self.tess_langs),
-                                                                itertools.repeat(self.tmp_dir),
-                                                                itertools.repeat(self.shell_mode),
-                                                                itertools.repeat(self.path_cuneiform)))
-            elif self.ocr_engine == "tesseract":
-                ocr_pool_map = self.main_pool.starmap_async(do_ocr_tesseract,
-                                                            zip(image_list_for_external_ocr,
-                                                                itertools.repeat(self.extra_ocr_flag),
-                                                                itertools.repeat(self.tess_langs),
-                                                                itertools.repeat(self.tess_psm),
-                                                                itertools.repeat(self.tmp_dir),
-                                                                itertools.repeat(self.shell_mode),
-                                                                itertools.repeat(self.path_tesseract),
-                                                                itertools.repeat(self.text_generation_strategy),
-                                                                itertools.repeat(self.delete_temps),
-                                                                itertools.repeat(self.tesseract_can_textonly_pdf)))
-            else:
-                ocr_pool_map = None  # Should never happen
-            #
-            ocr_rounds = 0
-            while not ocr_pool_map.ready() and (self.main_pool is not None):
-                ocr_rounds += 1
-                pages_processed = len(glob.glob(self.tmp_dir + self.prefix + "*.tmp"))
-                if ocr_rounds % 10 == 0:
-                    self.log("Waiting for OCR to complete. {0}/{1} pages completed...".format(pages_processed, self.input_file_number_of_pages))
-                time.sleep(0.5)
-            #
-            if len(self.blank_pages) > 0:
-                for idx, blank_page_img in enumerate(self.blank_pages):
-                    blank_page_dimension = self.blank_pages_dimensions[idx]
-                    pdf_file_img = blank_page_img.replace("." + self.extension_images, ".pdf")
-                    do_create_blank_pdf(pdf_file_img, blank_page_dimension, self.image_resolution)
-            #
-            self.log("OCR completed")
             self.ocr_ignored = False
         else:
             self.log("OCR ignored")
             self.ocr_ignored = True
-
-    def check_blank_pages(self, image_file_list):
-        self.log("Checking blank pages")
-        colors_size_pool_map = self.main_pool.starmap_async(do_check_img_colors_size, zip(image_file_list))
-        while not colors_size_pool_map.ready() and (self.main_pool is not None):
-            time.sleep(0.5)
-        blank_map_values = colors_size_pool_map.get()
-        for idx, t_image in enumerate(image_file_list):
-            color_size_info = blank_map_values[idx]
-            is_blank = (color_size_info[0] is not None) and (len(color_size_info[0]) == 1)
-            if is_blank:
-                self.blank_pages.append(t_image)
-                self.blank_pages_dimensions.append(color_size_info[1])
-
-    def autorotate_info(self, image_file_list):
-        if self.use_autorotate:
-            self.debug("Calculating autorotate values...")
-            image_list_for_autorotate_info = [x for x in image_file_list if x not in self.blank_pages]
-            autorotate_pool_map = self.main_pool.starmap_async(do_autorotate_info,
-                                                               zip(image_list_for_autorotate_info,
-                                                                   itertools.repeat(self.shell_mode),
-                                                                   itertools.repeat(self.tmp_dir),
-                                                                   itertools.repeat(self.tess_langs),
-                                                                   itertools.repeat(self.path_tesseract),
-                                                                   itertools.repeat(self.tesseract_version)))
-            autorotate_rounds = 0
-            while not autorotate_pool_map.ready() and (self.main_pool is not None):
-                autorotate_rounds += 1
-                pages_processed = len(glob.glob(self.tmp_dir + self.prefix + "*.osd"))
-                if autorotate_rounds % 10 == 0:
-                    self.log("Waiting for autorotate. {0}/{1} pages completed...".format(pages_processed, self.input_file_number_of_pages))
-                time.sleep(0.5)
+        #
+        if self.pages_selection is not None:
+            self.select_pages()
+        if self.skip_text_pages and not self.ocr_ignored:
+            self.find_pages_with_text()
+        if self.journal_file is not None:
+            self.read_journal()
+        input_file_for_images = self.convert_input_to_images()
+        page_settings = self.get_page_settings(input_file_for_images)
+        tasks_running = 0
+        self.pool_busy = True
+        # Work waiting for rasterization: page ranges for pdftoppm or chunks of pages found in cache (or to rasterize in memory)
+        pending_work = collections.deque()
+        # Chunks of images already rasterized (with their raster cache keys), processed before any other work
+        ready_chunks = collections.deque()
+        raster_cache_keys = None
+        if page_settings["raster_in_memory"]:
+            self.extension_images = "pgm"
+            pages_to_process = [page for page in range(1, self.input_file_number_of_pages + 1)
+                                if page not in self.pages_without_ocr and page not in self.resumed_page_results]
+            pending_work.extend(("memory", pages_chunk) for pages_chunk in self.chunks(pages_to_process, self.ocr_batch))
+        elif input_file_for_images is not None:
+            raster_cache_keys = self.get_raster_cache_keys(input_file_for_images)
+            pages_to_rasterize = None
+            if self.input_file_number_of_pages is not None:
+                pages_to_rasterize = []
+                pages_cached = []
+                for page_number in range(1, self.input_file_number_of_pages + 1):
+                    if page_number in self.pages_without_ocr or page_number in self.resumed_page_results:
+                        continue
+                    if raster_cache_keys is not None and self.session.cache.contains(raster_cache_keys[page_number - 1]):
+                        pages_cached.append(page_number)
+                    else:
+                        pages_to_rasterize.append(page_number)
+                pending_work.extend(("cached", pages_chunk) for pages_chunk in self.chunks(pages_cached, self.ocr_batch))
+            page_ranges = self.calculate_ranges(pages_to_rasterize)
+            if page_ranges is not None:
+                pending_work.extend(("pdftoimage", page_range) for page_range in page_ranges)
+            else:
+                # Without page info, only alternative is going sequentialy (without range)
+                pending_work.append(("pdftoimage", None))
+        else:
+            self.set_number_of_pages(self.number_of_images)
+            image_file_list = [self.get_page_image_file(page) for page in range(1, self.number_of_images + 1)
+                               if page not in self.resumed_page_results]
+            ready_chunks.extend((image_files_chunk, None) for image_files_chunk in self.chunks(image_file_list, self.ocr_batch))
+        #
+        self.start_concurrency(input_file_for_images, page_settings["image_resolution"])
+        page_results = list(self.resumed_page_results.values())
+        if len(page_results) > 0:
+            self.log("Resuming job. {0} pages were already processed".format(len(page_results)))
+        pages_in_flight = 0
+        images_in_flight_bytes = dict()
+        bytes_in_flight = 0
+        last_progress_time = time.time()
+        while len(pending_work) > 0 or len(ready_chunks) > 0 or tasks_running > 0:
+            while len(ready_chunks) > 0 and (tasks_running == 0 or tasks_running < self.concurrency):
+                image_files_chunk, chunk_raster_cache_keys = ready_chunks.popleft()
+                self._submit_task("page", do_process_pages, (image_files_chunk, page_settings, chunk_raster_cache_keys))
+                tasks_running += 1
+            while len(pending_work) > 0 and (tasks_running == 0 or (
+                    tasks_running < self.concurrency and pages_in_flight < self.max_pages_in_flight and (
+                    self.max_bytes_in_flight is None or bytes_in_flight < self.max_bytes_in_flight))):
+                work_kind, work_pages = pending_work.popleft()
+                if work_kind == "cached":
+                    pages_in_flight += len(work_pages)
+                    self._submit_task("page", do_process_pages, ([self.get_page_image_file(page) for page in work_pages], page_settings,
+                                                                 [raster_cache_keys[page - 1] for page in work_pages],
+                                                                 [True] * len(work_pages)))
+                elif work_kind == "memory":
+                    # Pages are rasterized by the same task that process them
+                    pages_in_flight += len(work_pages)
+                    self._submit_task("page", do_process_pages, ([self.get_page_image_file(page) for page in work_pages], page_settings))
+                elif work_kind == "raster_again":
+                    # Pages already counted with their range
+                    self._submit_task("page", do_process_pages, ([self.get_page_image_file(page) for page in work_pages], page_settings,
+                                                                 None, None, True))
+                else:
+                    range_timeout = None
+                    if work_pages is not None:
+                        pages_in_flight += (work_pages[1] - work_pages[0]) + 1
+                        if self.page_timeout is not None:
+                            range_timeout = self.page_timeout * ((work_pages[1] - work_pages[0]) + 1)
+                    self._submit_task("pdftoimage", do_pdftoimage, (self.path_pdftoppm, work_pages, input_file_for_images,
+                                                                    page_settings["image_resolution"], self.tmp_dir, self.prefix,
+                                                                    self.shell_mode, range_timeout))
+                tasks_running += 1
             #
+            self.adjust_concurrency(tasks_running)
+            task_kind, task_args, task_value, task_error = self._wait_task()
+            tasks_running -= 1
+            if task_error is not None:
+                self.cleanup()
+                raise Pdf2PdfOcrException("Error processing pages: {0}".format(task_error))
+            if task_kind == "pdftoimage":
+                return_code, image_files = task_value
+                if return_code is None:
+                    # Killed by page timeout. Pages not rasterized are rasterized again one by one (see 'do_process_pages')
+                    rasterized_pages = {self.get_page_number(image_file) for image_file in image_files}
+                    missing_pages = [page for page in range(task_args[1][0], task_args[1][1] + 1) if page not in rasterized_pages]
+                    self.debug("Pages {0} not rasterized in time".format(missing_pages))
+                    pending_work.extend(("raster_again", [page]) for page in missing_pages)
+                elif return_code != 0:
+                    self.cleanup()
+                    raise Pdf2PdfOcrException("Fail to create images from PDF. Exiting.")
+                if task_args[1] is None:
+                    self.set_number_of_pages(len(image_files))
+                    pages_in_flight += len(image_files)
+                for image_file in image_files:
+                    images_in_flight_bytes[image_file] = os.path.getsize(image_file)
+                    bytes_in_flight += images_in_flight_bytes[image_file]
+                for image_files_chunk in self.chunks(image_files, self.ocr_batch):
+                    chunk_raster_cache_keys = None
+                    if raster_cache_keys is not None:
+                        chunk_raster_cache_keys = [raster_cache_keys[self.get_page_number(image_file) - 1] for image_file in image_files_chunk]
+                    ready_chunks.append((image_files_chunk, chunk_raster_cache_keys))
+            else:
+                # Progress is counted by page, even when many pages are processed together
+                pages_in_flight -= len(task_value)
+                for page_result in task_value:
+                    bytes_in_flight -= images_in_flight_bytes.pop(page_result["image_file"], 0)
+                page_results.extend(task_value)
+                if self.journal_file is not None:
+                    for page_result in task_value:
+                        self.write_journal({"stage": "page", "result": page_result, "files": self.get_page_files(page_result["image_file"])})
+                if time.time() - last_progress_time >= 5:
+                    last_progress_time = time.time()
+                    self.log("Waiting for pages to be processed. {0}/{1} pages completed...".format(
+                        len(page_results), self.input_file_number_of_pages - len(self.pages_without_ocr)))
+        self.pool_busy = False
+        #
+        page_results.sort(key=lambda page_result: page_result["image_file"])
+        for page_result in page_results:
+            for cache_kind, cache_status in page_result["cache"].items():
+                if cache_status is not None:
+                    self.cache_stats[cache_kind + "_" + cache_status] += 1
+            if page_result["blank"]:
+                self.blank_pages.append(page_result["image_file"])
+                self.blank_pages_dimensions.append(page_result["dimensions"])
+            self.pages_greyscale.append(page_result["greyscale"])
+            if page_result["rotated_before_ocr"] != 0:
+                self.pages_rotated_before_ocr[self.get_page_number(page_result["image_file"])] = page_result["rotated_before_ocr"]
+            if page_result["deskew_angle"] != 0:
+                self.debug("Page {0} deskewed by {1} degrees".format(self.get_page_number(page_result["image_file"]),
+                                                                     page_result["deskew_angle"]))
+            if len(page_result["degraded"]) > 0:
+                self.pages_degraded[self.get_page_number(page_result["image_file"])] = list(page_result["degraded"])
+            if page_result["empty_text"]:
+                self.pages_empty_text.add(self.get_page_number(page_result["image_file"]))
+        self.debug("{0} blank pages detected".format(len(self.blank_pages)))
+        adaptive_results = [page_result["adaptive"] for page_result in page_results if page_result["adaptive"] is not None]
+        if len(adaptive_results) > 0:
+            self.log_adaptive_ocr(adaptive_results)
+        #
+        if not self.ocr_ignored:
+            self.log("OCR completed")
 
-    def autorotate_final_output(self):
-        param_source_file = self.tmp_dir + self.prefix + "-OUTPUT.pdf"
-        param_dest_file = self.tmp_dir + self.prefix + "-OUTPUT-ROTATED.pdf"
-        # method "autorotate_info" generated these OSD files
-        list_osd = sorted(glob.glob(self.tmp_dir + "{0}*.{1}".format(self.prefix, "osd")))
-        skip_autorotate = False
-        if self.use_autorotate and (len(list_osd) != self.input_file_number_of_pages):
-            eprint("Skipping autorotation because OSD files were not correctly generated. Check input file and "
-                   "tesseract logs")
-            skip_autorotate = True
+    def get_raster_resolution(self, input_file_for_images):
+        """Resolution of page images. Adaptive OCR rasterizes PDF pages in lower resolution, unless images are used to rebuild PDF"""
+        if self.adaptive_confidence is None or input_file_for_images is None or self.rebuild_pdf_from_images:
+            return self.image_resolution
+        return min(self.adaptive_resolution, self.image_resolution)
+
+    def log_degraded_pages(self):
+        """Report pages degraded by page timeout (cheaper settings or no OCR text)"""
+        if len(self.pages_degraded) == 0:
+            return
+        eprint("Warning: {0} pages degraded by page timeout of {1} seconds:".format(len(self.pages_degraded), self.page_timeout))
+        for page_number, degraded_notes in sorted(self.pages_degraded.items()):
+            eprint("    page {0}: {1}".format(page_number, ", ".join(degraded_notes)))
+
+    def log_adaptive_ocr(self, adaptive_results):
+        escalated_results = [adaptive_result for adaptive_result in adaptive_results if adaptive_result["escalated"]]
+        first_pass_seconds = sum(adaptive_result["first_pass_seconds"] for adaptive_result in adaptive_results)
+        full_pass_seconds = sum(adaptive_result["full_pass_seconds"] for adaptive_result in escalated_results)
+        self.log("Adaptive OCR: {0} of {1} pages escalated (word confidence below {2})".format(len(escalated_results), len(adaptive_results),
+                                                                                             self.adaptive_confidence))
+        if len(escalated_results) == 0:
+            self.log("Adaptive OCR: no page needed full OCR. First pass took {0:.1f} seconds (sum of all workers)".format(first_pass_seconds))
+            return
+        # Time of full OCR for all pages is estimated with the time of pages that were escalated
+        full_page_seconds = full_pass_seconds / len(escalated_results)
+        saved_seconds = full_page_seconds * len(adaptive_results) - first_pass_seconds - full_pass_seconds
+        self.log("Adaptive OCR: about {0:.1f} seconds saved (sum of all workers, full OCR estimated in {1:.2f} seconds per page)".format(
+            saved_seconds, full_page_seconds))
+
+    def use_raster_in_memory(self, input_file_for_images):
+        """Rasterization in memory (--raster-in-memory) works only when images are not needed after OCR"""
+        if not self.raster_in_memory:
+            return False
+        if input_file_for_images is None or self.rebuild_pdf_from_images or self.input_file_number_of_pages is None:
+            self.debug("Rasterization in memory is not used: images are needed to rebuild PDF")
+            return False
+        if not hasattr(os, "memfd_create"):
+            eprint("Warning: rasterization in memory is not supported in this platform.")
+            return False
+        return True
+
+    def find_pages_with_text(self):
+        """
+        Find pages that already have native text (e.g. born digital pages in a document with some scanned pages).
+        These pages are not rasterized nor OCR'ed: they get an empty OCR text layer and their native text is used in text output.
+        """
+        if self.input_file_type != "application/pdf" or self.rebuild_pdf_from_images or self.ignore_existing_text or \
+                self.input_file_number_of_pages is None:
+            return
+        pages_with_text = []
+        try:
+            with open(self.input_file, 'rb') as f:
+                pdf_reader = PyPDF2.PdfReader(f, strict=False)
+                for page_number, page in enumerate(pdf_reader.pages, start=1):
+                    if page_number in self.pages_without_ocr:
+                        continue
+                    page_resources = page.get("/Resources")
+                    if page_resources is None or "/Font" not in page_resources.get_object():
+                        continue
+                    page_text = page.extract_text()
+                    # A few characters (e.g. a stamp or page number over a scanned image) don't make a page born digital
+                    if len("".join(page_text.split())) >= self.min_text_page_chars:
+                        pages_with_text.append(page_number)
+                        self.pages_without_ocr[page_number] = page_text
+                        page_file_base = os.path.splitext(self.get_page_image_file(page_number))[0]
+                        do_create_empty_page_pdf(page_file_base + ".pdf", *get_page_size_pt(page))
+                        with open(page_file_base + ".txt", 'wb') as f_text:
+                            f_text.write((page_text + "\f").encode("utf-8"))
+        except Exception as e:
+            eprint("Warning: could not check text of each page ({0}). All pages will be OCR'ed.".format(e))
+            for page_number in pages_with_text:
+                page_file_base = os.path.splitext(self.get_page_image_file(page_number))[0]
+                Pdf2PdfOcr.best_effort_remove(page_file_base + ".pdf")
+                Pdf2PdfOcr.best_effort_remove(page_file_base + ".txt")
+                del self.pages_without_ocr[page_number]
+            pages_with_text = []
+        self.log("{0} pages already have text and will not be OCR'ed".format(len(pages_with_text)))
+
+    def select_pages(self):
+        """
+        Pages selected for OCR by user (--pages). Without PDF rebuild, other pages are not rasterized and get an empty OCR
+        text layer. When PDF is rebuilt from images, they are rasterized only to be rebuilt (see 'do_prepare_page').
+        """
+        if self.input_file_type != "application/pdf" or self.rebuild_pdf_from_images or self.input_file_number_of_pages is None:
+            return
+        with open(self.input_file, 'rb') as f:
+            pdf_reader = PyPDF2.PdfReader(f, strict=False)
+            for page_number, page in enumerate(pdf_reader.pages, start=1):
+                if not any(first <= page_number and (last is None or page_number <= last) for first, last in self.pages_selection):
+                    self.pages_without_ocr[page_number] = None
+                    page_file_base = os.path.splitext(self.get_page_image_file(page_number))[0]
+                    do_create_empty_page_pdf(page_file_base + ".pdf", *get_page_size_pt(page))
+        self.log("{0} of {1} pages selected for OCR".format(self.input_file_number_of_pages - len(self.pages_without_ocr),
+                                                            self.input_file_number_of_pages))
+
+    def start_concurrency(self, input_file_for_images, image_resolution):
+        """
+        Number of page tasks to start with: CPUs to use, limited by available memory for the estimated memory of each task,
+        from the size of first page image.
+        """
+        try:
+            if input_file_for_images is not None:
+                with open(input_file_for_images, 'rb') as f:
+                    page = PyPDF2.PdfReader(f, strict=False).pages[0]
+                    page_pixels = float(page.mediabox.width) * float(page.mediabox.height) * (image_resolution / 72.0) ** 2
+            else:
+                with Image.open(self.get_page_image_file(1)) as im:
+                    page_pixels = im.width * im.height
+        except Exception as e:
+            self.debug("Page size unknown to estimate memory of page tasks: {0}".format(e))
+            return
+        self.task_memory = self.worker_base_memory + page_pixels * self.task_memory_per_pixel
+        memory_concurrency = int(Pdf2PdfOcrSession.get_available_memory() * (1 - self.memory_reserve) / self.task_memory)
+        self.concurrency = max(1, min(self.cpu_to_use, memory_concurrency))
+        self.debug("Page tasks estimated in {0:.0f} MB each. Starting with {1} page tasks at once".format(
+            self.task_memory / (1024 * 1024), self.concurrency))
+
+    def measure_workers(self):
+        """
+        Memory (bytes) of the largest worker with its tools, memory of all workers with their tools and CPU seconds used by them
+        since last measure. Workers and tools may finish while they are measured, so measures are approximate.
+        """
+        largest_worker_memory = 0
+        workers_memory = 0
+        workers_cpu_seconds = dict()
+        for worker in self.session.get_workers():
+            try:
+                tools = worker.children(recursive=True)
+                worker_memory = worker.memory_info().rss
+                # CPU time of a worker includes its tools already finished
+                worker_cpu_seconds = {worker.pid: (sum(worker.cpu_times()[:4]), False)}
+                for tool in tools:
+                    worker_memory += tool.memory_info().rss
+                    worker_cpu_seconds[tool.pid] = (sum(tool.cpu_times()[:2]), True)
+            except psutil.Error:
+                continue
+            largest_worker_memory = max(largest_worker_memory, worker_memory)
+            workers_memory += worker_memory
+            workers_cpu_seconds.update(worker_cpu_seconds)
+        cpu_seconds = 0.0
+        for pid, (process_cpu_seconds, is_tool) in workers_cpu_seconds.items():
+            cpu_seconds += process_cpu_seconds - self.workers_cpu_seconds.get(pid, (0.0, is_tool))[0]
+        for pid, (process_cpu_seconds, is_tool) in self.workers_cpu_seconds.items():
+            if is_tool and pid not in workers_cpu_seconds:
+                cpu_seconds -= process_cpu_seconds  # Now counted in CPU time of its worker
+        self.workers_cpu_seconds = workers_cpu_seconds
+        return largest_worker_memory, workers_memory, max(0.0, cpu_seconds)
+
+    def adjust_concurrency(self, tasks_running):
+        """
+        Adjust number of page tasks running at once with measures of workers (and their tools): fewer tasks when pages are large or
+        memory is tight, more tasks (up to pool size) when tasks are waiting on I/O, and back to CPUs to use when they are not.
+        """
+        check_time = time.perf_counter()
+        if self.last_concurrency_check is not None and check_time - self.last_concurrency_check < self.concurrency_check_seconds:
+            return
+        elapsed_seconds = None if self.last_concurrency_check is None else check_time - self.last_concurrency_check
+        self.last_concurrency_check = check_time
+        try:
+            largest_worker_memory, workers_memory, cpu_seconds = self.measure_workers()
+            available_memory = Pdf2PdfOcrSession.get_available_memory()
+        except (psutil.Error, OSError, ValueError) as e:
+            self.debug("Fail to measure workers: {0}".format(e))
+            return
         #
-        if self.use_autorotate and not skip_autorotate:
-            self.debug("Autorotate final output")
-            file_source = open(param_source_file, 'rb')
-            pre_output_pdf = PyPDF2.PdfReader(file_source, strict=False)
-            final_output_pdf = PyPDF2.PdfWriter()
-            rotation_angles = []
-            osd_page_num = 0
-            for osd_information_file in list_osd:
-                with open(osd_information_file, 'r') as f:
-                    osd_information_string = '[root]\n' + f.read()  # A dummy section to satisfy ConfigParser
-                f.close()
-                osd_page_num += 1
-                config_osd = configparser.ConfigParser()
-                config_osd.read_file(io.StringIO(osd_information_string))
-                try:
-                    rotate_value = config_osd.getint('root', 'Rotate')
-                except configparser.NoOptionError:
-                    self.log("WARN: error reading rotate page value from page {0}. Assuming zero as rotation angle.".format(osd_page_num))
-                    rotate_value = 0
-                rotation_angles.append(rotate_value)
-            #
-            for i in range(len(pre_output_pdf.pages)):
-                page = pre_output_pdf.pages[i]
-                page.rotateClockwise(rotation_angles[i])
-                final_output_pdf.addPage(page)
-            #
-            with open(param_dest_file, 'wb') as f:
-                final_output_pdf.write(f)
-                f.close()
-            #
-            file_source.close()
-        else:
-            # No autorotate, just rename the file to next method process correctly
-            self.debug("Autorotate skipped")
-            os.rename(param_source_file, param_dest_file)
-
-    def deskew(self, image_file_list):
-        if self.use_deskew_mode:
-            self.debug("Applying deskew (will rebuild final PDF file)")
-            image_list_for_deskew = [x for x in image_file_list if x not in self.blank_pages]
-            deskew_pool_map = self.main_pool.starmap_async(do_deskew, zip(image_list_for_deskew, itertools.repeat(self.deskew_threshold),
-                                                                          itertools.repeat(self.shell_mode), itertools.repeat(self.path_mogrify)))
-            deskew_wait_rounds = 0
-            while not deskew_pool_map.ready() and (self.main_pool is not None):
-                deskew_wait_rounds += 1
-                # noinspection PyProtectedMember
-                pages_processed = len([x for x in deskew_pool_map._value if x is not None])
-                if deskew_wait_rounds % 10 == 0:
-                    self.log("Waiting for deskew to complete. {0}/{1} pages completed...".format(pages_processed, self.input_file_number_of_pages))
-                time.sleep(0.5)
+        cpu_concurrency = max(self.concurrency, self.cpu_to_use)
+        if elapsed_seconds is not None and tasks_running > 0 and tasks_running >= self.concurrency:
+            cpus_used = cpu_seconds / elapsed_seconds
+            if cpus_used / tasks_running < self.io_wait_cpu_per_task and cpus_used < self.cpu_to_use:
+                cpu_concurrency = min(self.session.max_workers, max(self.cpu_to_use, self.concurrency + 1))
+            else:
+                cpu_concurrency = self.cpu_to_use
+        # Memory of a task is the largest measured recently, as tasks running now may be in a stage using less memory
+        if tasks_running > 0 and largest_worker_memory > 0:
+            self.task_memory = max(largest_worker_memory, 0.9 * (self.task_memory or 0))
+        memory_concurrency = cpu_concurrency
+        if self.task_memory is not None:
+            # Memory used now by workers is available to page tasks
+            memory_concurrency = int((available_memory + workers_memory) * (1 - self.memory_reserve) / self.task_memory)
+        #
+        concurrency = max(1, min(cpu_concurrency, memory_concurrency))
+        if concurrency != self.concurrency:
+            self.debug("Running {0} page tasks at once (was {1}). Task memory {2:.0f} MB, available memory {3:.0f} MB".format(
+                concurrency, self.concurrency, (self.task_memory or 0) / (1024 * 1024), available_memory / (1024 * 1024)))
+            self.concurrency = concurrency
+
+    def _submit_task(self, task_kind, task_function, task_args):
+        if not self.pool_open:
+            raise Pdf2PdfOcrException("Page processing was interrupted")
+        # Results (or errors) are queued as soon as each task finishes
+        self.session.get_pool().apply_async(task_function, task_args,
+                                            callback=lambda value: self.events.put((task_kind, task_args, value, None)),
+                                            error_callback=lambda error: self.events.put((task_kind, task_args, None, error)))
+
+    def _wait_task(self):
+        # Cleanup (timeout or SIGINT) queues None to stop waiting
+        event = self.events.get()
+        if event is None or not self.pool_open:
+            raise Pdf2PdfOcrException("Page processing was interrupted")
+        return event
+
+    @staticmethod
+    def chunks(items, chunk_size):
+        return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    def set_number_of_pages(self, number_of_images):
+        if self.input_file_number_of_pages is None:
+            self.input_file_number_of_pages = number_of_images
+        self.check_avoid_high_pages()
+
+    def get_page_image_file(self, page_number):
+        return self.tmp_dir + "{0}-{1:09d}.{2}".format(self.prefix, page_number, self.extension_images)
+
+    def get_page_files_by_suffix(self, suffix, file_prefix=""):
+        """File of each page with this suffix (e.g. ".pdf" for OCR text), in page order"""
+        return [self.tmp_dir + file_prefix + os.path.splitext(os.path.basename(self.get_page_image_file(page_number)))[0] + suffix
+                for page_number in range(1, self.input_file_number_of_pages + 1)]
+
+    @staticmethod
+    def get_page_number(image_file):
+        return int(os.path.splitext(image_file)[0][-9:])
+
+    def get_job_key(self, args):
+        """Key of a job to be resumed: hash of input file and of options that change output"""
+        job_options = {option: value for option, value in vars(args).items() if option not in self.resume_ignored_options}
+        return Pdf2PdfOcrCache.make_key("job", Pdf2PdfOcrCache.hash_file(self.input_file), json.dumps(job_options, sort_keys=True, default=str))
+
+    def get_page_files(self, image_file):
+        """Files of one page in temp dir (image, OCR text, OSD, rebuilt PDF...) -> size"""
+        image_file_base = os.path.splitext(os.path.basename(image_file))[0]
+        page_files = [os.path.basename(image_file), "REBUILD_" + image_file_base + ".pdf"] + \
+                     [image_file_base + suffix for suffix in [".pdf", ".txt", ".hocr", ".osd"]]
+        return {page_file: os.path.getsize(self.tmp_dir + page_file) for page_file in page_files if os.path.isfile(self.tmp_dir + page_file)}
+
+    def write_journal(self, entry):
+        """Record a completed step of this job (without resume dir, nothing is recorded)"""
+        if self.journal_file is None:
+            return
+        with open(self.journal_file, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            # Journal must survive a host crash, as it will be trusted by next run
+            os.fsync(f.fileno())
+
+    def read_journal(self):
+        """Read steps completed by an interrupted run of this job. Pages with missing or changed files are processed again"""
+        try:
+            with open(self.journal_file, 'r') as f:
+                journal_lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for journal_line in journal_lines:
+            try:
+                entry = json.loads(journal_line)
+            except ValueError:
+                continue  # Last line is incomplete when run was killed while writing it
+            if entry["stage"] == "images":
+                self.number_of_images = entry["number_of_images"]
+            elif entry["stage"] == "page":
+                if all(os.path.isfile(self.tmp_dir + page_file) and os.path.getsize(self.tmp_dir + page_file) == page_file_size
+                       for page_file, page_file_size in entry["files"].items()):
+                    page_result = entry["result"]
+                    page_result["image_file"] = self.tmp_dir + os.path.basename(page_result["image_file"])
+                    page_result["cache"] = {cache_kind: None for cache_kind in page_result["cache"]}
+                    self.resumed_page_results[self.get_page_number(page_result["image_file"])] = page_result
+            elif entry["stage"] == "rebuild":
+                if os.path.isfile(self.tmp_dir + "REBUILD_" + os.path.splitext(entry["image_file"])[0] + ".pdf"):
+                    self.resumed_rebuilt_images.add(entry["image_file"])
+        self.debug("Journal read: {0} pages already processed".format(len(self.resumed_page_results)))
+
+    def get_raster_cache_keys(self, input_file_for_images):
+        """Cache key of each rasterized page (page content hash and resolution), or None without cache or page info"""
+        if self.session.cache is None or input_file_for_images is None or self.input_file_number_of_pages is None:
+            return None
+        try:
+            with open(input_file_for_images, 'rb') as f:
+                pdf_reader = PyPDF2.PdfReader(f, strict=False)
+                if pdf_reader.is_encrypted or len(pdf_reader.pages) != self.input_file_number_of_pages:
+                    return None
+                object_digests = dict()
+                raster_cache_keys = []
+                for page in pdf_reader.pages:
+                    page_hash = hashlib.sha256()
+                    hash_pdf_object(page, page_hash, object_digests)
+                    raster_cache_keys.append(Pdf2PdfOcrCache.make_key("pdftoppm", page_hash.hexdigest(),
+                                                                      self.get_raster_resolution(input_file_for_images),
+                                                                      self.extension_images))
+                return raster_cache_keys
+        except Exception as e:
+            self.debug("Could not calculate page hashes, rasterized pages will not be cached: {0}".format(e))
+            return None
+
+    def get_rotation_angles(self):
+        """
+        Rotation angles of final pages (autorotate) and of image pages before merge with OCR text (pages rotated before OCR).
+        :return: tuple of two lists of angles, each one may be None if pages should not be rotated
+        """
+        rotation_angles = self.get_autorotate_angles()
+        if len(self.pages_rotated_before_ocr) == 0:
+            return rotation_angles, None
+        # OCR text of these pages is upright. Pages rebuilt from rotated images are upright too, other image pages are rotated
+        image_rotation_angles = None if self.rebuild_pdf_from_images else [0] * self.input_file_number_of_pages
+        for page_number, rotation_angle in self.pages_rotated_before_ocr.items():
+            if rotation_angles is not None:
+                rotation_angles[page_number - 1] = 0
+            if image_rotation_angles is not None:
+                image_rotation_angles[page_number - 1] = rotation_angle
+        return rotation_angles, image_rotation_angles
+
+    def get_autorotate_angles(self):
+        """
+        Rotation angle of each page, read from OSD files.
+        :return: list of angles, or None if pages should not be rotated
+        """
+        if not self.use_autorotate:
+            return None
+        # method "autorotate_info" generated these OSD files
+        blank_page_numbers = set(self.get_page_number(blank_page) for blank_page in self.blank_pages)
+        rotation_angles = []
+        for osd_page_num in range(1, self.input_file_number_of_pages + 1):
+            osd_information_file = os.path.splitext(self.get_page_image_file(osd_page_num))[0] + ".osd"
+            if not os.path.isfile(osd_information_file):
+                if osd_page_num in self.pages_without_ocr or osd_page_num in blank_page_numbers or osd_page_num in self.pages_empty_text:
+                    # Pages not OCR'ed (pages with text, not selected, blank or after page timeout) may have no OSD and are kept as they are
+                    rotation_angles.append(0)
+                    continue
+                eprint("Skipping autorotation because OSD files were not correctly generated. Check input file and "
+                       "tesseract logs")
+                return None
+            with open(osd_information_file, 'r') as f:
+                osd_information_string = '[root]\n' + f.read()  # A dummy section to satisfy ConfigParser
+            config_osd = configparser.ConfigParser()
+            config_osd.read_file(io.StringIO(osd_information_string))
+            try:
+                rotate_value = config_osd.getint('root', 'Rotate')
+            except configparser.NoOptionError:
+                self.log("WARN: error reading rotate page value from page {0}. Assuming zero as rotation angle.".format(osd_page_num))
+                rotate_value = 0
+            rotation_angles.append(rotate_value)
+        return rotation_angles
 
     def convert_input_to_images(self):
+        """
+        Prepare input file for rasterization.
+        :return: PDF file to be rasterized with pdftoppm, or None if input is an image already converted to image files
+        """
         self.log("Converting input file to images...")
         if self.input_file_type == "application/pdf":
             input_file_for_images = self.input_file
             if self.ignore_existing_text:
                 input_file_for_images = self.tmp_dir + "_" + self.prefix + "-input_file_for_images.pdf"
                 # Credits for Kurt Pfeifle: https://stackoverflow.com/questions/24322338/remove-all-text-from-pdf-file
-                p_ignore_text = subprocess.Popen([self.path_gs, "-o", input_file_for_images, "-sDEVICE=pdfwrite", "-dFILTERTEXT", self.input_file],
-                                                 stdout=subprocess.DEVNULL,
-                                                 stderr=open(self.tmp_dir + "err_input_file_for_images-{0}.log".format(self.prefix),
-                                                             "wb"), shell=self.shell_mode)
+                p_ignore_text = self.start_process([self.path_gs, "-o", input_file_for_images, "-sDEVICE=pdfwrite", "-dFILTERTEXT", self.input_file],
+                                                   stdout=subprocess.DEVNULL,
+                                                   stderr=open(self.tmp_dir + "err_input_file_for_images-{0}.log".format(self.prefix),
+                                                               "wb"), shell=self.shell_mode)
                 p_ignore_text.wait()
             #
-            parallel_page_ranges = self.calculate_ranges()
-            if parallel_page_ranges is not None:
-                # TODO - try to use method inside this class (encapsulate do_pdftoimage)
-                do_pdftoimage_result_codes = self.main_pool.starmap(do_pdftoimage, zip(itertools.repeat(self.path_pdftoppm),
-                                                                                       parallel_page_ranges,
-                                                                                       itertools.repeat(input_file_for_images),
-                                                                                       itertools.repeat(self.image_resolution),
-                                                                                       itertools.repeat(self.tmp_dir),
-                                                                                       itertools.repeat(self.prefix),
-                                                                                       itertools.repeat(self.shell_mode)))
-            else:
-                # Without page info, only alternative is going sequentialy (without range)
-                do_pdftoimage_result_code = do_pdftoimage(self.path_pdftoppm, None, input_file_for_images, self.image_resolution, self.tmp_dir,
-                                                          self.prefix, self.shell_mode)
-                do_pdftoimage_result_codes = [do_pdftoimage_result_code]
-            #
-            if not all(ret_code == 0 for ret_code in do_pdftoimage_result_codes):
-                self.cleanup()
-                raise Pdf2PdfOcrException("Fail to create images from PDF. Exiting.")
+            return input_file_for_images
         else:
             if self.input_file_type in ["image/tiff", "image/jpeg", "image/png"]:
-                # %09d to format files for correct sort
-                p = subprocess.Popen([self.path_convert, self.input_file, '-quality', '100', '-scene', '1',
-                                      self.tmp_dir + self.prefix + '-%09d.' + self.extension_images],
-                                     shell=self.shell_mode)
-                p.wait()
+                # Images converted by an interrupted run of this job are kept in work dir
+                if self.number_of_images is None:
+                    # %09d to format files for correct sort
+                    p = self.start_process([self.path_convert, self.input_file, '-quality', '100', '-scene', '1',
+                                            self.tmp_dir + self.prefix + '-%09d.' + self.extension_images],
+                                           shell=self.shell_mode)
+                    p.wait()
+                    self.number_of_images = len(glob.glob(self.tmp_dir + "{0}*.{1}".format(self.prefix, self.extension_images)))
+                    self.write_journal({"stage": "images", "number_of_images": self.number_of_images})
+                return None
             else:
                 self.cleanup()
                 raise Pdf2PdfOcrException("{0} is not supported in this script. Exiting.".format(self.input_file_type))
@@ -1144,6 +3171,13 @@ This software is free, but if you like it, please donate to support new features
         Pdf2PdfOcr.best_effort_remove(self.output_file)
         if self.create_text_mode:
             Pdf2PdfOcr.best_effort_remove(self.output_file_text)
+        if self.journal_file is not None:
+            # Files of final stage left by an interrupted run of this job are not in journal, so they are created again
+            for final_stage_file in glob.glob(self.tmp_dir + "ASSEMBLE_*") + glob.glob(self.tmp_dir + self.prefix + "-fixPDF.*"):
+                Pdf2PdfOcr.best_effort_remove(final_stage_file)
+            # Dirs of page ranges being rasterized when it was interrupted (range dirs have the same names in every run of this job)
+            for range_dir in glob.glob(self.tmp_dir + "pdftoppm_{0}-*".format(self.prefix) + os.path.sep):
+                shutil.rmtree(range_dir, ignore_errors=True)
 
     def define_output_files(self):
         if self.force_out_file_mode:
@@ -1170,7 +3204,7 @@ This software is free, but if you like it, please donate to support new features
         try:
             pdf_file_obj = open(self.input_file, 'rb')
             pdf_reader = PyPDF2.PdfReader(pdf_file_obj, strict=False)
-        except PdfReadError:
+        except PyPDF2.errors.PdfReadError:
             self.cleanup()
             raise Pdf2PdfOcrException("Corrupted PDF file detected. Aborting...")
         #
@@ -1214,8 +3248,8 @@ This software is free, but if you like it, please donate to support new features
 
     def check_for_text(self):
         """Check if input file contains text. Actually based on pdffonts from poppler"""
-        ptext = subprocess.Popen([self.path_pdffonts, self.input_file], stdout=subprocess.PIPE,
-                                 stderr=subprocess.DEVNULL, shell=self.shell_mode)
+        ptext = self.start_process([self.path_pdffonts, self.input_file], stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, shell=self.shell_mode)
         ptext_output, ptext_errors = ptext.communicate()
         ptext.wait()
         pdffonts_text_output_lines = ptext_output.decode("utf-8").strip().splitlines()
@@ -1228,117 +3262,42 @@ This software is free, but if you like it, please donate to support new features
 
     def detect_file_type(self):
         """Detect mime type of input file"""
-        pfile = subprocess.Popen([self.path_file, '-b', '--mime-type', self.input_file], stdout=subprocess.PIPE,
-                                 stderr=subprocess.DEVNULL, shell=self.shell_mode)
+        pfile = self.start_process([self.path_file, '-b', '--mime-type', self.input_file], stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, shell=self.shell_mode)
         pfile_output, pfile_errors = pfile.communicate()
         pfile.wait()
         self.input_file_type = pfile_output.decode("utf-8").strip()
         self.log("Input file {0}: type is {1}".format(self.input_file, self.input_file_type))
 
-    def test_convert(self):
-        """
-        test convert command to check if it's ImageMagick
-        :return: True if it's ImageMagicks convert, false with any other case or error
-        """
-        try:
-            result = False
-            test_image = self.tmp_dir + "converttest-" + self.prefix + ".jpg"
-            ptest = subprocess.Popen([self.path_convert, 'rose:', test_image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                                     shell=self.shell_mode)
-            ptest.wait()
-            return_code = ptest.returncode
-            if (return_code == 0) and (os.path.isfile(test_image)):
-                Pdf2PdfOcr.best_effort_remove(test_image)
-                result = True
-            return result
-        except Exception:
-            self.log("Error testing convert utility. Assuming there is no 'convert' available...")
-            return False
-
-    def test_tesseract_textonly_pdf(self):
-        result = False
-        try:
-            result = ('textonly_pdf' in subprocess.check_output([self.path_tesseract, '--print-parameters'], universal_newlines=True))
-        except Exception:
-            self.log("Error checking tesseract capabilities. Trying to continue without 'textonly_pdf' in Tesseract")
-        #
-        self.debug("Tesseract can 'textonly_pdf': {0}".format(result))
-        return result
-
-    def get_tesseract_version(self):
-        # Inspired by the great lib 'pytesseract' - https://github.com/madmaze/pytesseract/blob/master/src/pytesseract.py
-        try:
-            version_info = subprocess.check_output([self.path_tesseract, '--version'], stderr=subprocess.STDOUT).decode('utf-8').split()
-            # self.debug("Tesseract full version info: {0}".format(version_info))
-            version_info = version_info[1].lstrip(string.printable[10:])
-            l_version_info = parse_version(version_info)
-            result = int(l_version_info.base_version.split(".")[0])
-            self.debug("Tesseract version: {0}".format(result))
-            return result
-        except Exception as e:
-            self.log("Error checking tesseract version. Trying to continue assuming legacy version 3. Exception was {0}".format(e))
-            return 3
-
-    def get_qpdf_version(self):
-        try:
-            version_info = subprocess.check_output([self.path_qpdf, '--version'], stderr=subprocess.STDOUT).decode('utf-8').split()
-            version_info = version_info[2]
-            l_version_info = parse_version(version_info)
-            self.debug("Qpdf version: {0}".format(l_version_info))
-            return l_version_info
-        except Exception as e:
-            legacy_version = "8.4.0"
-            self.log("Error checking qpdf version. Trying to continue assuming legacy version {0}. Exception was {1}".format(legacy_version, e))
-            return parse_version(legacy_version)
-
-    def get_pdftoppm_version(self):
-        try:
-            version_info = subprocess.check_output([self.path_pdftoppm, '-v'], stderr=subprocess.STDOUT).decode('utf-8').split()
-            version_info = version_info[2]
-            l_version_info = parse_version(version_info)
-            self.debug("Pdftoppm version: {0}".format(l_version_info))
-            return l_version_info
-        except Exception as e:
-            legacy_version = "0.70.0"
-            self.log("Error checking pdftoppm version. Trying to continue assuming legacy version {0}. Exception was {1}".format(legacy_version, e))
-            return parse_version(legacy_version)
-
-    def calculate_ranges(self):
+    def calculate_ranges(self, page_numbers):
         """
-        calculate ranges to run pdftoppm in parallel. Each CPU available will run well defined page range
+        calculate ranges to run pdftoppm in parallel. Ranges are small, so the first pages reach OCR while the others are
+        still being rasterized
+        :param page_numbers: sorted pages to rasterize (None if number of pages is unknown)
         :return:
         """
-        if (self.input_file_number_of_pages is None) or (self.input_file_number_of_pages < 20):  # 20 to avoid unnecessary parallel operation
+        if page_numbers is None:
             return None
         #
-        range_size = math.ceil(self.input_file_number_of_pages / self.cpu_to_use)
-        number_of_ranges = math.ceil(self.input_file_number_of_pages / range_size)
+        range_size = max(1, min(self.max_pages_per_range, math.ceil(len(page_numbers) / self.cpu_to_use)))
         result = []
-        for i in range(0, number_of_ranges):
-            range_start = (range_size * i) + 1
-            range_end = (range_size * i) + range_size
-            # Handle last range
-            if range_end > self.input_file_number_of_pages:
-                range_end = self.input_file_number_of_pages
-            result.append((range_start, range_end))
+        for page_number in page_numbers:
+            # Start a new range with the first page, a gap in page numbers or a full range
+            if len(result) == 0 or page_number != result[-1][1] + 1 or (result[-1][1] - result[-1][0]) + 1 == range_size:
+                result.append((page_number, page_number))
+            else:
+                result[-1] = (result[-1][0], page_number)
         # Check result
         check_pages = 0
         for created_range in result:
             check_pages += (created_range[1] - created_range[0]) + 1
-        if check_pages != self.input_file_number_of_pages:
+        if check_pages != len(page_numbers):
             raise ArithmeticError("Please check 'calculate_ranges' function, something is wrong...")
         #
         return result
 
-    def edit_producer(self):
-        self.debug("Editing producer")
-        param_source_file = self.tmp_dir + self.prefix + "-OUTPUT-ROTATED.pdf"
-        file_source = open(param_source_file, 'rb')
-        pre_output_pdf = PyPDF2.PdfReader(file_source, strict=False)
-        final_output_pdf = PyPDF2.PdfWriter()
-        for i in range(len(pre_output_pdf.pages)):
-            page = pre_output_pdf.pages[i]
-            final_output_pdf.addPage(page)
+    def get_output_metadata(self):
+        """Metadata of final PDF: input file metadata, with our signature as a producer"""
         info_dict_output = dict()
         # Our signature as a producer
         our_name = "PDF2PDFOCR(github.com/LeoFCardoso/pdf2pdfocr)"
@@ -1348,7 +3307,7 @@ This software is free, but if you like it, please donate to support new features
             for key in self.input_file_metadata:
                 value = self.input_file_metadata[key]
                 if key == producer_key:
-                    if type(value) == ByteStringObject:
+                    if type(value) == PyPDF2.generic.ByteStringObject:
                         value = str(value, errors="ignore")
                         value = "".join(filter(lambda x: x in string.printable, value))  # Try to remove unprintable
                     value = value + "; " + our_name
@@ -1364,14 +3323,7 @@ This software is free, but if you like it, please donate to support new features
         #
         if not read_producer:
             info_dict_output[producer_key] = our_name
-        #
-        final_output_pdf.add_metadata(info_dict_output)
-        #
-        with open(self.output_file, 'wb') as f:
-            final_output_pdf.write(f)
-            f.close()
-        #
-        file_source.close()
+        return info_dict_output
 
     @staticmethod
     def best_effort_remove(filename):
@@ -1382,40 +3334,397 @@ This software is free, but if you like it, please donate to support new features
                 raise  # re-raise exception if a different error occured
 
 
+class Pdf2PdfOcrWatcher(Pdf2PdfOcrLogger):
+    """
+    Find files to process in watch mode: files already in folder and new files, as soon as they are closed (or moved to folder).
+    Uses inotify on Linux and polls the folder on other systems.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    inotify_event = struct.Struct("iIII")  # wd, mask, cookie, len (followed by name)
+
+    poll_interval = 2
+    """Seconds between checks of folder without inotify"""
+
+    def __init__(self, watch_dir, verbose_mode):
+        super().__init__()
+        self.verbose_mode = verbose_mode
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.inotify_fd = self.init_inotify()
+
+    def init_inotify(self):
+        if not sys.platform.startswith("linux"):
+            return None
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            inotify_fd = libc.inotify_init1(os.O_CLOEXEC)
+            if inotify_fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(inotify_fd, os.fsencode(self.watch_dir), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+                os.close(inotify_fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (OSError, AttributeError) as e:
+            self.debug("inotify is not available ({0}). Folder will be checked every {1} seconds".format(e, self.poll_interval))
+            return None
+        return inotify_fd
+
+    def is_candidate(self, file_name):
+        # Hidden files are usually still being written (and renamed when complete)
+        return not file_name.startswith(".") and os.path.isfile(self.watch_dir + os.path.sep + file_name)
+
+    def current_files(self):
+        """Files in folder, oldest first, with size and modification time"""
+        files = []
+        for entry in os.scandir(self.watch_dir):
+            try:
+                if entry.is_file() and not entry.name.startswith("."):
+                    entry_stat = entry.stat()
+                    files.append((entry_stat.st_mtime, entry.name, entry_stat.st_size))
+            except OSError:
+                pass  # Removed meanwhile
+        files.sort()
+        return files
+
+    def settled_files(self, last_check):
+        """
+        Check folder again after poll interval. A file is ready when its size and modification time don't change between two checks.
+        :return: tuple of ready files and this check of files not ready (name -> modification time and size)
+        """
+        time.sleep(self.poll_interval)
+        ready = []
+        this_check = dict()
+        for file_mtime, file_name, file_size in self.current_files():
+            if last_check.get(file_name) == (file_mtime, file_size) and self.is_candidate(file_name):
+                ready.append(self.watch_dir + os.path.sep + file_name)
+            else:
+                this_check[file_name] = (file_mtime, file_size)
+        return ready, this_check
+
+    def ready_files(self):
+        """Generator of files to process. It never ends: waits for new files. Each file should be moved out of folder after processing"""
+        # With inotify, folder is watched before listing current files, so no new file is lost.
+        # Files already in folder may be still being written, so they are checked like polled files (with inotify, files changed
+        # between checks are found when closed)
+        startup_check = {file_name: (file_mtime, file_size) for file_mtime, file_name, file_size in self.current_files()}
+        if self.inotify_fd is not None:
+            if len(startup_check) > 0:
+                startup_files, _ = self.settled_files(startup_check)
+                yield from startup_files
+            yield from self.inotify_files()
+        else:
+            yield from self.polled_files(startup_check)
+
+    def inotify_files(self):
+        while True:
+            events = os.read(self.inotify_fd, 64 * 1024)
+            event_offset = 0
+            while event_offset < len(events):
+                wd, mask, cookie, name_length = self.inotify_event.unpack_from(events, event_offset)
+                event_offset += self.inotify_event.size
+                file_name = os.fsdecode(events[event_offset:event_offset + name_length].rstrip(b"\0"))
+                event_offset += name_length
+                # File could be already processed (listed at start and closed again)
+                if len(file_name) > 0 and self.is_candidate(file_name):
+                    yield self.watch_dir + os.path.sep + file_name
+
+    def polled_files(self, last_check):
+        while True:
+            ready, last_check = self.settled_files(last_check)
+            yield from ready
+
+    @staticmethod
+    def move_file(file_path, dest_dir):
+        """Move processed file to a folder, without overwriting files with the same name"""
+        dest_file = dest_dir + os.path.sep + os.path.basename(file_path)
+        if os.path.exists(dest_file):
+            file_name_no_ext, file_ext = os.path.splitext(os.path.basename(file_path))
+            dest_file = dest_dir + os.path.sep + "{0}-{1}{2}".format(file_name_no_ext, datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"),
+                                                                     file_ext)
+        shutil.move(file_path, dest_file)
+        return dest_file
+
+
+class Pdf2PdfOcrService(Pdf2PdfOcrLogger):
+    """
+    Service mode: OCR jobs are received by HTTP (localhost only) and run by resident sessions, so external tools are checked
+    and worker pools are started only once. Each session runs one job at a time.
+    POST /jobs with JSON {"input_file": "...", "options": ["-o", "...", "-w"]} (options are command line arguments) -> job id
+    GET /jobs/<id> -> job status
+    GET /metrics -> queue depth, pages per second and latency percentiles
+    """
+
+    max_finished_jobs = 1000
+    """Finished jobs kept for status requests (and latency percentiles)"""
+
+    pages_per_second_window = 60
+    """Seconds of finished jobs used to calculate pages per second"""
+
+    # Options valid only for the whole service (sessions are created with service options)
+    service_options = ["parallel_percent", "cache_dir", "cache_size", "verbose_mode", "worker_max_tasks", "watch_mode", "service_port",
+                       "service_jobs", "pause_end_mode"]
+
+    def __init__(self, args, argument_parser, session):
+        super().__init__()
+        self.args = args
+        self.verbose_mode = args.verbose_mode
+        self.argument_parser = argument_parser
+        self.sessions = [session] + [Pdf2PdfOcrSession(args) for _ in range(args.service_jobs - 1)]
+        self.jobs_lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.jobs_queue = queue.Queue()
+        self.last_job_id = 0
+        self.jobs_running = 0
+        self.running_pdf2ocr = set()
+        self.jobs_ok = 0
+        self.jobs_failed = 0
+        self.finished_jobs_pages = collections.deque()  # (finish time, pages) inside pages per second window
+        import http.server
+        handler_class = type("Pdf2PdfOcrServiceHTTPHandler", (Pdf2PdfOcrServiceHandler, http.server.BaseHTTPRequestHandler), {})
+        self.http_server = http.server.ThreadingHTTPServer(("127.0.0.1", args.service_port), handler_class)
+        self.http_server.pdf2ocr_service = self
+
+    def run(self):
+        for session in self.sessions:
+            threading.Thread(target=self.run_jobs, args=(session,), daemon=True).start()
+        self.log("Service listening on http://127.0.0.1:{0} with {1} concurrent jobs".format(self.args.service_port, len(self.sessions)))
+        try:
+            self.http_server.serve_forever()
+        finally:
+            self.http_server.server_close()
+            with self.jobs_lock:
+                running_pdf2ocr = list(self.running_pdf2ocr)
+            for job_pdf2ocr in running_pdf2ocr:
+                job_pdf2ocr.cleanup()
+            for session in self.sessions[1:]:
+                session.close()
+
+    def submit_job(self, job_request):
+        """Validate and queue a new job. Return HTTP status code and response"""
+        if not isinstance(job_request, dict) or not isinstance(job_request.get("input_file"), str) or \
+                not isinstance(job_request.get("options", []), list):
+            return 400, {"error": "'input_file' (string) and 'options' (list of strings) are expected"}
+        job_input_file = os.path.abspath(job_request["input_file"])
+        if not os.path.isfile(job_input_file):
+            return 400, {"error": "input file {0} not found".format(job_input_file)}
+        try:
+            job_args = self.argument_parser.parse_args(["-i", job_input_file] + [str(option) for option in job_request.get("options", [])])
+        except SystemExit:
+            return 400, {"error": "invalid options {0}".format(job_request.get("options"))}
+        for service_option in self.service_options:
+            setattr(job_args, service_option, getattr(self.args, service_option))
+        with self.jobs_lock:
+            self.last_job_id += 1
+            job = {"id": self.last_job_id, "status": "queued", "input_file": job_input_file, "output_file": None, "error": None,
+                   "pages": None, "submitted": time.time(), "started": None, "finished": None}
+            self.jobs[job["id"]] = job
+        self.jobs_queue.put((job, job_args))
+        self.debug("Job {0} queued for {1}".format(job["id"], job_input_file))
+        return 202, dict(job)
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def run_jobs(self, session):
+        while True:
+            job, job_args = self.jobs_queue.get()
+            with self.jobs_lock:
+                job["status"] = "running"
+                job["started"] = time.time()
+                self.jobs_running += 1
+            job_pdf2ocr = None
+            try:
+                job_pdf2ocr = Pdf2PdfOcr(job_args, job["input_file"], session)
+                with self.jobs_lock:
+                    self.running_pdf2ocr.add(job_pdf2ocr)
+                run_ocr(job_pdf2ocr, job_args.timeout)
+                job_error = None
+            except Pdf2PdfOcrException as e:
+                job_error = str(e)
+            except Exception as e:
+                # Unexpected errors should not stop the service
+                job_error = "unexpected error: {0}".format(e)
+                session.restart_pool()
+            finally:
+                # Temp dir of a job is removed even after unexpected errors (cleanup was already called after any other error)
+                if job_pdf2ocr is not None:
+                    job_pdf2ocr.cleanup()
+                # Cache of a long running service is kept in its maximum size
+                if session.cache is not None:
+                    session.cache.evict()
+            self.finish_job(job, job_pdf2ocr, job_error)
+
+    def finish_job(self, job, job_pdf2ocr, job_error):
+        with self.jobs_lock:
+            job["finished"] = time.time()
+            job["error"] = job_error
+            self.jobs_running -= 1
+            self.running_pdf2ocr.discard(job_pdf2ocr)
+            if job_error is None:
+                job["status"] = "done"
+                job["output_file"] = job_pdf2ocr.output_file
+                job["pages"] = job_pdf2ocr.input_file_number_of_pages
+                self.jobs_ok += 1
+                self.finished_jobs_pages.append((job["finished"], job["pages"] or 0))
+            else:
+                job["status"] = "error"
+                self.jobs_failed += 1
+            # Oldest finished jobs are forgotten
+            while len(self.jobs) > self.max_finished_jobs + self.jobs_queue.qsize() + self.jobs_running:
+                oldest_job_id = next(iter(self.jobs))
+                if self.jobs[oldest_job_id]["finished"] is None:
+                    break
+                self.jobs.pop(oldest_job_id)
+        self.log("Job {0} finished with status '{1}' in {2:.3f} seconds".format(job["id"], job["status"], job["finished"] - job["submitted"]))
+
+    def get_metrics(self):
+        with self.jobs_lock:
+            now = time.time()
+            while len(self.finished_jobs_pages) > 0 and self.finished_jobs_pages[0][0] < now - self.pages_per_second_window:
+                self.finished_jobs_pages.popleft()
+            latencies = sorted(job["finished"] - job["submitted"] for job in self.jobs.values() if job["finished"] is not None)
+            metrics = {
+                "queue_depth": self.jobs_queue.qsize(),
+                "jobs_running": self.jobs_running,
+                "jobs_done": self.jobs_ok,
+                "jobs_failed": self.jobs_failed,
+                "pages_per_second": sum(pages for finish_time, pages in self.finished_jobs_pages) / self.pages_per_second_window,
+            }
+        for percentile in [50, 90, 99]:
+            latency = None
+            if len(latencies) > 0:
+                latency = latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+            metrics["latency_p{0}_seconds".format(percentile)] = latency
+        return metrics
+
+
+class Pdf2PdfOcrServiceHandler:
+    """HTTP requests of service mode. Mixed with http.server.BaseHTTPRequestHandler when the service starts, to keep startup fast"""
+
+    def send_json(self, status_code, response):
+        response_data = json.dumps(response).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response_data)))
+        self.end_headers()
+        self.wfile.write(response_data)
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            job_request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_json(400, {"error": "invalid JSON"})
+            return
+        self.send_json(*self.server.pdf2ocr_service.submit_job(job_request))
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.server.pdf2ocr_service.get_metrics())
+            return
+        job = None
+        if self.path.startswith("/jobs/") and self.path[len("/jobs/"):].isdigit():
+            job = self.server.pdf2ocr_service.get_job(int(self.path[len("/jobs/"):]))
+        if job is None:
+            self.send_json(404, {"error": "not found"})
+        else:
+            self.send_json(200, job)
+
+    def log_message(self, format_string, *args):
+        self.server.pdf2ocr_service.debug("HTTP {0} - {1}".format(self.address_string(), format_string % args))
+
+
 # To be used on signal handling
 # noinspection PyUnusedLocal,PyUnusedLocal
 def sigint_handler(signum, frame):
     global pdf2ocr
-    pdf2ocr.cleanup()
+    if pdf2ocr is not None:
+        pdf2ocr.cleanup()
+    pdf2ocr_session.close()
     sys.exit(1)
 
 
-# -------------
-# MAIN
-# -------------
-if __name__ == '__main__':
-    # https://docs.python.org/3/library/multiprocessing.html#multiprocessing-programming
-    # See "Safe importing of main module"
-    multiprocessing.freeze_support()  # Should make effect only on non-fork systems (Windows)
-    #
-    # From tesseract docs:
-    # "If the tesseract executable was built with multithreading support, it will normally use four CPU cores for the OCR process. While this can be
-    # faster for a single image, it gives bad performance if the host computer provides less than four CPU cores or if OCR is made for many images.
-    # Only a single CPU core is used with OMP_THREAD_LIMIT=1"
-    # As we control number of parallel executions, set this env var for the entire script.
-    os.environ['OMP_THREAD_LIMIT'] = '1'
-    #
-    # Adjust Imagemagick parallel control
-    # https://legacy.imagemagick.org/script/resources.php
-    os.environ['MAGICK_THREAD_LIMIT'] = '1'
-    #
-    # Arguments
+def run_ocr(param_pdf2ocr, param_timeout):
+    """OCR of one file, with optional time limit in seconds. Errors are raised as Pdf2PdfOcrException"""
+    if param_timeout:
+        # https://stackoverflow.com/questions/56305195/is-it-possible-to-specify-the-max-amount-of-time-to-wait-for-code-to-run-with-py
+        # /56305465
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            future_pdf2ocr = executor.submit(param_pdf2ocr.ocr)
+            try:
+                future_pdf2ocr.result(param_timeout)
+            except futures.TimeoutError as fte:
+                #
+                # https://stackoverflow.com/questions/48350257/how-to-exit-a-script-after-threadpoolexecutor-has-timed-out
+                import atexit
+
+                # noinspection PyProtectedMember
+                atexit.unregister(futures.thread._python_exit)
+                executor.shutdown = lambda wait: None
+                #
+                param_pdf2ocr.cleanup()
+                raise Pdf2PdfOcrException("Script stopped due to timeout of {0} seconds".format(param_timeout))
+    else:
+        param_pdf2ocr.ocr()
+
+
+def process_file(param_args, param_file, param_session):
+    """Process one file with the shared session. Return True with success"""
+    global pdf2ocr
+    try:
+        print("-------------------------------------")
+        print("File:", param_file, flush=True)
+        pdf2ocr = Pdf2PdfOcr(param_args, param_file, param_session)
+        run_ocr(pdf2ocr, param_args.timeout)
+    except Pdf2PdfOcrException as e_p:
+        print("Error:", e_p, flush=True)
+        return False
+    finally:
+        pdf2ocr = None
+    return True
+
+
+def watch_folder(param_args, param_session):
+    """Watch mode: process files written to input folder, moving them to 'done' or 'error' folder. Runs until interrupted"""
+    done_dir = param_args.done_dir if param_args.done_dir is not None else param_args.input_file + os.path.sep + "done"
+    error_dir = param_args.error_dir if param_args.error_dir is not None else param_args.input_file + os.path.sep + "error"
+    os.makedirs(done_dir, exist_ok=True)
+    os.makedirs(error_dir, exist_ok=True)
+    if param_args.output_dir is None:
+        # Output files can't be created in watched folder
+        param_args.output_dir = done_dir
+    watcher = Pdf2PdfOcrWatcher(param_args.input_file, param_args.verbose_mode)
+    param_session.log("Watching folder {0} for new files".format(watcher.watch_dir))
+    for file_to_process in watcher.ready_files():
+        try:
+            success = process_file(param_args, file_to_process, param_session)
+        except Exception as e:
+            # Unexpected errors should not stop watch mode
+            print("Error:", e, flush=True)
+            param_session.restart_pool()
+            success = False
+        try:
+            Pdf2PdfOcrWatcher.move_file(file_to_process, done_dir if success else error_dir)
+        except OSError as e:
+            eprint("Warning: could not move file {0} ({1})".format(file_to_process, e))
+        if param_session.cache is not None:
+            param_session.cache.evict()
+
+
+def get_argument_parser():
+    """Command line arguments (also used by jobs of service mode)"""
     parser = argparse.ArgumentParser(
         description=('pdf2pdfocr.py [https://github.com/LeoFCardoso/pdf2pdfocr] version %s (http://semver.org/lang/pt-BR/)' % VERSION),
         formatter_class=argparse.RawTextHelpFormatter)
     requiredNamed = parser.add_argument_group('required arguments')
-    requiredNamed.add_argument("-i", dest="input_file", action="store", required=True,
-                               help="path for input file or folder")
+    requiredNamed.add_argument("-i", dest="input_file", action="store", required=False,
+                               help="path for input file or folder (not used in service mode)")
     #
     parser.add_argument("-c", dest="ocr_engine", action="store", default="tesseract", type=str,
                         help="specify OCR engine (tesseract, cuneiform, no_ocr). "
@@ -1443,17 +3752,25 @@ Examples:
     -g jpeg -> keep original color image as JPEG ("-strip -interlace Plane -gaussian-blur 0.05 -quality 50%% -compress JPEG")
     -g jpeg2000 -> keep original color image as JPEG2000 ("-quality 32%% -compress JPEG2000")
     -g smart -> try to autodetect colors and use 'jpeg' preset if one color page is detected, otherwise use preset 'best'
+    -g mixed -> autodetect colors of each page and use 'jpeg' preset for color pages and preset 'best' for the other pages
     -g="-threshold 60%% -compress Group4" -> direct apply these parameters (DON'T FORGET TO USE EQUAL SIGN AND QUOTATION MARKS)
     Note, without -g, preset 'best' is used"""
     parser.add_argument("-g", dest="convert_params", action="store", default="",
                         help=option_g_help)
     parser.add_argument("-d", dest="deskew_percent", action="store",
                         help="use imagemagick deskew *before* OCR. <DESKEW_PERCENT> should be a percent, e.g. '40%%'")
+    parser.add_argument("--deskew-ocr", dest="deskew_min_angle", action="store", type=float, default=None,
+                        help="deskew page images before OCR without rebuilding PDF (OCR text is rotated back to the original page). "
+                             "Pages with skew lower than <DESKEW_MIN_ANGLE> degrees are not deskewed")
     parser.add_argument("-u", dest="autorotate", action="store_true", default=False,
-                        help="try to autorotate pages using 'psm 0' feature [tesseract only]")
+                        help="try to autorotate pages. Orientation is read from OCR with page segmentation modes 1 and 12, "
+                             "otherwise it's detected with 'psm 0' feature in downscaled pages [tesseract only]")
+    parser.add_argument("--rotate-before-ocr", dest="rotate_before_ocr", action="store_true", default=False,
+                        help="with -u, rotate page images before OCR, so OCR is faster and better on sideways or upside-down pages")
     parser.add_argument("-j", dest="parallel_percent", action="store", type=percentual_float,
-                        help="run this percentual jobs in parallel (0 - 1.0] - multiply with the number of CPU cores"
-                             " (default = 1 [all cores])")
+                        help="run this percentual jobs in parallel (0 - 1.0] - multiply with the number of CPU cores available "
+                             "(CPU affinity and container CPU limit). Page tasks at once are also adjusted to available memory "
+                             "(default = 1 [all cores])")
     parser.add_argument("-w", dest="create_text_mode", action="store_true", default=False,
                         help="also create a text file at same location of PDF OCR file [tesseract only]")
     parser.add_argument("-o", dest="output_file", action="store", required=False,
@@ -1467,6 +3784,9 @@ Examples:
                              "improves OCR quality (default is for quality = 300)")
     parser.add_argument("-e", dest="text_generation_strategy", action="store", default="tesseract", type=str,
                         help="specify how text is generated in final pdf file (tesseract, native) [tesseract only]. Default: tesseract")
+    parser.add_argument("--text-per-line", dest="text_per_line", action="store_true", default=False,
+                        help="place OCR text by line instead of by word. Text layer is created faster and is smaller, "
+                             "but text selection is less precise [native text generation and cuneiform only]")
     parser.add_argument("-l", dest="tess_langs", action="store", required=False,
                         help="force tesseract or cuneiform to use specific language (default: por+eng)")
     parser.add_argument("-m", dest="tess_psm", action="store", required=False,
@@ -1474,10 +3794,66 @@ Examples:
                              "OCR default = 1) [tesseract only]. Use with caution")
     parser.add_argument("-x", dest="extra_ocr_flag", action="store", required=False,
                         help="add extra command line flags in select OCR engine for all pages. Use with caution")
+    parser.add_argument("--adaptive-ocr", dest="adaptive_confidence", action="store", default=None, type=int,
+                        help="adaptive OCR: pages are OCR'ed with a cheaper first pass and only pages with mean word confidence below "
+                             "this value (0-100) are OCR'ed again with normal settings [tesseract only]")
+    parser.add_argument("--adaptive-resolution", dest="adaptive_resolution", action="store", default=200, type=int,
+                        help="image resolution in DPI of adaptive OCR first pass. Not used when PDF is rebuilt from images (default: 200)")
+    parser.add_argument("--adaptive-flags", dest="adaptive_ocr_flag", action="store", required=False,
+                        help="extra tesseract flags of adaptive OCR first pass, e.g. a faster model with \"--tessdata-dir <tessdata_fast "
+                             "dir>\" (default: same as -x)")
     parser.add_argument("--timeout", dest="timeout", action="store", default=None, type=int,
                         help="run with time limit in seconds")
+    parser.add_argument("--page-timeout", dest="page_timeout", action="store", default=None, type=int,
+                        help="time limit in seconds for each page in each external tool (pdftoppm, tesseract, mogrify and convert). "
+                             "Pages over the limit are done again with cheaper settings (lower resolution, tesseract psm 6, "
+                             "'fast' preset) or get an empty text layer, and are reported at the end")
+    parser.add_argument("--blank-threshold", dest="blank_threshold", action="store", default=0, type=float,
+                        help="pages with no more than this percent of ink (pixels far from background, page borders ignored) are "
+                             "blank and will not be OCR'ed. A small value (e.g. 0.05) skips pages with only dust or scanner noise, "
+                             "but may skip pages with very little text, like a page number. Default: 0 (only pages of one color)")
+    parser.add_argument("--raster-in-memory", dest="raster_in_memory", action="store_true", default=False,
+                        help="rasterize pages as uncompressed images in memory, without JPEG files in temp dir. Not used when PDF "
+                             "is rebuilt from images")
+    parser.add_argument("--ocr-batch", dest="ocr_batch", action="store", default=1, type=int,
+                        help="number of pages OCR'ed by each tesseract process. Bigger values avoid loading language data for "
+                             "every page (default: 1)")
+    parser.add_argument("--cache-dir", dest="cache_dir", action="store", required=False,
+                        help="use a persistent cache of rasterized pages and OCR results in this directory")
+    parser.add_argument("--cache-size", dest="cache_size", action="store", default=2048, type=int,
+                        help="maximum size of cache in MBytes. Least recently used entries are removed (default: 2048)")
     parser.add_argument("--ignore-existing-text", dest="ignore_existing_text", action="store_true", default=False,
                         help="don't OCR again native PDF text")
+    parser.add_argument("--pages", dest="pages_selection", action="store", default=None, type=page_selection,
+                        help="OCR only these pages (e.g. 1-10,250-300 or 20- until the last page). Other pages are kept unchanged, "
+                             "without text")
+    parser.add_argument("--skip-text-pages", dest="skip_text_pages", action="store_true", default=False,
+                        help="don't rasterize nor OCR pages that already have text. Their native text is used in text output (-w)")
+    parser.add_argument("--tmp-dir", dest="tmp_dir_base", action="store", required=False,
+                        help="use this directory for temporary files (e.g. a tmpfs mount for speed)")
+    parser.add_argument("--resume-dir", dest="resume_dir", action="store", required=False,
+                        help="keep a work dir and a journal of each job in this directory, so a job interrupted (e.g. by timeout) "
+                             "is resumed by next run with same input file and options, without processing again the completed pages")
+    parser.add_argument("--tmp-size", dest="tmp_size", action="store", default=None, type=int,
+                        help="pause rasterization when images waiting for OCR use more than this size in MBytes")
+    parser.add_argument("--watch", dest="watch_mode", action="store_true", default=False,
+                        help="watch mode. With a folder as input, keep running and process each file written (or moved) to it. "
+                             "Processed files are moved to 'done' folder and failed files to 'error' folder. Output files are "
+                             "created in 'done' folder, unless -O is used")
+    parser.add_argument("--done-dir", dest="done_dir", action="store", required=False,
+                        help="with watch mode, folder for processed files (default: 'done' inside input folder)")
+    parser.add_argument("--error-dir", dest="error_dir", action="store", required=False,
+                        help="with watch mode, folder for files that could not be processed (default: 'error' inside input folder)")
+    parser.add_argument("--service", dest="service_port", action="store", default=None, type=int,
+                        help="service mode. Receive OCR jobs by HTTP on this port (localhost only). POST /jobs with JSON "
+                             "{\"input_file\": path, \"options\": [command line options]}, GET /jobs/<id> for job status and "
+                             "GET /metrics")
+    parser.add_argument("--service-jobs", dest="service_jobs", action="store", default=1, type=int,
+                        help="with service mode, number of jobs running at the same time, each one with its own worker pool "
+                             "(default: 1)")
+    parser.add_argument("--worker-max-tasks", dest="worker_max_tasks", action="store", default=None, type=int,
+                        help="restart each worker process after this number of tasks, to limit memory growth of long runs "
+                             "(watch and service modes)")
     parser.add_argument("-k", dest="keep_temps", action="store_true", default=False,
                         help="keep temporary files for debug")
     parser.add_argument("-v", dest="verbose_mode", action="store_true", default=False,
@@ -1487,11 +3863,44 @@ Examples:
                              "script (default: not wait)")
     # Dummy to be called by gooey (GUI)
     parser.add_argument("--ignore-gooey", action="store_true", required=False, default=False)
+    return parser
+
+
+# -------------
+# MAIN
+# -------------
+if __name__ == '__main__':
+    # https://docs.python.org/3/library/multiprocessing.html#multiprocessing-programming
+    # See "Safe importing of main module"
+    multiprocessing.freeze_support()  # Should make effect only on non-fork systems (Windows)
+    #
+    # From tesseract docs:
+    # "If the tesseract executable was built with multithreading support, it will normally use four CPU cores for the OCR process. While this can be
+    # faster for a single image, it gives bad performance if the host computer provides less than four CPU cores or if OCR is made for many images.
+    # Only a single CPU core is used with OMP_THREAD_LIMIT=1"
+    # As we control number of parallel executions, set this env var for the entire script.
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    #
+    # Adjust Imagemagick parallel control
+    # https://legacy.imagemagick.org/script/resources.php
+    os.environ['MAGICK_THREAD_LIMIT'] = '1'
     #
+    # Arguments
+    parser = get_argument_parser()
     pdf2ocr_args = parser.parse_args()
     #
-    dir_mode = os.path.isdir(pdf2ocr_args.input_file)
-    if dir_mode:
+    if pdf2ocr_args.input_file is None and pdf2ocr_args.service_port is None:
+        parser.error("the following arguments are required: -i")
+    if pdf2ocr_args.service_jobs < 1 or (pdf2ocr_args.worker_max_tasks is not None and pdf2ocr_args.worker_max_tasks < 1):
+        parser.error("number of service jobs and worker tasks should be positive")
+    dir_mode = pdf2ocr_args.input_file is not None and os.path.isdir(pdf2ocr_args.input_file)
+    if pdf2ocr_args.watch_mode and not dir_mode:
+        parser.error("watch mode needs a folder as input")
+    if pdf2ocr_args.watch_mode and pdf2ocr_args.output_file is not None:
+        parser.error("watch mode can't use one output file (-o) for all files. Use -O")
+    if pdf2ocr_args.watch_mode or pdf2ocr_args.service_port is not None:
+        file_to_process_list = []
+    elif dir_mode:
         file_to_process_list = []
         for t_root, t_directories, t_files in os.walk(pdf2ocr_args.input_file):
             for name in t_files:
@@ -1499,39 +3908,24 @@ Examples:
     else:
         file_to_process_list = [pdf2ocr_args.input_file]
     #
+    # Pool and external tools discovery are shared by all files
+    pdf2ocr_session = Pdf2PdfOcrSession(pdf2ocr_args)
+    pdf2ocr = None
     signal.signal(signal.SIGINT, sigint_handler)
     #
+    if pdf2ocr_args.watch_mode:
+        # Pool is kept warm between files, until interrupted
+        watch_folder(pdf2ocr_args, pdf2ocr_session)
+    if pdf2ocr_args.service_port is not None:
+        Pdf2PdfOcrService(pdf2ocr_args, parser, pdf2ocr_session).run()
+    #
     all_success = True
     for file_to_process in file_to_process_list:
-        try:
-            print("-------------------------------------")
-            print("File:", file_to_process, flush=True)
-            pdf2ocr = Pdf2PdfOcr(pdf2ocr_args, file_to_process)
-            #
-            if pdf2ocr_args.timeout:
-                # https://stackoverflow.com/questions/56305195/is-it-possible-to-specify-the-max-amount-of-time-to-wait-for-code-to-run-with-py
-                # /56305465
-                with futures.ThreadPoolExecutor(max_workers=1) as executor:
-                    future_pdf2ocr = executor.submit(pdf2ocr.ocr)
-                    try:
-                        future_pdf2ocr.result(pdf2ocr_args.timeout)
-                    except futures.TimeoutError as fte:
-                        #
-                        # https://stackoverflow.com/questions/48350257/how-to-exit-a-script-after-threadpoolexecutor-has-timed-out
-                        import atexit
-
-                        # noinspection PyProtectedMember
-                        atexit.unregister(futures.thread._python_exit)
-                        executor.shutdown = lambda wait: None
-                        #
-                        pdf2ocr.cleanup()
-                        raise Pdf2PdfOcrException("Script stopped due to timeout of {0} seconds".format(pdf2ocr_args.timeout))
-            else:
-                pdf2ocr.ocr()
-        except Pdf2PdfOcrException as e_p:
-            print("Error:", e_p, flush=True)
+        if not process_file(pdf2ocr_args, file_to_process, pdf2ocr_session):
             all_success = False
     #
+    pdf2ocr_session.close()
+    #
     if pdf2ocr_args.pause_end_mode:
         input("Press <Enter> to continue...")
     #
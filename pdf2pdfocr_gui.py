@@ -57,12 +57,20 @@ def show_gui(p_input_file_argument):
                                help="Does not process if file size in KB is lower than this value ")
     basic_options.add_argument("-d", dest="deskew_percent", metavar='Deskew (-d)', action="store",
                                help="Use imagemagick deskew before OCR. Should be a percent, e.g. '40%' ")
+    basic_options.add_argument("--deskew-ocr", dest="deskew_min_angle", metavar='Deskew OCR min angle (--deskew-ocr)', action="store", default=None,
+                               type=float, help="Deskew page images before OCR, without rebuild, when skew is at least this angle in degrees ")
     basic_options.add_argument("-w", dest="create_text_mode", metavar='Text file (-w)', action="store_true", default=False,
                                help="Create a text file at same location of PDF OCR file [tesseract only] ")
     basic_options.add_argument("-u", dest="autorotate", metavar='Autorotate (-u)', action="store_true", default=False,
-                               help="Try to autorotate pages using 'psm 0' feature [tesseract only] ")
+                               help="Try to autorotate pages, with orientation read from OCR or detected in downscaled pages [tesseract only] ")
+    basic_options.add_argument("--rotate-before-ocr", dest="rotate_before_ocr", metavar='Rotate before OCR (--rotate-before-ocr)',
+                               action="store_true", default=False, help="With autorotate, rotate page images before OCR ")
     basic_options.add_argument("--ignore-existing-text", dest="ignore_existing_text", metavar='Ignore existing text (--ignore-existing-text)',
                                action="store_true", default=False, help="don't OCR again native PDF text")
+    basic_options.add_argument("--pages", dest="pages_selection", metavar='Pages (--pages)', action="store", required=False, default=None,
+                               help="OCR only these pages (e.g. 1-10,250-300) ")
+    basic_options.add_argument("--skip-text-pages", dest="skip_text_pages", metavar='Skip pages with text (--skip-text-pages)', action="store_true",
+                               default=False, help="don't OCR pages that already have text ")
     basic_options.add_argument("-v", dest="verbose_mode", metavar='Verbose (-v)', action="store_true", default=True,
                                help="enable verbose mode ")
     #
@@ -76,26 +84,30 @@ def show_gui(p_input_file_argument):
         jpeg -> keep original color image as JPEG ("-strip -interlace Plane -gaussian-blur 0.05 -quality 50% -compress JPEG")
         jpeg2000 -> keep original color image as JPEG2000 ("-quality 32% -compress JPEG2000")
         smart -> try to autodetect colors and use 'jpeg' preset if one color page is detected, otherwise use preset 'best'
+        mixed -> autodetect colors of each page and use 'jpeg' preset for color pages and preset 'best' for the other pages
         or use custom parameters directly (USE SPACE CHAR FIRST)
         Note, without -g, preset 'best' is used
     """
     rebuild_options.add_argument("-g", dest="convert_params", metavar='Force params (-g)', action="store", default="",
                                  help=option_g_help, widget="Dropdown",
-                                 choices=["", "fast", "best", "grayscale", "jpeg", "jpeg2000", "smart",
+                                 choices=["", "fast", "best", "grayscale", "jpeg", "jpeg2000", "smart", "mixed",
                                           " -custom_params (to use custom params, please keep the first space char)"])
     #
     advanced_options = parser.add_argument_group("Advanced options")
     advanced_options.add_argument("-c", dest="ocr_engine", metavar='OCR engine (-c)', action="store", type=str, default="tesseract",
                                   help="select the OCR engine to use ", widget="Dropdown", choices=["tesseract", "cuneiform", "no_ocr"])
     advanced_options.add_argument("-j", dest="parallel_percent", metavar='Parallel (-j)', action="store", type=float, default=1.0,
-                                  help="run this percentual jobs in parallel (0 - 1.0]\nmultiply with the number of CPU cores, default = 1 [all "
-                                       "cores] ")
+                                  help="run this percentual jobs in parallel (0 - 1.0]\nmultiply with the number of CPU cores available, default = 1 "
+                                       "[all cores] ")
     advanced_options.add_argument("-r", dest="image_resolution", metavar='Resolution (-r)', action="store", default=300, type=int,
                                   help="specify image resolution in DPI before OCR operation\nlower is faster, higher improves OCR quality, default "
                                        "is for quality = 300")
     advanced_options.add_argument("-e", dest="text_generation_strategy", metavar='Text generation (-e)', action="store", default="tesseract",
                                   type=str, help="specify how text is generated in final pdf file [tesseract only] ",
                                   widget="Dropdown", choices=["tesseract", "native"])
+    advanced_options.add_argument("--text-per-line", dest="text_per_line", metavar='Text per line (--text-per-line)', action="store_true",
+                                  default=False, help="place OCR text by line instead of by word\nfaster and smaller, but text selection is less "
+                                                      "precise [native text generation and cuneiform only] ")
     advanced_options.add_argument("-l", dest="tess_langs", metavar='Languages (-l)', action="store", required=False, default="por",
                                   help="force tesseract or cuneiform to use specific language ")
     advanced_options.add_argument("-m", dest="tess_psm", metavar='Tesseract PSM (-m)', action="store", required=False,
@@ -103,8 +115,36 @@ def show_gui(p_input_file_argument):
                                        "HOCR default = 1) [tesseract only]. Use with caution ")
     advanced_options.add_argument("-x", dest="extra_ocr_flag", metavar='Extra OCR parameters (-x)', action="store", required=False, default="",
                                   help="add extra command line flags in select OCR engine for all pages.\nUse with caution ")
+    advanced_options.add_argument("--adaptive-ocr", dest="adaptive_confidence", metavar='Adaptive OCR confidence (--adaptive-ocr)', action="store",
+                                  required=False, default=None, type=int,
+                                  help="OCR with a cheaper first pass and OCR again only pages with mean word confidence below this value "
+                                       "(0-100) [tesseract only] ")
+    advanced_options.add_argument("--adaptive-resolution", dest="adaptive_resolution", metavar='Adaptive OCR resolution (--adaptive-resolution)',
+                                  action="store", default=200, type=int, help="image resolution in DPI of adaptive OCR first pass ")
+    advanced_options.add_argument("--adaptive-flags", dest="adaptive_ocr_flag", metavar='Adaptive OCR flags (--adaptive-flags)', action="store",
+                                  required=False, help="extra tesseract flags of adaptive OCR first pass, e.g. a faster model ")
     advanced_options.add_argument("-k", dest="keep_temps", metavar='Keep temps (-k)', action="store_true", default=False,
                                   help="keep temporary files for debug ")
+    advanced_options.add_argument("--blank-threshold", dest="blank_threshold", metavar='Blank page threshold % (--blank-threshold)', action="store",
+                                  default=0, type=float, help="pages with no more than this percent of ink will not be OCR'ed "
+                                                               "(0: only pages of one color) ")
+    advanced_options.add_argument("--raster-in-memory", dest="raster_in_memory", metavar='Rasterize in memory (--raster-in-memory)',
+                                  action="store_true", default=False, help="rasterize pages in memory, without image files ")
+    advanced_options.add_argument("--ocr-batch", dest="ocr_batch", metavar='Pages per OCR process (--ocr-batch)', action="store", default=1,
+                                  type=int, help="number of pages OCR'ed by each tesseract process ")
+    advanced_options.add_argument("--tmp-dir", dest="tmp_dir_base", metavar='Temp dir (--tmp-dir)', action="store", required=False,
+                                  widget="DirChooser", help="use this directory for temporary files ")
+    advanced_options.add_argument("--resume-dir", dest="resume_dir", metavar='Resume dir (--resume-dir)', action="store", required=False,
+                                  widget="DirChooser", help="keep work of interrupted jobs in this directory, to resume them in next run ")
+    advanced_options.add_argument("--tmp-size", dest="tmp_size", metavar='Temp size MB (--tmp-size)', action="store", required=False,
+                                  default=None, type=int, help="pause rasterization when images waiting for OCR use more than this size ")
+    advanced_options.add_argument("--cache-dir", dest="cache_dir", metavar='Cache dir (--cache-dir)', action="store", required=False,
+                                  widget="DirChooser", help="use a persistent cache of rasterized pages and OCR results in this directory ")
+    advanced_options.add_argument("--cache-size", dest="cache_size", metavar='Cache size MB (--cache-size)', action="store", default=2048, type=int,
+                                  help="maximum size of cache in MBytes ")
+    advanced_options.add_argument("--page-timeout", dest="page_timeout", metavar='Page timeout in seconds (--page-timeout)', action="store",
+                                  required=False, default=None, type=int,
+                                  help="time limit of each page in each tool. Slow pages are done again with cheaper settings ")
     advanced_options.add_argument("--timeout", dest="timeout", metavar='Timeout in seconds (--timeout)', action="store", required=False, default="",
                                   help="run with time limit in seconds ")
     #
@@ -0,0 +1,22 @@
+from PIL import Image, ImageDraw
+
+from pdf2pdfocr import do_check_img_blank_size
+
+
+def save_page(image_file, text=None):
+    im = Image.new("RGB", (2480, 3508), "white")
+    if text is not None:
+        ImageDraw.Draw(im).text((1200, 3200), text, fill="black")
+    im.save(image_file, quality=90)
+
+
+def test_page_with_little_text_is_not_blank_by_default(tmp_path):
+    save_page(tmp_path / "page.jpg", "Page 5")
+    assert do_check_img_blank_size(str(tmp_path / "page.jpg"), 0) == (False, (2480, 3508))
+    # With a threshold, pages with very little ink are blank
+    assert do_check_img_blank_size(str(tmp_path / "page.jpg"), 0.05)[0]
+
+
+def test_page_of_one_color_is_blank(tmp_path):
+    save_page(tmp_path / "page.jpg")
+    assert do_check_img_blank_size(str(tmp_path / "page.jpg"), 0)[0]
@@ -0,0 +1,32 @@
+from unittest import mock
+
+import PyPDF2
+from reportlab.pdfbase import pdfmetrics
+
+from pdf2pdfocr import HocrTransform
+
+WORDS_PER_LINE = 20
+LINES = 50
+
+
+def write_hocr(hocr_file):
+    lines = []
+    for line_index in range(LINES):
+        y1, y2 = 100 + line_index * 40, 130 + line_index * 40
+        words = ["<span class='ocrx_word' title='bbox {0} {1} {2} {3}; x_wconf 93'>hello{4}</span>".format(
+            100 + word_index * 100, y1, 190 + word_index * 100, y2, word_index % 3) for word_index in range(WORDS_PER_LINE)]
+        lines.append("<span class='ocr_line' title='bbox 100 {0} 2100 {1}'>{2}</span>".format(y1, y2, " ".join(words)))
+    hocr_file.write_text("<html><body><div class='ocr_page' title='bbox 0 0 2480 3508'><p class='ocr_par' title='bbox 100 100 2100 2100'>"
+                         "{0}</p></div></body></html>".format("".join(lines)))
+
+
+def test_word_widths_come_from_glyph_width_cache(tmp_path):
+    hocr_file = tmp_path / "page.hocr"
+    write_hocr(hocr_file)
+    hocr = HocrTransform(str(hocr_file), 300)
+    with mock.patch.dict(HocrTransform.glyph_widths, clear=True), \
+            mock.patch.object(pdfmetrics, "stringWidth", wraps=pdfmetrics.stringWidth) as string_width:
+        hocr.to_pdf(str(tmp_path / "page.pdf"))
+    # Only distinct glyphs are measured ("helo012"), not each of the 1000 words
+    assert string_width.call_count == len(set("hello012"))
+    assert PyPDF2.PdfReader(str(tmp_path / "page.pdf")).pages[0].extract_text().split()[:2] == ["hello0", "hello1"]
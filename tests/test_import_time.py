@@ -0,0 +1,27 @@
+import os
+import py_compile
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_TIME_BUDGET_US = 100000
+"""Cumulative import time of the module (with bytecode compiled), from "python -X importtime -c 'import pdf2pdfocr'" """
+
+
+def import_time_us():
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import pdf2pdfocr"], cwd=ROOT_DIR, capture_output=True,
+                               text=True, check=True)
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == "pdf2pdfocr":
+            return int(fields[1])
+    raise AssertionError("pdf2pdfocr not found in import times:\n{0}".format(completed.stderr))
+
+
+def test_import_time_budget():
+    # Compile time is not import time (bytecode is reused by next runs)
+    py_compile.compile(os.path.join(ROOT_DIR, "pdf2pdfocr.py"), doraise=True)
+    best_time_us = min(import_time_us() for _ in range(3))
+    assert best_time_us < IMPORT_TIME_BUDGET_US, "import takes {0} us (budget is {1} us)".format(best_time_us, IMPORT_TIME_BUDGET_US)